@@ -1,19 +1,38 @@
 import time, threading
+boot_time = time.time()                # start of the boot-to-first-ack measurement
 from time import strftime
 import subprocess
 import datetime
 import io
-import picamera
 import serial
 import sys
 import os
-import Image
 import base64
-import hashlib
 import re
 import string
 from array import array
 import RPi.GPIO as GPIO
+from rfd_metrics import LinkMetrics, send_metrics
+from rfd_service import Services
+from rfd_catalog import ImageCatalog
+from rfd_storage import StorageManager
+import rfd_phash
+import rfd_integrity
+from rfd_budget import BudgetEncoder
+from rfd_txsched import TxScheduler, Job, NORMAL
+from rfd_push import Pusher
+from rfd_pipeline import Pipeline
+from rfd_sync import SyncLink
+import rfd_frame
+import rfd_baud
+from rfd_clip import ClipRecorder
+from rfd_ring import FrameRing
+from rfd_shutdown import ShutdownCoordinator
+from rfd_timing import CycleTimer, Profiler
+import rfd_profiles
+
+# hardware profile (mux/OLED/shutdown switch...), see rfd_profiles.py
+profile = rfd_profiles.load()
 
 
 # -------------------------    GPIO inits  ---------------------------------------------
@@ -30,57 +49,49 @@ selection = 4
 enable1 = 17
 enable2 = 18
 SWITCHGPIO = 8
-AUTOSHUTDOWN = 1   # really only used if reading from a config file
-
-# GPIO.setmode(GPIO.BOARD)        # use board numbering for GPIO header vs broadcom **** broadcom used in adafruit library dependant stuff ****
-GPIO.setmode(GPIO.BCM)           # broadcom numbering, may not matter if not using oled or any adafruit libraries that need BCM
-GPIO.setwarnings(False)
-GPIO.setup(SWITCHGPIO, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-
-# GPIO settings for camera mux
-GPIO.setup(selection, GPIO.OUT)         # mux "select"
-GPIO.setup(enable1, GPIO.OUT)           # mux "enable1"
-GPIO.setup(enable2, GPIO.OUT)           # mux "enable2"
+AUTOSHUTDOWN = 1 if profile["autoshutdown"] else 0
 # -------------------------------------------------------------------------------------------
 
 
 #  ---------------------  Comms inits ----------------------
 #Serial Variables
-port  = "/dev/ttyAMA0"
-baud = 38400
+port  = profile["port"]
+baud = profile["baud"]             # command 'W' raises it, a failed resync drops back to the base rate
 timeout = 5
 wordlength = 10000
+COMMANDS = set("123456789cdBEFIKLMQRTUVWX")     # command bytes the main loop knows; garbage at a wrong rate isn't one
 checkOK = ''
-ser = serial.Serial(port = port, baudrate = baud, timeout = timeout)
+integrity = rfd_integrity.get(profile["integrity"]) or rfd_integrity.get("md5")    # chunk digest, command 'K' changes it
+ser = None                       # opened first thing in startup()
+link_sync = profile["link_sync"]  # "legacy" sync()/'S' or "marker" (rfd_sync.py), command 'L' changes it
+linksync = None                  # rfd_sync.SyncLink, made once serial is open
+ser2 = None                      # profile "port2": second radio, striped framed traffic only
 #  ----------------------------------------------------------
 
 #  -------------------  camera and directory initis  -----------------
 pic_interval = 60
 extension = ".jpg"
 #  **** folder can be machine specific  ****
-folder = "/home/pi/RFD_Pics_Logs/%s/" % strftime("%m%d%Y_%H%M%S")
+folder = "%s/%s/" % (os.environ.get("RFD_PICS_DIR", profile["folder"]), strftime("%m%d%Y_%H%M%S"))      # RFD_PICS_DIR lets rfd_bench.py run off the Pi
 
-dir = os.path.dirname(folder)
-if not os.path.exists(dir):
-    os.mkdir(dir)
-    
-fh = open(folder + "imagedata.txt","w")
-fh.write("")
-fh.close()
+metrics = LinkMetrics(folder + "linkmetrics.bin")     # link telemetry, queried with command 'M'
+services = Services(boot_time)                        # background hardware bring-up, see startup()
+catalog = ImageCatalog()                              # every image captured this flight
+storage = StorageManager(folder, catalog, profile["storage_quota_mb"], profile["storage_min_free_mb"])
+picamera = None                                       # imported by init_camera()
+display = None                                        # rfd_oled.OledDisplay, only with an OLED profile
+logfile = None
 
 class Unbuffered:
     def __init__(self,stream):
         self.stream = stream
     def write(self,data):
+        start = time.time()
         self.stream.write(data)
         self.stream.flush()
         logfile.write(data)
         logfile.flush()
-
-logfile = open(folder+"piruntimedata.txt","w")
-logfile.close()
-logfile = open(folder+"piruntimedata.txt","a")
-sys.stdout = Unbuffered(sys.stdout)
+        timer.add("log", time.time() - start)
 
 
 ###########################
@@ -88,6 +99,25 @@ sys.stdout = Unbuffered(sys.stdout)
 ###########################
 imagenumber = 0
 recentimg = ""
+bestsent = -1                          # newest image number already considered by command 'B'
+lastfinished = -1                      # newest image number the pipeline has scored (or failed)
+duplicates = rfd_phash.DuplicateFilter(profile["dup_threshold"])
+budgeter = BudgetEncoder()             # byte/time budget re-encodes for command 'Q'
+delta = None                           # rfd_delta.DeltaEncoder once 'E' needs one, see delta_encoder
+delta_base = None                      # path of the last _b the ground got in full
+scheduler = TxScheduler()              # lets ping/time sync interrupt image transfers, see send_image
+pipeline = Pipeline(None, profile["pipeline_workers"])    # post-capture work on the other cores, see finish_capture
+txcache = []                           # entries holding a base64 copy for send_image, newest last
+TX_CACHE = 8
+MAX_BATCH = 100                        # most images one 'R' request may ask for
+pusher = Pusher(catalog, folder+"imagedata.txt", profile["push_idle"], profile["push"])   # idle-time thumbnail push
+clips = ClipRecorder(profile["clip_seconds"], (profile["clip_width"], profile["clip_height"]),
+                     profile["clip_framerate"], profile["clip_bitrate"])     # H.264 circular buffer, command 'V'
+ring = FrameRing(profile["ring_seconds"], profile["ring_fps"],
+                 (profile["ring_width"], profile["ring_height"]))         # pre-trigger greyscale frames, command 'F'
+shutdown = ShutdownCoordinator(profile["shutdown_deadline"], AUTOSHUTDOWN == 1, folder+"shutdown.txt")     # see shutdown_steps()
+timer = CycleTimer(folder+"timing.txt", profile["slow_cycle"])       # main loop phase times, also in 'M'
+profiler = Profiler()                                                # command 'X'
 #Camera Settings
 width = 650
 height = 450 
@@ -96,7 +126,7 @@ sharpness = 0
 brightness = 50
 contrast = 0
 saturation = 0
-iso = 100
+iso = profile["iso"]
 camera_annotation = ''                # global variable for camera annottation, initialize to something to prevent dynamic typing from changing type
 cam_hflip = True                       # global variable for camera horizontal flip
 cam_vflip = True                       # global variable for camera vertical flip
@@ -106,54 +136,317 @@ cam_vflip = True                       # global variable for camera vertical fli
 
 #  ------------------------  Method/funciton defs  -------------------------------
 
+#  ---------------  startup  --------------------
+# Serial and the log folder come up inline since command handling needs them;
+# GPIO/mux, the camera library and the OLED (if the profile has one) are started
+# in the background and waited on with services.require() by the code that uses them.
+def init_folder():
+    global logfile
+    dir = os.path.dirname(folder)
+    if not os.path.exists(dir):
+        os.mkdir(dir)
+    fh = open(folder + "imagedata.txt","w")
+    fh.write("")
+    fh.close()
+    logfile = open(folder+"piruntimedata.txt","w")
+    logfile.close()
+    logfile = open(folder+"piruntimedata.txt","a")
+    sys.stdout = Unbuffered(sys.stdout)
+
+def init_gpio():
+    # GPIO.setmode(GPIO.BOARD)        # use board numbering for GPIO header vs broadcom **** broadcom used in adafruit library dependant stuff ****
+    GPIO.setmode(GPIO.BCM)           # broadcom numbering, may not matter if not using oled or any adafruit libraries that need BCM
+    GPIO.setwarnings(False)
+
+    if profile["mux"]:
+        # GPIO settings for camera mux
+        GPIO.setup(selection, GPIO.OUT)         # mux "select"
+        GPIO.setup(enable1, GPIO.OUT)           # mux "enable1"
+        GPIO.setup(enable2, GPIO.OUT)           # mux "enable2"
+        set_camera_A()             # initialize the camera to something so mux is not floating
+
+    if profile["shutdown_switch"]:
+        GPIO.setup(SWITCHGPIO, GPIO.IN, pull_up_down = GPIO.PUD_UP)
+        GPIO.add_event_detect(SWITCHGPIO, GPIO.FALLING, callback = switchCallback)
+
+    # event triggers; one pin may save a clip and freeze the ring together
+    triggers = {}
+    for pin, callback in ((profile["clip_trigger_gpio"], clips.trigger), (profile["ring_trigger_gpio"], ring.freeze)):
+        if pin:
+            triggers.setdefault(pin, []).append(callback)
+    for pin, callbacks in triggers.items():
+        GPIO.setup(pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
+        GPIO.add_event_detect(pin, GPIO.FALLING, callback = lambda channel, callbacks = callbacks: [c(channel) for c in callbacks],
+                              bouncetime = 500)
+
+def init_camera():
+    global picamera
+    import picamera
+
+def init_display():
+    global display
+    import rfd_oled
+    display = rfd_oled.OledDisplay(folder + "piruntimedata.txt")
+
+def startup():
+    global ser
+    global linksync
+    global ser2
+    ser = serial.Serial(port = port, baudrate = baud, timeout = timeout)
+    linksync = SyncLink(ser, baud)
+    extra = []
+    if profile["port2"]:
+        try:
+            ser2 = serial.Serial(port = profile["port2"], baudrate = baud, timeout = timeout)
+            extra.append(ser2)
+        except (serial.SerialException, OSError), e:
+            print "Second link", profile["port2"], "unavailable:", e
+    pusher.framer = rfd_frame.Framer(ser, extra)
+    pipeline.start()                    # forks its workers, so before any thread starts
+    init_folder()
+    storage.timer = timer.add
+    storage.start()
+    reset_cam()
+    services.start("gpio", init_gpio)
+    services.start("camera", init_camera)
+    if profile["oled"]:
+        services.start("display", init_display)
+    services.serving()
+    if profile["clip_arm"]:
+        start_clips()
+    if profile["ring"]:
+        start_ring()
+
+# Starts the clip buffer once the camera library is up
+def start_clips():
+    if not services.require("camera"):
+        return False
+    try:
+        with ring.lock:
+            ring.release()              # the ring borrows the recorder's camera instead
+            clips.start(picamera)
+        return True
+    except Exception, e:
+        print "Clip recording failed to start", e
+        return False
+
+def stop_clips():
+    with ring.lock:
+        clips.stop()
+
+def start_ring():
+    if not services.require("camera"):
+        return False
+    ring.start(picamera, held_camera)
+    return True
+
+# Writes out the frozen ring frames and thaws it.  Returns their catalog ids.
+def save_frozen():
+    number = ring.freezes
+    ids = []
+    for frame, (stamp, data) in enumerate(ring.frozen_frames()):
+        name = "ring%03d_f%02d.pgm" % (number, frame)
+        entry = catalog.add(name, folder+name, number, 'r', frame = frame, resolution = (ring.width, ring.height))
+        storage.save(entry, data, "%s @ time(%s) ring(%d) frame(%d) id(%d)\n"
+                     % (name, datetime.datetime.fromtimestamp(stamp).strftime("%m/%d/%Y %H:%M:%S.%f")[:-3],
+                        number, frame, entry["id"]))
+        ids.append(entry["id"])
+    ring.saved += len(ids)
+    print "Frame ring freeze", number, "saved,", len(ids), "frames, trigger %.3fs ago" % (time.time() - ring.frozen)
+    ring.thaw()
+    return ids
+
+# Saves the clip buffer (last `seconds` of it) as segment files.  Returns the
+# catalog ids of the segments, [] if nothing was recording.
+def save_clip(seconds = None):
+    saved = clips.save(seconds)
+    if saved is None:
+        return []
+    number, data, bounds = saved
+    ids = []
+    for segment, (start, end) in enumerate(bounds):
+        name = "clip%03d_s%02d.264" % (number, segment)
+        entry = catalog.add(name, folder+name, number, 'v', segment = segment)
+        storage.save(entry, data[start:end], "%s @ time(%s) clip(%d) segment(%d) id(%d)\n"
+                     % (name, datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"), number, segment, entry["id"]))
+        ids.append(entry["id"])
+    print "Clip", number, "saved,", len(ids), "segments", len(data), "bytes"
+    return ids
+
+# Stops the profiler and stores its report(s).  Returns their catalog ids.
+def save_profile():
+    number = profiler.runs
+    ids = []
+    for suffix, data in profiler.stop():
+        name = "prof%03d_%s" % (number, suffix)
+        entry = catalog.add(name, folder+name, number, 'p')
+        storage.save(entry, data, "%s @ time(%s) profile(%d) id(%d)\n"
+                     % (name, datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"), number, entry["id"]))
+        ids.append(entry["id"])
+    print "Profile", number, "saved,", len(ids), "files"
+    return ids
+
+# The camera the clip recorder has open while it records
+def held_camera():
+    return clips.camera
+
+# While a clip is recording the camera is the recorder's: stills come off its
+# video port, since its resolution can't change under it, and its settings
+# are left alone.  The frame ring instead gives its own camera up, so stills
+# are real full-res captures; it reopens it on its next frame.  The ring's
+# lock keeps the ring off the camera meanwhile.
+def open_still_camera():
+    ring.lock.acquire()
+    if held_camera() is not None:
+        return held_camera()
+    ring.release()
+    return picamera.PiCamera()
+
+# True if the still camera is the recorder's, see open_still_camera()
+def still_borrowed(camera):
+    return camera is held_camera()
+
+# The size a still of `size` really comes out at: off a borrowed camera's
+# video port no bigger than its frames and with their aspect ratio
+def still_size(camera, size):
+    if not still_borrowed(camera):
+        return size
+    frame_width, frame_height = camera.resolution
+    width = min(size[0], frame_width)
+    height = width * frame_height // frame_width
+    if height > size[1]:
+        height = size[1]
+        width = height * frame_width // frame_height
+    return (width, height)
+
+def capture_still(camera, output, format, size):
+    if still_borrowed(camera):
+        camera.capture(output, format = format, use_video_port = True, resize = still_size(camera, size))
+    else:
+        camera.resolution = size
+        camera.capture(output, format = format)
+
+def close_still_camera(camera):
+    if not still_borrowed(camera):
+        camera.close()
+    ring.lock.release()
+
+# No-ops unless the profile has an OLED and it came up
+def UpdateDisplay():
+    if display is not None:
+        with timer.timed("display"):
+            display.update()
+
+def smile():
+    if display is not None:
+        display.smile()
+
 # switchCallback() called from event_detect (ISR)
+# only asks for the shutdown; the main loop runs it, see shutdown_steps()
 def switchCallback(channel):
-    global AUTOSHUTDOWN
-    
-    if AUTOSHUTDOWN == 1:
-        os.system('/sbin/shutdown -h now')
-    sys.exit(0)
+    shutdown.request("switch on GPIO %d" % channel)
+
+# What the main loop does, in order, once a shutdown has been requested.  Each
+# step gets the seconds left before the deadline.
+def stop_transfers(remaining):
+    if pusher.job is not None and not pusher.job.done:
+        scheduler.cancel(pusher.job)
+        print "Shutdown: background push cancelled"
+
+def stop_buffers(remaining):
+    if clips.triggered:
+        save_clip()
+    if ring.frozen is not None:
+        save_frozen()
+    if profiler.running():
+        save_profile()
+    ring.stop()
+    stop_clips()
+
+def flush_logs(remaining):
+    timer.write(True)
+    if logfile is not None:
+        logfile.flush()
+        os.fsync(logfile.fileno())
+
+def close_serial(remaining):
+    for port in (ser, ser2):
+        if port is not None:
+            port.close()
+
+def release_gpio(remaining):
+    if services.ready("gpio"):
+        GPIO.cleanup()
+
+def shutdown_steps():
+    shutdown.add("transfers", stop_transfers)
+    shutdown.add("buffers", stop_buffers)
+    shutdown.add("pipeline", lambda remaining: (pipeline.flush(remaining), pipeline.close()))
+    shutdown.add("storage", lambda remaining: storage.flush(remaining))
+    shutdown.add("logs", flush_logs)
+    shutdown.add("serial", close_serial)
+    shutdown.add("gpio", release_gpio)
 
 ###############################
 # Cameras B-D are used in the #
 # multiplexer system. In the  #
 # single camera system they   #
-# are never used.             #
+# are never used (profile     #
+# "cameras" lists the ones    #
+# wired up).                  #
 ###############################
 
+# True if the profile has the camera on its mux; waits for GPIO bring-up
+def camera_available(name):
+    if name not in profile["cameras"]:
+        print "Camera", name, "not in hardware profile", profile["name"]
+        return False
+    return services.require("gpio")
+
 def enable_camera_A():
+    if not camera_available('A'):
+        return
+    set_camera_A()
+    return
+
+def set_camera_A():
     global cam_hflip
     global cam_vflip
     global camera_annotation
-    GPIO.output(selection, False)
-    GPIO.output(enable2, True)          # pin that needs to be high set first to avoid enable 1 and 2 being low at same time
-    GPIO.output(enable1, False)         # if coming from a camera that had enable 2 low then we set enable 1 low on next camera
-    #GPIO.output(enable2, True)         # first, we would have both enables low at the same time
+    if profile["mux"]:
+        GPIO.output(selection, False)
+        GPIO.output(enable2, True)          # pin that needs to be high set first to avoid enable 1 and 2 being low at same time
+        GPIO.output(enable1, False)         # if coming from a camera that had enable 2 low then we set enable 1 low on next camera
+        #GPIO.output(enable2, True)         # first, we would have both enables low at the same time
     cam_hflip = True
     cam_vflip = True
     camera_annotation = ''
-    time.sleep(0.5)
+    if profile["mux"]:
+        time.sleep(0.5)
     return
 
 def enable_camera_B():
     global cam_hflip
     global cam_vflip
     global camera_annotation
+    if not camera_available('B'):
+        return
     GPIO.output(selection, True)
     GPIO.output(enable2, True)
     GPIO.output(enable1, False)
     #GPIO.output(enable2, True)
-    cam_hflip = True
-    cam_vflip = True
-    camera_annotation = ''
+    cam_hflip = profile["camera_b_flip"]
+    cam_vflip = profile["camera_b_flip"]
+    camera_annotation = profile["camera_b_annotation"]
     time.sleep(0.5)                        # ??? are these delays going to mess with timming else where ???
     return
 
-'''
 def enable_camera_C():
     global cam_hflip
     global cam_vflip
     global camera_annotation
+    if not camera_available('C'):
+        return
     GPIO.output(selection, False)
     GPIO.output(enable1, True)           # make sure first enable pin to be changed is going high
     GPIO.output(enable2, False)
@@ -167,6 +460,8 @@ def enable_camera_D():
     global cam_hflip
     global cam_vflip
     global camera_annotation
+    if not camera_available('D'):
+        return
     GPIO.output(selection, True)
     GPIO.output(enable1, True)
     GPIO.output(enable2, False)
@@ -175,7 +470,6 @@ def enable_camera_D():
     camera_annotation = 'Camera D'
     time.sleep(0.5)
     return
-'''
 
 ###########################
 # Method is used to reset #
@@ -198,7 +492,7 @@ def reset_cam():
     brightness = 50
     contrast = 0
     saturation = 0
-    iso = 100
+    iso = profile["iso"]
     file = open(folder + "camerasettings.txt","w")
     file.write(str(width)+"\n")
     file.write(str(height)+"\n")
@@ -221,19 +515,29 @@ def b64_to_image(data,savepath):
     fl.write(data.decode('base4'))
     fl.close()
 
-# Generates the checksum used to verify packet transmission
-def gen_checksum(data,pos):
-    return hashlib.md5(data[pos:pos+wordlength]).hexdigest()
+# Generates the checksums used to verify packet transmission: one per chunk,
+# taken in one pass and cached on the image's catalog entry for resends
+def chunk_checksums(exportpath, data, wordlength):
+    entry = catalog.get(os.path.basename(exportpath))
+    key = (integrity.name, wordlength)
+    if entry is not None and key in entry.get("digests", {}):
+        return entry["digests"][key]
+    digests = rfd_integrity.chunk_digests(integrity, data, wordlength)
+    if entry is not None:
+        entry.setdefault("digests", {})[key] = digests
+    return digests
 
 # Verifies the checksums
 def sendword(data,pos):
     if(pos + wordlength < len(data)):
         for x in range(pos, pos+wordlength):
             ser.write(data[x])
+        metrics.wrote(wordlength)
         return
     else:
         for x in range(pos, len(data)):
             ser.write(data[x])
+        metrics.wrote(len(data) - pos)
         return
 ################################################################
 # Sync is used to sync the groundstation and the image system. #
@@ -242,7 +546,8 @@ def sendword(data,pos):
 def sync():
     synccheck = ''
     synctry = 5
-    syncterm = time.time() + 10
+    syncstart = time.time()
+    syncterm = syncstart + 10
     while((synccheck != 'S')&(syncterm > time.time())):
         ser.write("sync")
         synccheck = ser.read()
@@ -251,275 +556,829 @@ def sync():
                 print "SyncError"
                 break
         synctry -= 1
+    metrics.sync_result(synccheck == 'S', time.time() - syncstart)
     time.sleep(0.5)
-    return
+    return synccheck == 'S'
+
+# Moves the primary link to `rate`; everything sized from baud follows it
+def set_rate(rate):
+    global baud
+    if ser.baudrate != rate:
+        rfd_baud.drain(ser)
+        ser.baudrate = rate
+    baud = rate
+    linksync.baud = rate
+    print "Serial rate", rate
+
+# Drops a negotiated rate back to the base rate, where the ground station
+# also ends up once its commands go unacked (see rfd_baud.py)
+def fall_back_rate(reason):
+    if baud != profile["baud"]:
+        print "Serial rate", baud, "lost:", reason
+        set_rate(profile["baud"])
+
+# Brings the ground station back in step before (re)sending chunk `seq`, with
+# the marker resync or the old sync().  Returns False if the link is lost.
+# A failed old sync() only counts as lost at a negotiated rate, which it then
+# drops; at the base rate the transfer carries on as it always has.
+def resync(seq):
+    if link_sync == "marker":
+        start = time.time()
+        ok = linksync.resync(seq, metrics.srtt)
+        metrics.sync_result(ok, time.time() - start)
+        print "Resync to chunk", seq, "ok" if ok else "failed", "in %.3fs" % (time.time() - start)
+        if not ok:
+            fall_back_rate("resync failed")
+        return ok
+    if sync() or baud == profile["baud"]:
+        return True
+    fall_back_rate("sync failed")
+    return False
+
+# Waits for the ground station's 'Y'/'N' after a chunk
+def read_chunk_ack():
+    if link_sync == "marker":
+        return linksync.read_ack(metrics.srtt)
+    return ser.read()
+
+# Reads a short '\n' terminated request (command arguments) from the ground station
+def read_request(limit = 64):
+    request = ''
+    temp = ser.read()
+    while (temp != '') and (temp != '\n') and (len(request) < limit):
+        request += temp
+        temp = ser.read()
+    return request.strip()
 
-# Transmits the image and uses the checksum method to verify transmission
+# Re-encodes a captured image to fit a ground station budget for command 'Q'.
+# request is "<bytes>" or "t<seconds>", optionally followed by ",<image name>";
+# returns the name of the file to send.
+def budget_image(request):
+    parts = request.split(",")
+    name = recentimg
+    if len(parts) > 1 and parts[1] != '':
+        name = parts[1]
+    if parts[0].startswith('t'):
+        budget = budgeter.bytes_for_time(float(parts[0][1:]), metrics.goodput(), baud)
+    else:
+        budget = int(parts[0])
+    entry = catalog.get(name)
+    if entry is None:
+        print "Budget request for unknown image", name
+        return name
+    sources = []
+    full = catalog.get(name.replace("_b.jpg", "_a.png"))
+    if full is not None and full["stored"] and not full["thinned"]:
+        sources.append((full["path"], full["resolution"]))
+    sources.append((entry["path"], entry["resolution"]))
+    for path, res in sources:
+        storage.wait(path)
+    result = budgeter.fit(name, sources, budget)
+    if result is None:
+        print "No encoding of", name, "fits", budget, "bytes, sending original"
+        return name
+    sendname = "%s%04d%s" % ("image", entry["number"], "_q.jpg")
+    fh = open(folder + sendname, "wb")
+    fh.write(result["data"])
+    fh.close()
+    print "Budget", budget, "->", result["bytes"], "bytes q =", result["quality"], "res =", result["resolution"]
+    return sendname
+
+# Looks up an image id for command 'I'.  Returns the catalog entry, or None
+# if the request isn't an id of an image that is on the card.
+def lookup_image(request):
+    try:
+        entry = catalog.by_id(int(request))
+    except ValueError:
+        print "Bad image id", repr(request)
+        return None
+    if entry is None:
+        print "No image with id", request
+        return None
+    if not entry["stored"] or entry["thinned"]:
+        print "Image", entry["name"], "is not on the card"
+        return None
+    return entry
+
+# Builds the changed-tile delta of a _b image against the ground station's copy
+# rfd_delta needs NumPy, which takes about a second to import on a Pi: it is
+# loaded the first time 'E' asks for a delta, not at boot, and the encoder is
+# seeded with the last _b the ground got in full.
+def delta_encoder():
+    global delta
+    if delta is None:
+        from rfd_delta import DeltaEncoder
+        delta = DeltaEncoder()
+        if delta_base is not None:
+            fh = open(delta_base, "rb")
+            delta.full_sent(os.path.basename(delta_base), fh.read())
+            fh.close()
+    return delta
+
+# for command 'E' ("name", "" for the recent one, ",full" to skip the delta).
+# Returns (name to send, True if it is a delta).
+def delta_image(request):
+    parts = request.split(",")
+    name = parts[0] or recentimg
+    if "full" in parts[1:]:
+        print "Full image asked for"
+        return name, False
+    storage.wait(folder+name)
+    fh = open(folder+name, "rb")
+    data = fh.read()
+    fh.close()
+    out = delta_encoder().encode(data)
+    if out is None:
+        print "No usable reference for", name, "sending full image"
+        return name, False
+    entry = catalog.get(name)
+    sendname = "%s%04d%s" % ("image", entry["number"], "_d.bin")
+    fh = open(folder+sendname, "wb")
+    fh.write(out)
+    fh.close()
+    print "Delta", len(out), "bytes vs", len(data), "full"
+    return sendname, True
+
+#  --------  control commands  --------
+# Ping ('6') and time sync ('T') are also served in the middle of an image
+# transfer (see send_image_steps), so they live here rather than in the main loop
+def handle_ping():
+    ser.write('A')
+    print "Ping Request Received"
+    try:
+        termtime = time.time() + 10
+        pingread = ser.read()
+        while ((pingread != 'D') & (pingread != "")&(termtime > time.time())):
+            if (pingread == 'P'):
+                print "Ping Received"
+                metrics.ping_in()
+                ser.flushInput()
+                ser.write('P')
+                metrics.ping_out()
+            else:
+                print "pingread = ",pingread
+                ser.flushInput()
+                ser.write('A')
+            pingread = ser.read()
+            sys.stdin.flush()
+    except:
+        print "Ping Runtime Error"
+
+def handle_time():
+    ser.write('A')
+    try:
+        print "Time Sync Request Recieved"
+
+        timeval=str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"))+"\n"
+        for x in timeval:
+            ser.write(x)
+    except:
+        print "error with time sync"
+
+scheduler.control = {'6': handle_ping, 'T': handle_time}
+
+# Transmits the image and uses the checksum method to verify transmission.
+# Runs through the transmit scheduler so control commands can cut in between chunks.
 def send_image(exportpath, wordlength):
+    return scheduler.run(Job(os.path.basename(exportpath), send_image_steps(exportpath, wordlength)))
+
+# send_image as a generator: yields after every chunk, and last yields whether the
+# transfer succeeded.  A control command byte in place of the chunk ack is handed
+# to the scheduler and the chunk is resent once it has been served.
+def send_image_steps(exportpath, wordlength):
+    global delta_base
     timecheck = time.time()
+    storage.wait(exportpath)            # may still be queued for the card
     done = False
     cur = 0
     trycnt = 0
-    outbound = image_to_b64(exportpath)
+    sendok = True
+    entry = catalog.get(os.path.basename(exportpath))
+    if entry is not None and "encoded" in entry:
+        outbound = entry["encoded"]     # from the pipeline's transmit cache
+    else:
+        outbound = image_to_b64(exportpath)
     size = len(outbound)
+    checksums = chunk_checksums(exportpath, outbound, wordlength)
     print size,": Image Size"
     print "photo request received"
+    metrics.transfer_start(os.path.basename(exportpath), size, os.path.getsize(exportpath))
     while(cur < len(outbound)):
+        if shutdown.requested():
+            print "Shutdown: transfer of", os.path.basename(exportpath), "stopped @", cur, "of", size
+            sendok = False
+            break
         print "Send Position:", cur," // Remaining:", int((size - cur)/1024), "kB"
-        checkours = gen_checksum(outbound,cur)
+        checkours = checksums[cur // wordlength]
         ser.write(checkours)
         sendword(outbound,cur)
-        checkOK = ser.read()
+        UpdateDisplay()
+        checkOK = read_chunk_ack()
+        if scheduler.is_control(checkOK):
+            print "Control command", checkOK, "during transfer, resending @", cur, "after it"
+            scheduler.preempt(checkOK)
+            yield None
+            continue
+        metrics.chunk_result(min(wordlength, size - cur), checkOK)
         if (checkOK == 'Y'):
             cur = cur + wordlength
             trycnt = 0
         else:
-            if(trycnt < 3):
-                sync()
+            if(trycnt < 3) and resync(cur // wordlength):
                 trycnt += 1
                 print "try number:", trycnt
                 print "resending last @", cur
-                print "ours:",checkours
+                print "ours:",integrity.text(checkours)
             else:
                 print "error out"
                 cur = len(outbound)
+                sendok = False
+        yield None
+    metrics.transfer_end(sendok)
+    if sendok and entry is not None:
+        entry["downlinked"] = True      # nothing left for the background push to do
+    if sendok and exportpath.endswith("_b.jpg"):
+        # the ground station now has this frame in full, deltas are taken against it
+        delta_base = exportpath
+        if delta is not None:
+            fh = open(exportpath, "rb")
+            delta.full_sent(os.path.basename(exportpath), fh.read())
+            fh.close()
     print "Image Send Complete"
     print "Send Time =", (time.time() - timecheck)
-    return
+    yield sendok
+
+# Parses a batch request for command 'R': image numbers as a comma separated
+# list of numbers and ranges, e.g. "10-40" or "3,5,9-12".  Returns the numbers,
+# ValueError if the request is malformed.
+def batch_numbers(request):
+    numbers = []
+    for part in request.split(","):
+        part = part.strip()
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            first = int(first)
+            # clamped before expanding: "0-999999999" must not build the list
+            last = min(int(last), first + MAX_BATCH - len(numbers))
+            numbers.extend(range(first, last + 1))
+        else:
+            numbers.append(int(part))
+        if len(numbers) > MAX_BATCH:
+            break
+    return numbers[:MAX_BATCH]
+
+# Streams the _b images of a batch back to back as rfd_frame frames and ends
+# with a BATCH_END frame giving how many were sent and how many don't exist.
+def batch_steps(numbers):
+    timecheck = time.time()
+    sent = 0
+    missing = 0
+    total = 0
+    for number in numbers:
+        entry = catalog.get("%s%04d%s" % ("image", number, "_b.jpg"))
+        if entry is None:
+            missing += 1
+            continue
+        storage.wait(entry["path"])
+        fh = open(entry["path"], "rb")
+        data = fh.read()
+        fh.close()
+        for x in rfd_frame.image_steps(pusher.framer, entry["name"], data):
+            yield x
+        entry["downlinked"] = True
+        sent += 1
+        total += len(data)
+    pusher.framer.send(rfd_frame.BATCH_END, rfd_frame.BATCH_END_INFO.pack(sent, missing))
+    print "Batch sent", sent, "images", total, "bytes,", missing, "missing, in", (time.time() - timecheck)
+    yield True
+
+# Sends a batch.  The frames aren't acked, so a control command from the ground
+# is noticed between frames and served; any other byte cancels the batch.
+def send_batch(request):
+    try:
+        numbers = batch_numbers(request)
+    except ValueError:
+        # still answered with a BATCH_END (0 sent, 0 missing), or the ground
+        # waits out its timeout
+        print "Bad batch request", repr(request)
+        numbers = []
+    job = Job("batch", batch_steps(numbers), NORMAL)
+    while scheduler.run_until(job, lambda: ser.inWaiting() > 0 or shutdown.requested()):
+        if shutdown.requested():
+            print "Shutdown: batch stopped"
+            scheduler.cancel(job)
+            return False
+        byte = ser.read()
+        if scheduler.is_control(byte):
+            scheduler.preempt(byte)
+        else:
+            print "Batch cancelled by ground station"
+            scheduler.cancel(job)
+            return False
+    pusher.framer.drain()               # the batch is out, BATCH_END included, on return
+    return job.result
+
+# Pipeline result for a capture (rfd_pipeline.py), called in capture order:
+# records the score and hash, flags near-duplicates, keeps the transmit cache
+# and hands both images to the storage writer
+def finish_capture(job, result):
+    global lastfinished
+    entry = job["entry"]
+    line = job["line"]
+    if "error" in result:
+        print "Pipeline error on", entry["name"], result["error"]
+    quality = result.get("quality")
+    if quality is not None:
+        entry.update(quality)
+        print "Image score", quality["score"], "exposure", quality["exposure"], "sharpness", quality["sharpness"], "entropy", quality["entropy"]
+    entry["dhash"] = result.get("dhash")
+    entry["duplicate_of"] = duplicates.check(entry["name"], entry["dhash"])
+    if entry["dhash"] is not None:
+        line += " hash(%016x)" % entry["dhash"]
+    if entry["duplicate_of"] is not None:
+        line += " dup(%s)" % entry["duplicate_of"]
+        print "Near-duplicate of", entry["duplicate_of"]
+    if "encoded" in result:
+        entry["encoded"] = result["encoded"]
+        entry.setdefault("digests", {})[result["digest_key"]] = result["digests"]
+        txcache.append(entry)
+        while len(txcache) > TX_CACHE:
+            txcache.pop(0).pop("encoded", None)
+    if job["full"] is not None:
+        fullname, data, fullline = job["full"]
+        if entry["duplicate_of"] is not None and profile["dedup_fullres"]:
+            storage.release(folder+fullname)
+            print "( 2592 , 1944 ) photo not stored, near-duplicate"
+        else:
+            full = catalog.add(fullname, folder+fullname, entry["number"], 'a', resolution = (2592,1944))
+            storage.save(full, data, fullline + " id(%d)\n" % full["id"])
+            print "( 2592 , 1944 ) photo saved"
+    storage.save(entry, job["data"], line + "\n")
+    print "(",entry["resolution"][0],",",entry["resolution"][1],") photo saved"
+    lastfinished = entry["number"]
+
+pipeline.finish = finish_capture
 
 #  ---------------- end of method/funciton defs  -------------------
 
 #  --------------  Last inits  --------------------
-reset_cam()
 starttime = time.time()
-print "Startime @ ",starttime
 checkpoint = time.time()
-
-enable_camera_A()          # initialize the camera to something so mux is not floating
-                           # maybe remove enabling camera if not using mxu???
-
-GPIO.add_event_detect(SWITCHGPIO, GPIO.FALLING, callback = switchCallback)
+last_command = time.time()             # last valid command byte, see fall_back_rate()
 # -------  last of inits and start program loop --------
 
 
 #  ------------  starting program loop  ------------------
-while(True):
-    print "RT:",int(time.time() - starttime),"Watching Serial"
-    command = ser.read()
-    if (command == '1'):
-        ser.write('A')
-        try:
-            print "Send Image Command Received"
-            #sync()
-            print "Sending:", recentimg
-            ser.write(recentimg)
-            send_image(folder+recentimg, wordlength)
-        except:
-            print "Send Recent Image Error"
-    if (command == '2'):
-        ser.write('A')
-        try:
-            print "data list request recieved"
-            #sync()
-            file = open(folder+"imagedata.txt","r")
-            print "Sending imagedata.txt"
-            for line in file:
-                ser.write(line)
-                #print line
-            file.close()
-            time.sleep(1)
-        except:
-            print "Error with imagedata.txt read or send"
-    if (command == '3'):
-        ser.write('A')
-        try:
-            print"specific photo request recieved"
-            sync()
-            imagetosend = ser.read(15)
-            send_image(folder+imagetosend,wordlength)
-        except:
-            print "Send Specific Image Error"
-    if (command == '4'):
-        ser.write('A')
-        try:
-            print "Attempting to send camera settings"
-            #sync()
-            file = open(folder+"camerasettings.txt","r")
-            temp = file.read()
-            while(temp != ""):
-                ser.write(temp)
-                temp = file.read()
-            ser.write("\r")
-            file.close()
-            print "Camera Settings Sent"
-        except:
-            print "cannot open file/file does not exist"
-            reset_cam()
-    if (command == '5'):
-        ser.write('A')
-        try:
-            print "Attempting to update camera settings"
-            file = open(folder+"camerasettings.txt","w")
-            temp = ser.read()
-            while(temp != ""):
-                file.write(temp)
-                temp = ser.read()
-            file.close()
-            print "New Camera Settings Received"
+if __name__ == "__main__":
+    startup()
+    shutdown_steps()
+    print "Startime @ ",starttime
+    while not shutdown.requested():
+        timer.start()
+        print "RT:",int(time.time() - starttime),"Watching Serial"
+        UpdateDisplay()
+        command = ser.read()
+        timer.lap("serial")
+        if shutdown.requested():
+            break
+        if (command != ''):
+            services.acked()
+            pusher.activity()
+        if command in COMMANDS:
+            last_command = time.time()
+        elif time.time() - last_command > profile["rate_fallback"]:
+            fall_back_rate("no valid command for %ds" % profile["rate_fallback"])
+            last_command = time.time()
+        if (command == '1'):
+            ser.write('A')
+            try:
+                print "Send Image Command Received"
+                #sync()
+                print "Sending:", recentimg
+                ser.write(recentimg)
+                send_image(folder+recentimg, wordlength)
+            except:
+                print "Send Recent Image Error"
+        if (command == 'B'):
             ser.write('A')
-            checkpoint = time.time()
-        except:
-            print "Error Retrieving Camera Settings"
-            reset_cam()
-    if (command == '6'):
+            try:
+                print "Send Best Image Command Received"
+                import rfd_quality              # NumPy; the scoring itself is done by the pipeline
+                best = rfd_quality.best_since(catalog.of_kind('b'), bestsent)
+                bestsent = max(bestsent, lastfinished)     # captures still in the pipeline wait for next time
+                if best is None:
+                    sendimg = recentimg             # nothing scored since last time
+                else:
+                    sendimg = best["name"]
+                    print "Best image score", best["score"]
+                print "Sending:", sendimg
+                ser.write(sendimg)
+                send_image(folder+sendimg, wordlength)
+            except:
+                print "Send Best Image Error"
+        if (command == 'Q'):
             ser.write('A')
-            print "Ping Request Received"
             try:
-                termtime = time.time() + 10
-                pingread = ser.read()
-                while ((pingread != 'D') & (pingread != "")&(termtime > time.time())):
-                    if (pingread == 'P'):
-                        print "Ping Received"
-                        ser.flushInput()
-                        ser.write('P')
-                    else:
-                        print "pingread = ",pingread
-                        ser.flushInput()
-                        ser.write('A')
-                    pingread = ser.read()
-                    sys.stdin.flush()
+                print "Budget Image Command Received"
+                sendimg = budget_image(read_request())
+                print "Sending:", sendimg
+                ser.write(sendimg)
+                send_image(folder+sendimg, wordlength)
             except:
-                print "Ping Runtime Error"
-    if (command == '7'):
-        ser.write('A')
-        try:
-            print "Attempting to send piruntimedata"
-            #sync()
-            file = open(folder+"piruntimedata.txt","r")
-            temp = file.readline()
-            while(temp != ""):
-                ser.write(temp)
+                print "Send Budget Image Error"
+        if (command == 'E'):
+            ser.write('A')
+            try:
+                print "Delta Image Command Received"
+                sendimg, isdelta = delta_image(read_request())
+                print "Sending:", sendimg
+                ser.write(sendimg)
+                sendok = send_image(folder+sendimg, wordlength)
+                if isdelta:
+                    delta.delta_sent(sendok)
+            except:
+                print "Send Delta Image Error"
+                if delta is not None:
+                    delta.delta_sent(False)
+        if (command == 'I'):
+            ser.write('A')
+            try:
+                print "Image ID Request Received"
+                entry = lookup_image(read_request())
+                if entry is None:
+                    ser.write("NO\n")
+                else:
+                    storage.wait(entry["path"])
+                    print "Sending:", entry["name"]
+                    ser.write("OK %s %d %08x\n" % (entry["name"], entry["size"], entry["crc32"]))
+                    send_image(entry["path"], wordlength)
+            except:
+                print "Send Image By ID Error"
+        if (command == 'R'):
+            ser.write('A')
+            try:
+                print "Batch Image Command Received"
+                send_batch(read_request())
+            except:
+                print "Send Batch Error"
+        if (command == '2'):
+            ser.write('A')
+            try:
+                print "data list request recieved"
+                #sync()
+                file = open(folder+"imagedata.txt","r")
+                print "Sending imagedata.txt"
+                for line in file:
+                    ser.write(line)
+                    #print line
+                file.close()
+                time.sleep(1)
+            except:
+                print "Error with imagedata.txt read or send"
+        if (command == '3'):
+            ser.write('A')
+            try:
+                print"specific photo request recieved"
+                resync(0)
+                imagetosend = ser.read(15)
+                send_image(folder+imagetosend,wordlength)
+            except:
+                print "Send Specific Image Error"
+        if (command == '4'):
+            ser.write('A')
+            try:
+                print "Attempting to send camera settings"
+                #sync()
+                file = open(folder+"camerasettings.txt","r")
+                temp = file.read()
+                while(temp != ""):
+                    ser.write(temp)
+                    temp = file.read()
+                ser.write("\r")
+                file.close()
+                print "Camera Settings Sent"
+            except:
+                print "cannot open file/file does not exist"
+                reset_cam()
+        if (command == '5'):
+            ser.write('A')
+            try:
+                print "Attempting to update camera settings"
+                file = open(folder+"camerasettings.txt","w")
+                temp = ser.read()
+                while(temp != ""):
+                    file.write(temp)
+                    temp = ser.read()
+                file.close()
+                print "New Camera Settings Received"
+                ser.write('A')
+                checkpoint = time.time()
+            except:
+                print "Error Retrieving Camera Settings"
+                reset_cam()
+        if (command == '6'):
+            handle_ping()
+        if (command == '7'):
+            ser.write('A')
+            try:
+                print "Attempting to send piruntimedata"
+                #sync()
+                file = open(folder+"piruntimedata.txt","r")
                 temp = file.readline()
-            #ser.write("\r")
-            file.close()
-            print "piruntimedata.txt sent"
-        except:
-            print "error sending piruntimedata.txt"
+                while(temp != ""):
+                    ser.write(temp)
+                    temp = file.readline()
+                #ser.write("\r")
+                file.close()
+                print "piruntimedata.txt sent"
+            except:
+                print "error sending piruntimedata.txt"
 
-# ------  camera/mux commands  --------
+    # ------  camera/mux commands  --------
 
-    if (command == '8'):             # enable camera a
-        ser.write('A')
-        try:
-            print 'command received to enable camera A, attempting to enable camera A'
-            enable_camera_A()
-            #time.sleep(2)
-            print 'returned from enabling camera A'
+        if (command == '8'):             # enable camera a
+            ser.write('A')
+            try:
+                print 'command received to enable camera A, attempting to enable camera A'
+                enable_camera_A()
+                #time.sleep(2)
+                print 'returned from enabling camera A'
 
-        except:
-            print 'Not done, need to implement catch condition for enable camera A'
+            except:
+                print 'Not done, need to implement catch condition for enable camera A'
 
-    if (command == '9'):             # enable camera b
-        ser.write('A')
-        try:
-            print 'command received to enable camera B, attempting to enable camera B'
-            enable_camera_B()
-            #time.sleep(2)
-            print 'returned from enabling camera B'
+        if (command == '9'):             # enable camera b
+            ser.write('A')
+            try:
+                print 'command received to enable camera B, attempting to enable camera B'
+                enable_camera_B()
+                #time.sleep(2)
+                print 'returned from enabling camera B'
 
-        except:
-            print 'Not done, need to implement catch condition for enable camera B'
+            except:
+                print 'Not done, need to implement catch condition for enable camera B'
 
-    if (command == 'c'):             # enable camera c
-        ser.write('A')
-        try:
-            print 'command received to enable camera C, attempting to enable camera C'
-            enable_camera_C()
-            #time.sleep(2)
-            print 'returned from enabling camera C'
+        if (command == 'c'):             # enable camera c
+            ser.write('A')
+            try:
+                print 'command received to enable camera C, attempting to enable camera C'
+                enable_camera_C()
+                #time.sleep(2)
+                print 'returned from enabling camera C'
 
-        except:
-            print 'Not done, need to implement catch condition for enable camera C'
+            except:
+                print 'Not done, need to implement catch condition for enable camera C'
             
-    if (command == 'd'):             # enable camera d
-        ser.write('A')
-        try:
-            print 'command received to enable camera D, attempting to enable camera D'
-            enable_camera_D()
-            #time.sleep(2)
-            print 'returned from enabling camera D'
+        if (command == 'd'):             # enable camera d
+            ser.write('A')
+            try:
+                print 'command received to enable camera D, attempting to enable camera D'
+                enable_camera_D()
+                #time.sleep(2)
+                print 'returned from enabling camera D'
 
-        except:
-            print 'Not done, need to implement catch condition for enable camera D'
-# -----  end of camera commands  -----------------
+            except:
+                print 'Not done, need to implement catch condition for enable camera D'
+    # -----  end of camera commands  -----------------
 
-    if (command == 'T'):
-        ser.write('A')
-        try:
-            print "Time Sync Request Recieved"
-            
-            timeval=str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"))+"\n"
-            for x in timeval:
-                ser.write(x)
-        except:
-            print "error with time sync"
+        if (command == 'M'):
+            ser.write('A')
+            try:
+                print "Link metrics request received"
+                ser.write(services.timings())
+                ser.write(storage.summary())
+                ser.write(scheduler.summary())
+                ser.write(pipeline.summary())
+                ser.write(linksync.summary())
+                ser.write(pusher.summary())
+                ser.write(clips.summary())
+                ser.write(ring.summary())
+                ser.write(timer.summary())
+                send_metrics(ser, metrics)
+                print metrics.summary(),
+            except:
+                print "error sending link metrics"
+
+        if (command == 'T'):
+            handle_time()
+
+        if (command == 'K'):             # chunk integrity algorithm, e.g. "crc32"
+            ser.write('A')
+            try:
+                name = read_request()
+                if rfd_integrity.get(name) is None:
+                    print "Integrity", name, "not available, have", rfd_integrity.available()
+                    ser.write("NO\n")
+                else:
+                    integrity = rfd_integrity.get(name)
+                    print "Chunk integrity now", name
+                    ser.write("OK\n")
+            except:
+                print "error setting chunk integrity"
+
+        if (command == 'L'):             # link resync mode, "marker" or "legacy"
+            ser.write('A')
+            try:
+                mode = read_request()
+                if mode in ("marker", "legacy"):
+                    link_sync = mode
+                    print "Link sync now", mode
+                    ser.write("OK\n")
+                else:
+                    ser.write("NO\n")
+            except:
+                print "error setting link sync"
+
+        if (command == 'U'):             # background push on ("1") / off ("0")
+            ser.write('A')
+            try:
+                pusher.enabled = (read_request() == '1')
+                print "Background push", "on" if pusher.enabled else "off"
+            except:
+                print "error setting background push"
+
+        if (command == 'W'):             # negotiate a faster serial rate, see rfd_baud.py
+            ser.write('A')
+            try:
+                rates = rfd_baud.parse_rates(read_request())
+                set_rate(rfd_baud.negotiate(ser, rates))
+            except Exception, e:
+                print "error negotiating serial rate", e
+                set_rate(profile["baud"])
+            last_command = time.time()
+
+        if (command == 'V'):             # clip buffer: "1" record, "0" stop, "s[,seconds]" save
+            ser.write('A')
+            try:
+                request = read_request().split(",")
+                if request[0] == '1':
+                    ser.write("OK\n" if start_clips() else "NO\n")
+                elif request[0] == '0':
+                    stop_clips()
+                    ser.write("OK\n")
+                elif request[0] == 's':
+                    seconds = float(request[1]) if len(request) > 1 else None
+                    ids = save_clip(seconds)
+                    if ids:
+                        ser.write("OK %d %d\n" % (ids[0], len(ids)))     # first segment id, segment count
+                    else:
+                        ser.write("NO\n")
+                else:
+                    ser.write("NO\n")
+            except Exception, e:
+                print "Clip command error", e
+                ser.write("NO\n")
     
 
-#Creates a loop to check when a picture needs to be taken
-    if (checkpoint < time.time()):
-        camera = picamera.PiCamera()
-        try:
-            file = open(folder+"camerasettings.txt","r")
-            width = int(file.readline())
-            height = int(file.readline())
-            sharpness = int(file.readline())
-            brightness = int(file.readline())
-            contrast = int(file.readline())
-            saturation = int(file.readline())
-            iso = int(file.readline())
-            file.close()
-            print "Camera Settings Read"
-        except:
-            print "cannot open file/file does not exist"
-            reset_cam()
-        camera.sharpness = sharpness
-        camera.brightness = brightness
-        camera.contrast = contrast
-        camera.saturation = saturation
-        camera.iso = iso
-        #camera.annotate_text = "Image:" + str(imagenumber)
-        camera.resolution = (2592,1944)
-        extension = '.png'
-        camera.hflip = cam_hflip
-        camera.vflip = cam_vflip
-        camera.annotate_background = picamera.Color('black')
-        camera.annotate_text = camera_annotation
-        #camera.start_preview()
-        camera.capture(folder+"%s%04d%s" %("image",imagenumber,"_a"+extension))
-        print "( 2592 , 1944 ) photo saved"
-        #UpdateDisplay()
-        fh = open(folder+"imagedata.txt","a")
-        fh.write("%s%04d%s @ time(%s) settings(w=%d,h=%d,sh=%d,b=%d,c=%d,sa=%d,i=%d)\n" % ("image",imagenumber,"_a"+extension,str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")),2592,1944,sharpness,brightness,contrast,saturation,iso))
-        camera.resolution = (width,height)
-        extension = '.jpg'
-        camera.hflip = cam_hflip
-        camera.vflip = cam_vflip
-        camera.annotate_text = camera_annotation
-        camera.capture(folder+"%s%04d%s" %("image",imagenumber,"_b"+extension))
-        print "(",width,",",height,") photo saved"
-        fh.write("%s%04d%s @ time(%s) settings(w=%d,h=%d,sh=%d,b=%d,c=%d,sa=%d,i=%d)\n" % ("image",imagenumber,"_b"+extension,str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")),width,height,sharpness,brightness,contrast,saturation,iso))
-        print "settings file updated"
-        #camera.stop_preview()
-        camera.close()
-        #print "camera closed"
-        recentimg = "%s%04d%s" %("image",imagenumber,"_b"+extension)
-        #print "resent image variable updated"
-        fh.close()
-        #print "settings file closed"
-        print "Most Recent Image Saved as", recentimg
-        imagenumber += 1
-        checkpoint = time.time() + pic_interval
-    ser.flushInput()
-    ser.flushOutput()
+    #Creates a loop to check when a picture needs to be taken
+        if (command != ''):
+            UpdateDisplay()
+
+        if (command == 'F'):             # frame ring: "1" run, "0" stop, "f" freeze and save
+            ser.write('A')
+            try:
+                request = read_request()
+                if request == '1':
+                    ser.write("OK\n" if start_ring() else "NO\n")
+                elif request == '0':
+                    ring.stop()
+                    ser.write("OK\n")
+                elif request == 'f' and ring.running:
+                    ring.freeze()
+                    ids = save_frozen()
+                    if ids:
+                        ser.write("OK %d %d\n" % (ids[0], len(ids)))     # first frame id, frame count
+                    else:
+                        ser.write("NO\n")
+                else:
+                    ser.write("NO\n")
+            except Exception, e:
+                print "Frame ring command error", e
+                ser.write("NO\n")
+
+        if (command == 'X'):             # profile the main loop: "c[,seconds]" cProfile, "s[,seconds]" sampling, "0" stop and save
+            ser.write('A')
+            try:
+                request = read_request().split(",")
+                if request[0] in ('c', 's'):
+                    seconds = float(request[1]) if len(request) > 1 else 60.0
+                    started = profiler.start("cprofile" if request[0] == 'c' else "sample", seconds)
+                    ser.write("OK\n" if started else "NO\n")
+                elif request[0] == '0' and profiler.running():
+                    ids = save_profile()
+                    ser.write("OK %d %d\n" % (ids[0], len(ids)))     # first report id, report count
+                else:
+                    ser.write("NO\n")
+            except Exception, e:
+                print "Profile command error", e
+                ser.write("NO\n")
+
+        if (command != ''):
+            timer.lap("cmd_" + command)
+        clips.poll()
+        if clips.triggered:
+            save_clip()
+        if ring.frozen is not None:
+            save_frozen()
+        if profiler.expired():
+            save_profile()
+        timer.lap("buffers")
+
+        if (checkpoint < time.time()) and services.require("gpio") and services.require("camera"):
+            UpdateDisplay()
+            camera = open_still_camera()
+            try:
+                file = open(folder+"camerasettings.txt","r")
+                width = int(file.readline())
+                height = int(file.readline())
+                sharpness = int(file.readline())
+                brightness = int(file.readline())
+                contrast = int(file.readline())
+                saturation = int(file.readline())
+                iso = int(file.readline())
+                file.close()
+                print "Camera Settings Read"
+            except:
+                print "cannot open file/file does not exist"
+                reset_cam()
+            borrowed = still_borrowed(camera)
+            if not borrowed:            # a borrowed camera keeps the recording's settings
+                camera.sharpness = sharpness
+                camera.brightness = brightness
+                camera.contrast = contrast
+                camera.saturation = saturation
+                camera.iso = iso
+                #camera.annotate_text = "Image:" + str(imagenumber)
+                camera.hflip = cam_hflip
+                camera.vflip = cam_vflip
+                camera.annotate_background = picamera.Color('black')
+                camera.annotate_text = camera_annotation
+            extension = '.png'
+            #camera.start_preview()
+            smile()
+            timer.lap("camera_open")
+            # images are captured to memory and written by the storage manager's
+            # writer thread, together with their imagedata.txt lines.  The full-res
+            # image is held until the thumbnail's hash says whether it is a near-duplicate.
+            fullres = None
+            if borrowed:
+                print "Camera recording, full-res photo skipped"      # its video frames are no full-res still
+            elif storage.make_room():
+                fullname = "%s%04d%s" %("image",imagenumber,"_a"+extension)
+                fullres = io.BytesIO()
+                capture_still(camera, fullres, 'png', (2592,1944))
+                fullline = "%s @ time(%s) settings(w=%d,h=%d,sh=%d,b=%d,c=%d,sa=%d,i=%d)" % (fullname,str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")),2592,1944,sharpness,brightness,contrast,saturation,iso)
+            else:
+                print "Low storage, full-res photo skipped"
+            timer.lap("capture_a")
+            #UpdateDisplay()
+            extension = '.jpg'
+            if not borrowed:
+                camera.hflip = cam_hflip
+                camera.vflip = cam_vflip
+                camera.annotate_text = camera_annotation
+            name = "%s%04d%s" %("image",imagenumber,"_b"+extension)
+            stream = io.BytesIO()
+            size = still_size(camera, (width,height))
+            capture_still(camera, stream, 'jpeg', size)
+            timer.lap("capture_b")
+            entry = catalog.add(name, folder+name, imagenumber, 'b', resolution = size)
+            line = "%s @ time(%s) settings(w=%d,h=%d,sh=%d,b=%d,c=%d,sa=%d,i=%d) id(%d)" % (name,str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")),size[0],size[1],sharpness,brightness,contrast,saturation,iso,entry["id"])
+            # scoring, hashing and the transmit cache run in the pipeline workers;
+            # finish_capture() stores both images once they are done
+            storage.reserve(entry["path"])
+            full = None
+            if fullres is not None:
+                storage.reserve(folder+fullname)
+                full = (fullname, fullres.getvalue(), fullline)
+            thumb = stream.getvalue()
+            pipeline.submit({"entry": entry, "data": thumb, "line": line, "full": full}, thumb, integrity.name, wordlength)
+            print "(",size[0],",",size[1],") photo queued"
+            UpdateDisplay()
+            print "settings file updated"
+            #camera.stop_preview()
+            close_still_camera(camera)
+            #print "camera closed"
+            recentimg = name
+            #print "resent image variable updated"
+            print "Most Recent Image Saved as", recentimg
+            imagenumber += 1
+            checkpoint = time.time() + pic_interval
+            timer.lap("queue")
+        # idle link: push new thumbnails until the ground sends something or a capture is due
+        if (command == ''):
+            pushed = pusher.pump(scheduler, lambda: ser.inWaiting() > 0 or checkpoint < time.time() or shutdown.requested())
+            timer.lap("push")
+            if pushed and ser.inWaiting() > 0:
+                continue                # a ground command cut the push short, read it next
+        # no flushOutput: it discards what hasn't gone out yet, which is
+        # always a reply or frames the ground is waiting for
+        ser.flushInput()
+
+    timer.end()
+    shutdown.run()
+    sys.exit(0)
 
 
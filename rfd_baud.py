@@ -0,0 +1,162 @@
+import time
+
+#  ------------------------  Serial rate negotiation  -------------------------------
+# The link used to be fixed at 38400 baud.  Command 'W' lets the ground
+# station move both ends to a faster serial rate that actually works on this
+# pair of radios/cables:
+#
+#   ground -> "230400,115200,57600\n"      rates it can do, any order
+#   for each rate, fastest first:
+#     payload -> "TRY <rate>\n"            both switch once it has gone out
+#     payload -> TEST_PATTERN              at the new rate
+#     ground  -> TEST_PATTERN              echoed if it arrived intact
+#     payload -> "OK\n"                    echo intact: rate is good
+#     ground  -> 'K'                       ground is ready to stay
+#     payload -> 'K'                       payload stays: switch committed
+#   anything missing or garbled before the payload's 'K': both go back to the
+#   old rate for the next try
+#   payload -> "END <rate>\n"              at the old rate if no faster one worked
+#
+# The last 'K' can still be lost, leaving the payload at the new rate and the
+# ground (which then gives up, follow() returns None) back at its base rate.
+# So both ends fall back to their base rate when the link goes quiet: the
+# payload when no valid command arrives for profile "rate_fallback" seconds
+# or a resync fails, the ground when its commands go unacked
+# (rfd_ground.GroundStation.command()) or, while it only listens to pushes,
+# when the payload's rate_fallback is up or only garbage arrives
+# (listen_fallback()).  Whatever was lost, they meet again at the base rate.
+# ----------------------------------------------------------------------------------
+
+RATES = [9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600]
+# every byte value, twice, in two orders, so stuck bits and framing errors show
+TEST_PATTERN = "".join([chr(i) for i in range(256)]) + "".join([chr(255 - i) for i in range(256)])
+GUARD = 0.05                    # settle time after a rate switch
+CONFIRM_TIMEOUT = 1.0
+RETRY_GAP = 1.0                 # after a failed try, so the ground has given up on it too
+
+
+def pattern_time(rate):
+    return len(TEST_PATTERN) * 10.0 / rate
+
+
+# Parses the ground's rate list, fastest first, only rates in RATES
+def parse_rates(request):
+    rates = []
+    for part in request.split(","):
+        try:
+            rate = int(part)
+        except ValueError:
+            continue
+        if rate in RATES and rate not in rates:
+            rates.append(rate)
+    return sorted(rates, reverse = True)
+
+
+# Waits until everything written has left the UART
+def drain(ser, limit = 5.0):
+    deadline = time.time() + limit
+    try:
+        while ser.outWaiting() > 0 and time.time() < deadline:
+            time.sleep(0.005)
+    except (AttributeError, IOError):
+        pass
+    time.sleep(GUARD)
+
+
+def read_exact(ser, size, timeout):
+    saved = ser.timeout
+    out = []
+    got = 0
+    deadline = time.time() + timeout
+    try:
+        while got < size and time.time() < deadline:
+            ser.timeout = max(0.01, deadline - time.time())
+            piece = ser.read(size - got)
+            out.append(piece)
+            got += len(piece)
+    finally:
+        ser.timeout = saved
+    return "".join(out)
+
+
+def read_line(ser, timeout, limit = 32):
+    saved = ser.timeout
+    line = ""
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline and len(line) < limit:
+            ser.timeout = max(0.01, deadline - time.time())
+            byte = ser.read()
+            if byte == "\n":
+                return line
+            line += byte
+    finally:
+        ser.timeout = saved
+    return None
+
+
+# Payload side, after 'A' and the rate list have been read.  Returns the rate
+# the link is now at (the current one if nothing faster worked).
+def negotiate(ser, rates):
+    current = ser.baudrate
+    for rate in rates:
+        if rate <= current:
+            break
+        ser.write("TRY %d\n" % rate)
+        drain(ser)
+        ser.baudrate = rate
+        ser.flushInput()
+        time.sleep(GUARD)
+        ser.write(TEST_PATTERN)
+        echo = read_exact(ser, len(TEST_PATTERN), 2 * pattern_time(rate) + 1.0)
+        if echo == TEST_PATTERN:
+            ser.write("OK\n")
+            saved = ser.timeout
+            ser.timeout = CONFIRM_TIMEOUT
+            confirm = ser.read()
+            ser.timeout = saved
+            if confirm == 'K':
+                ser.write('K')
+                print "Serial rate now", rate
+                return rate
+        print "Serial rate", rate, "failed"
+        drain(ser)
+        ser.baudrate = current
+        time.sleep(RETRY_GAP)
+        ser.flushInput()
+    ser.write("END %d\n" % current)
+    return current
+
+
+# Ground station side: sends the rate list and follows the payload through
+# the tries.  Returns the rate both ends settled on, or None if the exchange
+# broke down, including a commit 'K' that never came back (the caller should
+# then go back to its base rate).
+def follow(ser, rates, timeout = 5.0):
+    ser.write(",".join([str(r) for r in rates]) + "\n")
+    current = ser.baudrate
+    while True:
+        line = read_line(ser, timeout)
+        if line is None:
+            return None
+        if line.startswith("END"):
+            return current
+        if not line.startswith("TRY"):
+            continue
+        try:
+            rate = int(line.split()[1])
+        except (ValueError, IndexError):
+            continue
+        ser.baudrate = rate
+        pattern = read_exact(ser, len(TEST_PATTERN), 2 * pattern_time(rate) + 1.0)
+        if pattern == TEST_PATTERN:
+            ser.write(TEST_PATTERN)
+            if read_line(ser, 2 * pattern_time(rate) + 1.0) == "OK":
+                ser.write('K')
+                if read_exact(ser, 1, CONFIRM_TIMEOUT + 1.0) == 'K':
+                    return rate
+                return None
+        time.sleep(GUARD)
+        ser.baudrate = current
+        ser.flushInput()
+
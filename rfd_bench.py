@@ -0,0 +1,272 @@
+import os
+import sys
+import time
+import glob
+import json
+import runpy
+import tempfile
+import threading
+import argparse
+
+import rfd_fakehw
+import rfd_ground
+import rfd_delta
+
+#  ------------------------  Replay benchmark  -------------------------------
+# Runs the payload script against fake GPIO/camera/serial (rfd_fakehw.py) and
+# replays a recorded ground station session at it, timing every command end to
+# end.  The ground side is rfd_ground.py's GroundStation, the same code a real
+# ground station runs.  Lets protocol changes be performance tested on a plain
+# Linux box:
+#
+#     python rfd_bench.py bench/basic_session.txt --baud 38400
+#     python rfd_bench.py bench/loss_session.txt --baud 115200 --loss 2e-5
+#     python rfd_bench.py bench/rate_session.txt --baud 38400 --max-baud 115200
+#     python rfd_bench.py bench/batch_session.txt --pty --links 2
+#
+# --max-baud garbles anything sent above that rate or with the two ends at
+# different rates, for command 'W'.  --pty runs the link over a kernel pty
+# pair instead (real termios, no pacing or loss).  --links 2 gives the payload
+# a second radio (profile "port2") that framed image traffic is striped over.
+# --set key=value overrides a profile setting for the run.  --still makes the
+# fake camera shoot a still scene (only a small patch moves), so 'E' sends
+# deltas; every frame the ground rebuilds from one is checked against the
+# payload's _b on the card.
+#
+# Session files have one ground station command per line, '#' for comments:
+#     sleep 2.5             wait before the next command
+#     1                     recent image
+#     B                     best scoring image since the last B
+#     Q 20000[,name]        image re-encoded to fit 20000 bytes (t30 = 30 s)
+#     E [name]              changed tiles against the ground's last full _b
+#     I 3                   image by catalog id (id(N) in imagedata.txt)
+#     R 0-3,7               batch of _b images streamed as frames
+#     K crc32               chunk digest algorithm (rfd_integrity.py)
+#     L marker              link resync mode (rfd_sync.py)
+#     U 1 / U 0             background thumbnail push on/off
+#     W 230400,115200       negotiate the serial rate (rfd_baud.py)
+#     V 1 / V 0 / V s,5     clip buffer record/stop/save last 5 s (rfd_clip.py)
+#     F 1 / F 0 / F f       frame ring run/stop/freeze and save (rfd_ring.py)
+#     X s,30 / X c / X 0    sample / cProfile the main loop for 30 (60) s, stop and save (rfd_timing.py)
+#     I clip2 / I ring5     segment 2 of the last saved clip, frame 5 of the last freeze
+#     I prof0               first report of the last profile
+#     trigger 23            falling edge on GPIO 23 (e.g. --set ring_trigger_gpio=23)
+#     shutdown 8            shutdown switch edge, then wait for the payload to finish
+#                           shutting down (rfd_shutdown.py); os.system is never really called
+#     listen 20             collect pushed frames for 20 s
+# Image commands take "+<cmd>@<chunk>" to send a ping/time sync in place of
+# that chunk's ack, e.g. "3 image0000_a.png +6@5 +T@20" (for 'R', after that
+# many images have arrived).
+#     3 image0000_b.jpg     specific image
+#     5 650,450,0,50,0,0,100   new camera settings
+#     6 5                   ping exchange, 5 pings
+#     2 / 4 / 7 / 8 / 9 / T / M   as in the payload main loop
+# ----------------------------------------------------------------------------
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+SECOND_PORT = "bench2"
+
+
+# The ground station (rfd_ground.py), plus "+<cmd>@<chunk>" control commands
+# cut in between chunks and timed
+class BenchGround(rfd_ground.GroundStation):
+    def __init__(self, ser, outdir, idle = 0.3, card = None):
+        rfd_ground.GroundStation.__init__(self, ser, outdir, idle)
+        self.interleave = {}        # chunk number -> control command sent in place of its ack
+        self.control_latency = []
+        self.card = card            # the payload's pictures directory
+
+    def cut_in(self, number):
+        if number not in self.interleave:
+            return False
+        self.interrupt(self.interleave.pop(number))
+        return True
+
+    # sends a control command in place of a chunk ack and times the exchange;
+    # the payload resends the unacked chunk afterwards
+    def interrupt(self, cmd):
+        start = time.time()
+        if self.command(cmd, 1, False):
+            getattr(self, "do_" + cmd)("1")
+        self.control_latency.append(time.time() - start)
+
+    # A frame rebuilt from a delta must match the payload's _b: no tile further
+    # off than the delta's own change threshold
+    def do_E(self, arg):
+        ok, note = rfd_ground.GroundStation.do_E(self, arg)
+        name = note.split()[0]
+        if not ok or not name.endswith("_d.bin") or self.card is None:
+            return ok, note
+        found = [path for path in glob.glob(os.path.join(self.card, "*", name.replace("_d.bin", "_b.jpg")))
+                 if os.path.dirname(path) != self.outdir]
+        if not found:
+            return False, note + ", no _b on the card to check"
+        fh = open(found[0], "rb")
+        actual = rfd_delta.decode(fh.read())
+        fh.close()
+        worst = rfd_delta.tile_difference(self.frame, actual).max()
+        if worst > rfd_delta.THRESHOLD:
+            return False, note + ", rebuilt frame off by %.1f" % worst
+        return True, note + ", rebuilt frame matches (%.1f)" % worst
+
+
+def load_session(path):
+    steps = []
+    for line in open(path):
+        step = rfd_ground.parse_command(line)
+        if step is not None:
+            steps.append(step)
+    return steps
+
+
+# Runs the payload script in a thread against a fake radio and replays `steps`.
+# Returns a list of per-command result dicts.
+def run(steps, script, baud = None, verbose = False, workdir = None, loss = 0.0, seed = 1,
+        max_baud = None, pty = False, links = 1, settings = None, still = False):
+    def make_radio(seed):
+        if pty:
+            return rfd_fakehw.PtyRadio()
+        return rfd_fakehw.FakeRadio(baud, loss, seed, max_baud)
+    radio = make_radio(seed)
+    radios = [radio]
+    workdir = workdir or tempfile.mkdtemp(prefix = "rfd_bench_")
+    os.environ["RFD_PICS_DIR"] = workdir
+    settings = dict(settings or {})
+    if links > 1:
+        radios.append(make_radio(seed + 1))
+        settings["port2"] = SECOND_PORT
+    if settings:
+        config = os.path.join(workdir, "bench.cfg")
+        fh = open(config, "w")
+        fh.write("[payload]\n" + "".join(["%s = %s\n" % item for item in settings.items()]))
+        fh.close()
+        os.environ["RFD_CONFIG"] = config
+    gpio = rfd_fakehw.install(radio, dict([(SECOND_PORT, r) for r in radios[1:]]))
+    rfd_fakehw.FakePiCamera.still = still
+    # the payload's power off: recorded, never run
+    system_calls = []
+    real_system, real_exit = os.system, os._exit
+    def fake_system(command):
+        system_calls.append((time.time(), command))
+        return 0
+    def fake_exit(code):
+        system_calls.append((time.time(), "exit %d" % code))
+        raise SystemExit(code)
+    os.system, os._exit = fake_system, fake_exit
+    outdir = os.path.join(workdir, "ground")
+    os.mkdir(outdir)
+    if REPO not in sys.path:
+        sys.path.insert(0, REPO)
+
+    real_stdout = sys.stdout
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    def payload():
+        try:
+            runpy.run_path(script, run_name = "__main__")
+        except rfd_fakehw.LinkClosed:
+            pass
+
+    boot = time.time()
+    worker = threading.Thread(target = payload)
+    worker.daemon = True
+    worker.start()
+    while radio.payload is None and worker.is_alive():
+        time.sleep(0.01)
+
+    ground = BenchGround(radio.ground, outdir, card = workdir)
+    if "rate_fallback" in settings:
+        ground.rate_fallback = float(settings["rate_fallback"])
+    for r in radios[1:]:
+        ground.add_link(r.ground)
+    results = []
+    first_ack = None
+    try:
+        for cmd, arg in steps:
+            if cmd == "sleep":
+                time.sleep(float(arg))
+                continue
+            if cmd == "trigger":
+                gpio.trigger(int(arg))
+                continue
+            if cmd == "shutdown":
+                start = time.time()
+                gpio.trigger(int(arg))
+                worker.join(60)
+                seconds = time.time() - start
+                logs = glob.glob(os.path.join(workdir, "*", "shutdown.txt"))
+                steps = [line.split()[:2] for line in open(logs[0]).readlines()[1:]] if logs else []
+                calls = ["%s @%.3fs" % (command, stamp - start) for stamp, command in system_calls]
+                results.append({"cmd": cmd, "arg": arg, "ok": not worker.is_alive() and bool(logs),
+                                "seconds": seconds, "bytes": 0,
+                                "note": "%s; %s" % (", ".join(calls) or "no power off",
+                                                    " ".join(["%s=%s" % tuple(step) for step in steps]))})
+                continue
+            # "+6@3" in the arguments: ping in place of the ack of chunk 3
+            ground.interleave = {}
+            ground.control_latency = []
+            words = arg.split()
+            for word in [w for w in words if w.startswith("+")]:
+                control, chunk = word[1:].split("@")
+                ground.interleave[int(chunk)] = control
+                words.remove(word)
+            result = ground.execute(cmd, " ".join(words))
+            if first_ack is None and ground.acked_at is not None:
+                first_ack = ground.acked_at - boot
+            if ground.control_latency:
+                result["note"] += " control %s" % ",".join(["%.3fs" % t for t in ground.control_latency])
+            results.append(result)
+    finally:
+        for r in radios:
+            r.close()
+        worker.join(10)
+        sys.stdout = real_stdout
+        os.system, os._exit = real_system, real_exit
+    return {"boot_to_first_ack": first_ack, "commands": results, "workdir": workdir,
+            "injected_errors": sum([r.errors() for r in radios])}
+
+
+def report(result, out = sys.stdout):
+    out.write("%-4s %-20s %8s %9s %10s  %s\n" % ("cmd", "arg", "seconds", "bytes", "B/s", "result"))
+    total = 0.0
+    for r in result["commands"]:
+        rfd_ground.print_result(r, out)
+        total += r["seconds"]
+    if result["boot_to_first_ack"] is not None:
+        out.write("boot to first ack: %.3fs\n" % result["boot_to_first_ack"])
+    if result["injected_errors"]:
+        out.write("injected link errors: %d\n" % result["injected_errors"])
+    out.write("total command time: %.3fs  (files in %s)\n" % (total, result["workdir"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Replay a ground station session against the payload on fake hardware")
+    parser.add_argument("session", help = "session file, one command per line")
+    parser.add_argument("--script", default = os.path.join(REPO, "RFD_python_Pi.py"), help = "payload script to run")
+    parser.add_argument("--baud", type = int, default = None, help = "simulate link speed (default: unlimited)")
+    parser.add_argument("--loss", type = float, default = 0.0, help = "per byte error rate to inject on the link")
+    parser.add_argument("--seed", type = int, default = 1, help = "random seed for --loss")
+    parser.add_argument("--max-baud", type = int, default = None, help = "garble traffic above this serial rate (for 'W')")
+    parser.add_argument("--pty", action = "store_true", help = "run the link over a pty pair instead of the fake radio")
+    parser.add_argument("--links", type = int, default = 1, help = "radios for the payload, 2 stripes framed traffic")
+    parser.add_argument("--still", action = "store_true", help = "still scene camera frames, so 'E' sends deltas")
+    parser.add_argument("--set", action = "append", default = [], metavar = "KEY=VALUE",
+                        help = "override a profile setting (see rfd_profiles.py)")
+    parser.add_argument("--profile", default = None, help = "hardware profile for the payload (see rfd_profiles.py)")
+    parser.add_argument("--json", default = None, help = "also write results to this file")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "show payload output")
+    args = parser.parse_args()
+    if args.profile:
+        os.environ["RFD_PROFILE"] = args.profile
+
+    result = run(load_session(args.session), args.script, args.baud, args.verbose, loss = args.loss, seed = args.seed,
+                 max_baud = args.max_baud, pty = args.pty, links = args.links, still = args.still,
+                 settings = dict([item.split("=", 1) for item in args.set]))
+    report(result)
+    if args.json:
+        fh = open(args.json, "w")
+        json.dump(result, fh, indent = 1)
+        fh.close()
+    # the payload thread may still be blocked in a sleep; don't wait for it
+    os._exit(0 if all(r["ok"] for r in result["commands"]) else 1)
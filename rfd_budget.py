@@ -0,0 +1,138 @@
+import io
+
+#  ------------------------  Byte budget re-encoding  -------------------------------
+# The _b thumbnail is always 650x450 at the camera's default JPEG quality, so
+# its size (and downlink time) swings with scene content.  Command 'Q' lets the
+# ground station give a byte or transmit-time budget instead; fit() re-encodes
+# the image to the best quality/resolution that fits:
+#
+#   - resolutions are tried largest first from RESOLUTIONS, by width: the
+#     height follows the source's own aspect ratio (a 650x450 _b is not 4:3)
+#   - at each one the JPEG quality is binary searched in [MIN_QUALITY, MAX_QUALITY]
+#   - the first resolution that fits at >= GOOD_QUALITY wins, otherwise the best
+#     fit found at any resolution
+#
+# Results are cached per (image, budget) so a repeated request costs nothing.
+# Needs PIL; without it fit() returns None and the original image is sent.
+# -----------------------------------------------------------------------------------
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+RESOLUTIONS = [(1296, 972), (972, 729), (650, 450), (488, 366), (325, 244), (244, 183), (162, 122)]
+MIN_QUALITY = 10
+MAX_QUALITY = 95
+GOOD_QUALITY = 40
+CACHE_SIZE = 16
+B64_RATIO = 0.75                # raw bytes per transmitted byte (send_image base64)
+
+
+def available():
+    return Image is not None and hasattr(Image, "open")
+
+
+# (width, height) for `width` with the aspect ratio of `size`
+def scaled(width, size):
+    return (width, max(1, width * size[1] // size[0]))
+
+
+def encode(img, quality):
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality = quality, optimize = True)
+    return out.getvalue()
+
+
+# Highest quality whose encoding of img fits in budget bytes: (quality, data)
+# or (None, None) if even MIN_QUALITY is too big
+def search_quality(img, budget):
+    lo = MIN_QUALITY
+    hi = MAX_QUALITY
+    best = (None, None)
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        data = encode(img, mid)
+        if len(data) <= budget:
+            best = (mid, data)
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return best
+
+
+class BudgetEncoder:
+    def __init__(self):
+        self.cache = {}
+        self.order = []
+        self.hits = 0
+        self.misses = 0
+
+    # Converts a transmit-time budget (s) to a raw byte budget using the
+    # measured goodput (transmitted bytes/s), or the serial rate if there is none
+    def bytes_for_time(self, seconds, goodput, baud):
+        rate = goodput if goodput > 0 else baud / 10.0
+        return int(seconds * rate * B64_RATIO)
+
+    # sources: list of (path, (width, height)) largest first, e.g. the _a and _b
+    # of one capture.  Returns a dict with data/quality/size or None.
+    def fit(self, key, sources, budget):
+        if not available():
+            return None
+        if (key, budget) in self.cache:
+            self.hits += 1
+            return self.cache[(key, budget)]
+        self.misses += 1
+        result = None
+        opened = {}
+        maxwidth = max([s[1][0] for s in sources] or [0])
+        for size in RESOLUTIONS:
+            if size[0] > maxwidth:
+                continue                    # never upscale
+            src = self.pick_source(sources, size)
+            if src is None:
+                continue
+            img = self.load(src, size, opened)
+            if img is None:
+                continue
+            quality, data = search_quality(img, budget)
+            if quality is None:
+                continue
+            if result is None or quality > result["quality"]:
+                result = {"data": data, "quality": quality, "resolution": img.size, "bytes": len(data)}
+            if quality >= GOOD_QUALITY:
+                break
+        self.remember((key, budget), result)
+        return result
+
+    # smallest source that is at least as big as the target, else the biggest one
+    def pick_source(self, sources, size):
+        fitting = [s for s in sources if s[1][0] >= size[0]]
+        if fitting:
+            return fitting[-1]
+        if sources:
+            return sources[0]
+        return None
+
+    def load(self, src, size, opened):
+        path = src[0]
+        try:
+            if path not in opened:
+                img = Image.open(path)
+                img.draft('RGB', scaled(size[0], img.size))     # JPEG: decode at reduced scale
+                opened[path] = img.convert('RGB')
+            img = opened[path]
+        except IOError:
+            return None
+        if img.size[0] <= size[0]:
+            return img
+        return img.resize(scaled(size[0], img.size), Image.BILINEAR)
+
+    def remember(self, key, result):
+        self.cache[key] = result
+        self.order.append(key)
+        while len(self.order) > CACHE_SIZE:
+            self.cache.pop(self.order.pop(0), None)
@@ -0,0 +1,54 @@
+import time
+import threading
+
+#  ------------------------  Image catalog  -------------------------------
+# In-memory record of every file the payload captured this flight, one entry
+# per file (image0003_a.png and image0003_b.jpg are separate entries).  The
+# storage manager adds entries as images are written and marks full-res
+# images it thins out; later stages hang their own fields (scores, hashes...)
+# off the entry dicts.  imagedata.txt stays the on-card/ground-station copy.
+#
+# Each entry also gets a small numeric id (its position in capture order),
+# written to imagedata.txt as id(N), so the ground station can ask for an
+# image with command 'I' and a few digits instead of a 15 byte name.
+# -------------------------------------------------------------------------
+
+
+class ImageCatalog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}           # name -> entry
+        self.order = []             # names in capture order
+        self.ids = []               # id -> entry
+
+    # Adds (or replaces) the entry for `name`, returns it
+    def add(self, name, path, number, kind, **fields):
+        entry = {"name": name, "path": path, "number": number, "kind": kind,
+                 "time": time.time(), "size": 0, "stored": False, "thinned": False}
+        entry.update(fields)
+        with self.lock:
+            if name in self.entries:
+                entry["id"] = self.entries[name]["id"]
+            else:
+                entry["id"] = len(self.ids)
+                self.order.append(name)
+                self.ids.append(entry)
+            self.entries[name] = entry
+            self.ids[entry["id"]] = entry
+        return entry
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def by_id(self, image_id):
+        if 0 <= image_id < len(self.ids):
+            return self.ids[image_id]
+        return None
+
+    # Entries of one kind ('a' full-res, 'b' thumbnail) oldest first
+    def of_kind(self, kind):
+        with self.lock:
+            return [self.entries[name] for name in self.order if self.entries[name]["kind"] == kind]
+
+    def __len__(self):
+        return len(self.order)
@@ -0,0 +1,137 @@
+import io
+import time
+
+#  ------------------------  Video clips  -------------------------------
+# Stills every pic_interval miss fast events (launch, burst).  ClipRecorder
+# keeps the camera recording low rate H.264 into a picamera circular buffer
+# that always holds the last `seconds`; on command 'V' or on the clip trigger
+# GPIO the buffer is saved as a clip.
+#
+# A saved clip is cut into segments at its SPS headers: the encoder repeats
+# SPS/PPS before every IDR frame (inline_headers, one IDR per intra_period),
+# so each segment starts with everything a decoder needs and plays on its
+# own.  Each segment is stored and catalogued as its own file
+#
+#     clip003_s07.264       clip 3, segment 7 (15 characters, like image names)
+#
+# so the ground station fetches just the segments it wants with the image
+# commands ('I' by id, '3' by name).
+#
+# While recording, the recorder owns the camera; stills are taken from its
+# video port (capture_still in RFD_python_Pi.py) instead of opening the camera
+# again.
+# ----------------------------------------------------------------------
+
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+MAX_SEGMENTS = 100              # two digit segment numbers
+
+
+# (offset, nal type) of every NAL unit in an Annex B byte stream; the offset
+# includes the start code, 3 or 4 bytes
+def nal_units(data):
+    units = []
+    pos = data.find("\x00\x00\x01")
+    while pos >= 0 and pos + 3 < len(data):
+        start = pos - 1 if pos > 0 and data[pos - 1] == "\x00" else pos
+        units.append((start, ord(data[pos + 3]) & 0x1f))
+        pos = data.find("\x00\x00\x01", pos + 3)
+    return units
+
+
+# (start, end) of every independently decodable segment: from an SPS (or an
+# IDR without one in front) up to the next.  Anything before the first is
+# dropped, it needs frames that are no longer in the buffer.
+def segments(data):
+    starts = []
+    previous = None
+    for start, kind in nal_units(data):
+        if kind == NAL_SPS or (kind == NAL_IDR and previous not in (NAL_SPS, NAL_PPS)):
+            starts.append(start)
+        previous = kind
+    if len(starts) > MAX_SEGMENTS:
+        step = (len(starts) + MAX_SEGMENTS - 1) // MAX_SEGMENTS
+        starts = starts[::step]
+    return zip(starts, starts[1:] + [len(data)])
+
+
+class ClipRecorder:
+    def __init__(self, seconds = 20, resolution = (640, 480), framerate = 10, bitrate = 400000):
+        self.seconds = seconds
+        self.resolution = resolution
+        self.framerate = framerate
+        self.bitrate = bitrate
+        self.camera = None
+        self.stream = None
+        self.triggered = False
+        self.clips = 0
+        self.segments = 0
+        self.bytes = 0
+        self.save_time = 0.0
+
+    def recording(self):
+        return self.camera is not None
+
+    def start(self, picamera):
+        if self.camera is not None:
+            return
+        camera = picamera.PiCamera()
+        try:
+            camera.resolution = self.resolution
+            camera.framerate = self.framerate
+            self.stream = picamera.PiCameraCircularIO(camera, seconds = self.seconds, bitrate = self.bitrate)
+            camera.start_recording(self.stream, format = 'h264', bitrate = self.bitrate,
+                                   intra_period = self.framerate, inline_headers = True)
+        except:
+            camera.close()
+            self.stream = None
+            raise
+        self.camera = camera
+        print "Clip recording,", self.seconds, "s buffer"
+
+    def stop(self):
+        if self.camera is None:
+            return
+        try:
+            self.camera.stop_recording()
+        finally:
+            self.camera.close()
+            self.camera = None
+            self.stream = None
+        print "Clip recording stopped"
+
+    # Surfaces encoder errors; the recording is dropped if there was one
+    def poll(self):
+        if self.camera is None:
+            return
+        try:
+            self.camera.wait_recording(0)
+        except Exception, e:
+            print "Clip recording error", e
+            self.stop()
+
+    # GPIO edge callback: only flags the save, the main loop does it
+    def trigger(self, channel = None):
+        self.triggered = True
+
+    # Copies out the last `seconds` of the buffer.  Returns (clip number, data,
+    # segment bounds) or None if nothing is recording.
+    def save(self, seconds = None):
+        self.triggered = False
+        if self.camera is None:
+            return None
+        start = time.time()
+        out = io.BytesIO()
+        self.stream.copy_to(out, seconds = min(seconds or self.seconds, self.seconds))
+        data = out.getvalue()
+        bounds = segments(data)
+        self.clips += 1
+        self.segments += len(bounds)
+        self.bytes += len(data)
+        self.save_time += time.time() - start
+        return self.clips, data, bounds
+
+    def summary(self):
+        return ("clips recording=%d saved=%d segments=%d bytes=%d avgsave=%.3fs\n"
+                % (self.recording(), self.clips, self.segments, self.bytes, self.save_time / max(self.clips, 1)))
@@ -0,0 +1,166 @@
+import io
+import math
+import struct
+
+#  ------------------------  Delta transmission  -------------------------------
+# For slowly changing views most of each downlinked _b repeats the previous
+# one.  DeltaEncoder keeps a copy of what the ground station currently has on
+# screen (the last _b it received in full, plus any deltas applied since) and
+# for command 'E' sends only the TILE x TILE tiles that changed against it:
+#
+#     HEADER | count x uint16 tile index | JPEG mosaic of the changed tiles
+#
+# Tiles are laid out in the mosaic on the same 16 px grid as the JPEG MCUs, so
+# each one is coded independently of its neighbours.  apply_delta() is the
+# ground station side and is also what the payload uses to track the ground's
+# copy, so the two never drift apart.  Needs NumPy and PIL.
+#
+# The header names the copy the delta applies to: the full _b it started from
+# and how many deltas have been applied to that since (the step).  A ground
+# station whose copy isn't that one, e.g. because it missed a delta, must not
+# apply it; it asks for the full image instead ("E <name>,full").
+# ------------------------------------------------------------------------------
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+MAGIC = "RFDD"
+VERSION = 3
+# magic, version, base image name, step, width, height, tile size, changed tile count.
+# The name field has room to spare: "image10000_b.jpg" is already 16 bytes.
+HEADER = struct.Struct("<4sB32sIHHBH")
+TILE = 16
+THRESHOLD = 6.0                 # mean absolute difference per tile counted as changed
+MAX_CHANGED = 0.6               # above this fraction of tiles a full image is cheaper
+QUALITY = 75
+
+
+def available():
+    return numpy is not None and Image is not None and hasattr(Image, "open")
+
+
+def decode(data):
+    return numpy.asarray(Image.open(io.BytesIO(data)).convert('RGB'), dtype = numpy.uint8)
+
+
+# Pads an HxWx3 array up to whole tiles by repeating the last row/column
+def pad(a):
+    h, w = a.shape[:2]
+    ph = (-h) % TILE
+    pw = (-w) % TILE
+    if ph or pw:
+        a = numpy.pad(a, ((0, ph), (0, pw), (0, 0)), mode = 'edge')
+    return a
+
+
+# Mean absolute difference of every tile, as a (rows, cols) array
+def tile_difference(new, ref):
+    diff = numpy.abs(pad(new).astype(numpy.int16) - pad(ref).astype(numpy.int16))
+    rows = diff.shape[0] // TILE
+    cols = diff.shape[1] // TILE
+    return diff.reshape(rows, TILE, cols, TILE, 3).mean(axis = (1, 3, 4))
+
+
+def mosaic_shape(count):
+    cols = max(1, int(math.ceil(math.sqrt(count))))
+    rows = max(1, int(math.ceil(count / float(cols))))
+    return rows, cols
+
+
+# Ground station side: applies delta bytes to the base image array and
+# returns the new frame
+def apply_delta(base, data):
+    magic, version, name, step, width, height, tile, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not an RFD delta")
+    pos = HEADER.size
+    indices = struct.unpack_from("<%dH" % count, data, pos)
+    pos += 2 * count
+    frame = pad(base).copy()
+    if count:
+        mosaic = decode(data[pos:])
+        gcols = frame.shape[1] // tile
+        mrows, mcols = mosaic_shape(count)
+        for k, index in enumerate(indices):
+            y = (index // gcols) * tile
+            x = (index % gcols) * tile
+            my = (k // mcols) * tile
+            mx = (k % mcols) * tile
+            frame[y:y + tile, x:x + tile] = mosaic[my:my + tile, mx:mx + tile]
+    return frame[:height, :width]
+
+
+# (base image name, step) of the copy a delta applies to
+def reference(data):
+    magic, version, name, step = HEADER.unpack_from(data, 0)[:4]
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not an RFD delta")
+    return name.rstrip("\0"), step
+
+
+class DeltaEncoder:
+    def __init__(self):
+        self.name = None            # image the ground's copy started from
+        self.step = 0               # deltas applied to it since
+        self.reference = None       # the ground's copy, HxWx3 uint8
+        self.pending = None         # (name, frame) of a delta being sent
+
+    # send_image of a full _b succeeded: that is now the ground's copy
+    def full_sent(self, name, data):
+        if not available():
+            return
+        try:
+            self.reference = decode(data)
+            self.name = name
+            self.step = 0
+        except IOError:
+            self.reference = None
+
+    # Returns delta bytes for the new image, or None if a full send is better
+    def encode(self, data):
+        if not available() or self.reference is None:
+            return None
+        new = decode(data)
+        if new.shape != self.reference.shape:
+            return None
+        changed = tile_difference(new, self.reference) > THRESHOLD
+        count = int(changed.sum())
+        if count > MAX_CHANGED * changed.size:
+            return None
+        indices = numpy.flatnonzero(changed)
+        header = HEADER.pack(MAGIC, VERSION, self.name, self.step, new.shape[1], new.shape[0], TILE, count)
+        body = struct.pack("<%dH" % count, *[int(i) for i in indices])
+        if count:
+            padded = pad(new)
+            gcols = padded.shape[1] // TILE
+            mrows, mcols = mosaic_shape(count)
+            mosaic = numpy.zeros((mrows * TILE, mcols * TILE, 3), dtype = numpy.uint8)
+            for k, index in enumerate(indices):
+                y = (index // gcols) * TILE
+                x = (index % gcols) * TILE
+                my = (k // mcols) * TILE
+                mx = (k % mcols) * TILE
+                mosaic[my:my + TILE, mx:mx + TILE] = padded[y:y + TILE, x:x + TILE]
+            out = io.BytesIO()
+            Image.fromarray(mosaic).save(out, "JPEG", quality = QUALITY)
+            body += out.getvalue()
+        delta = header + body
+        # what the ground will have once this arrives; kept until the send succeeds
+        self.pending = apply_delta(self.reference, delta)
+        return delta
+
+    # send_image of the last encode() result finished
+    def delta_sent(self, ok):
+        if ok and self.pending is not None:
+            self.reference = self.pending
+            self.step += 1
+        self.pending = None
@@ -0,0 +1,646 @@
+import os
+import sys
+import time
+import tty
+import fcntl
+import select
+import termios
+import types
+import random
+import struct
+import zlib
+import threading
+from collections import deque
+
+#  ------------------------  Fake payload hardware  -------------------------------
+# Stand-ins for RPi.GPIO, picamera and serial so RFD_python_Pi.py can be run on a
+# plain Linux box (see rfd_bench.py).  install() puts them in sys.modules before
+# the payload script is imported; everything the script touches at import time
+# has a fake here.
+# ---------------------------------------------------------------------------------
+
+
+class LinkClosed(Exception):
+    pass
+
+
+#  ---------------------  Serial  ----------------------
+# One direction of the radio link.  With a baud rate set, each write is queued
+# behind the previous one and only becomes readable once it would have finished
+# clocking out at 10 bits per byte, so transfer times look like the real link.
+# Like a tty, at most TX_BUFFER bytes can be waiting to go out; a write past
+# that blocks until the buffer has drained.  With an error rate set, each
+# write may lose a byte or have one bit flipped, as on a marginal radio link.
+TX_BUFFER = 4096
+
+class FakeLink:
+    def __init__(self, baud = None, error_rate = 0.0, rng = None):
+        self.baud = baud
+        self.error_rate = error_rate        # per byte
+        self.rng = rng or random.Random()
+        self.errors = 0
+        self.cond = threading.Condition()
+        self.buf = deque()
+        self.free = 0.0
+        self.closed = False
+
+    # At most one error per write, with the probability of any of its bytes failing
+    def damage(self, data):
+        if not self.error_rate or not data:
+            return data
+        if self.rng.random() >= 1.0 - (1.0 - self.error_rate) ** len(data):
+            return data
+        self.errors += 1
+        pos = self.rng.randrange(len(data))
+        if self.rng.random() < 0.5:
+            return data[:pos] + data[pos + 1:]
+        return data[:pos] + chr(ord(data[pos]) ^ (1 << self.rng.randrange(8))) + data[pos + 1:]
+
+    def put(self, data):
+        with self.cond:
+            if self.closed:
+                raise LinkClosed()
+            data = self.damage(data)
+            if self.baud:
+                if self.backlog() + len(data) > TX_BUFFER:
+                    # like the tty driver, wake the writer once half the buffer has drained
+                    low = max(0, min(TX_BUFFER - len(data), TX_BUFFER // 2))
+                    while self.backlog() > low and not self.closed:
+                        self.cond.wait((self.backlog() - low) * 10.0 / self.baud)
+                if self.closed:
+                    raise LinkClosed()
+            now = time.time()
+            if self.baud:
+                self.free = max(self.free, now) + len(data) * 10.0 / self.baud
+                arrive = self.free
+            else:
+                arrive = now
+            self.buf.append([arrive, data])
+            self.cond.notify_all()
+
+    # bytes written but still clocking out
+    def backlog(self):
+        if not self.baud:
+            return 0
+        return max(0, int((self.free - time.time()) * self.baud / 10.0))
+
+    def ready(self):
+        with self.cond:
+            now = time.time()
+            count = 0
+            for arrive, data in self.buf:
+                if arrive > now:
+                    break
+                count += len(data)
+            return count
+
+    def get(self, size, timeout):
+        out = []
+        need = size
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            while need > 0:
+                if self.closed:
+                    raise LinkClosed()
+                now = time.time()
+                if self.buf and self.buf[0][0] <= now:
+                    item = self.buf[0]
+                    piece = item[1][:need]
+                    out.append(piece)
+                    need -= len(piece)
+                    if len(piece) == len(item[1]):
+                        self.buf.popleft()
+                    else:
+                        item[1] = item[1][len(piece):]
+                    continue
+                wait = 0.05
+                if self.buf:
+                    wait = min(wait, self.buf[0][0] - now)
+                if deadline is not None:
+                    if now >= deadline:
+                        break
+                    wait = min(wait, deadline - now)
+                self.cond.wait(max(wait, 0.0001))
+        return "".join(out)
+
+    def clear(self):
+        with self.cond:
+            now = time.time()
+            while self.buf and self.buf[0][0] <= now:
+                self.buf.popleft()
+
+    # Drops what hasn't clocked out yet, as tcflush(TCOFLUSH) does on a tty
+    def drop_unsent(self):
+        with self.cond:
+            now = time.time()
+            kept = deque()
+            for item in self.buf:
+                if item[0] <= now:
+                    kept.append(item)
+                    continue
+                # the write in progress keeps what has gone out of it, later ones go
+                start = item[0] - len(item[1]) * 10.0 / self.baud
+                sent = int((now - start) * self.baud / 10.0)
+                if sent > 0:
+                    kept.append([now, item[1][:sent]])
+                break
+            self.buf = kept
+            self.free = min(self.free, now)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+# pyserial-like endpoint over a pair of FakeLinks
+class FakeSerial:
+    def __init__(self, rx, tx, port = "fake", baudrate = 38400, timeout = None, radio = None):
+        self.rx = rx
+        self.tx = tx
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.radio = radio          # set when the radio checks serial rates
+
+    def read(self, size = 1):
+        return self.rx.get(size, self.timeout)
+
+    def write(self, data):
+        if self.radio is not None:
+            data = self.radio.line(self, data)
+            if self.tx.baud:
+                self.tx.baud = self.baudrate    # clocked out at this end's rate
+        self.tx.put(data)
+        return len(data)
+
+    def inWaiting(self):
+        return self.rx.ready()
+
+    @property
+    def in_waiting(self):
+        return self.rx.ready()
+
+    def outWaiting(self):
+        return self.tx.backlog()
+
+    @property
+    def out_waiting(self):
+        return self.tx.backlog()
+
+    def flushInput(self):
+        self.rx.clear()
+
+    def flushOutput(self):
+        self.tx.drop_unsent()
+
+    def close(self):
+        pass
+
+
+# Both ends of a simulated radio link.  payload is handed out by the fake
+# serial.Serial(), ground is driven by the benchmark.  With max_baud set the
+# two ends' serial rates matter: bytes sent while they differ, or faster than
+# max_baud, arrive as garbage, as with a real UART.
+class FakeRadio:
+    def __init__(self, baud = None, error_rate = 0.0, seed = None, max_baud = None):
+        self.rng = random.Random(seed)
+        self.max_baud = max_baud
+        self.up = FakeLink(baud, error_rate, self.rng)      # ground -> payload
+        self.down = FakeLink(baud, error_rate, self.rng)    # payload -> ground
+        self.payload = None
+        if max_baud:
+            self.ground = FakeSerial(self.down, self.up, "ground", 38400, radio = self)
+        else:
+            self.ground = FakeSerial(self.down, self.up, "ground", baud)
+
+    def open_payload(self, port = "fake", baudrate = 38400, timeout = None):
+        self.payload = FakeSerial(self.up, self.down, port, baudrate, timeout, self if self.max_baud else None)
+        return self.payload
+
+    def line(self, sender, data):
+        receiver = self.payload if sender is self.ground else self.ground
+        if receiver is None or (sender.baudrate == receiver.baudrate and sender.baudrate <= self.max_baud):
+            return data
+        return "".join([chr(self.rng.randrange(256)) for c in data])
+
+    def errors(self):
+        return self.up.errors + self.down.errors
+
+    def close(self):
+        self.up.close()
+        self.down.close()
+
+
+#  ---------------------  pty link  ----------------------
+# A kernel pty pair in place of the FakeLinks, so rate changes go through
+# termios and bytes through real tty buffers and flushes.  A pty moves bytes
+# instantly whatever its speed, so there is no pacing or error injection.
+class PtySerial(object):
+    def __init__(self, fd, port, baudrate = 38400, timeout = None):
+        self.fd = fd
+        self.port = port
+        self.timeout = timeout
+        self.closed = False
+        self._baudrate = None
+        tty.setraw(fd)
+        self.baudrate = baudrate
+
+    def get_baudrate(self):
+        return self._baudrate
+
+    def set_baudrate(self, rate):
+        attrs = termios.tcgetattr(self.fd)
+        speed = getattr(termios, "B%d" % rate, None)
+        if speed is None:
+            raise ValueError("unsupported rate %d" % rate)
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, attrs)
+        self._baudrate = rate
+
+    baudrate = property(get_baudrate, set_baudrate)
+
+    def read(self, size = 1):
+        out = []
+        need = size
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while need > 0:
+            if self.closed:
+                raise LinkClosed()
+            wait = 0.05
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+            try:
+                if select.select([self.fd], [], [], wait)[0]:
+                    piece = os.read(self.fd, need)
+                    out.append(piece)
+                    need -= len(piece)
+            except (OSError, ValueError, select.error):
+                raise LinkClosed()
+        return "".join(out)
+
+    def write(self, data):
+        view = data
+        try:
+            while view:
+                view = view[os.write(self.fd, view):]
+        except OSError:
+            raise LinkClosed()
+        return len(data)
+
+    def ioctl_count(self, request):
+        return struct.unpack("I", fcntl.ioctl(self.fd, request, "\0" * 4))[0]
+
+    def inWaiting(self):
+        return self.ioctl_count(termios.FIONREAD)
+
+    def outWaiting(self):
+        return self.ioctl_count(termios.TIOCOUTQ)
+
+    def flushInput(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def flushOutput(self):
+        termios.tcflush(self.fd, termios.TCOFLUSH)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            os.close(self.fd)
+
+
+# FakeRadio's interface over a pty pair
+class PtyRadio:
+    def __init__(self):
+        master, slave = os.openpty()
+        self.ground = PtySerial(master, "ground")
+        self.slave = slave
+        self.payload = None
+
+    def open_payload(self, port = "pty", baudrate = 38400, timeout = None):
+        self.payload = PtySerial(self.slave, port, baudrate, timeout)
+        return self.payload
+
+    def errors(self):
+        return 0
+
+    def close(self):
+        self.ground.close()
+        if self.payload is not None:
+            self.payload.close()
+
+
+#  ---------------------  GPIO  ----------------------
+class FakeGPIO:
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    PUD_OFF = 20
+    FALLING = 32
+    RISING = 31
+    BOTH = 33
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.mode = None
+        self.pins = {}
+        self.callbacks = {}
+        self.log = []
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down = None, initial = None):
+        self.pins[channel] = 1 if pull_up_down == self.PUD_UP else 0
+
+    def output(self, channel, value):
+        self.pins[channel] = int(bool(value))
+        self.log.append((time.time(), channel, int(bool(value))))
+
+    def input(self, channel):
+        return self.pins.get(channel, 0)
+
+    def add_event_detect(self, channel, edge, callback = None, bouncetime = None):
+        self.callbacks[channel] = callback
+
+    def remove_event_detect(self, channel):
+        self.callbacks.pop(channel, None)
+
+    def cleanup(self, channel = None):
+        pass
+
+    # Fires the edge callback from its own thread like RPi.GPIO does
+    def trigger(self, channel):
+        self.pins[channel] = 0
+        callback = self.callbacks.get(channel)
+        if callback is None:
+            return None
+        worker = threading.Thread(target = callback, args = (channel,))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+
+#  ---------------------  Camera  ----------------------
+def _png(width, height, seed):
+    # greyscale-ish gradient with a moving band, cheap to build and to compress
+    rng = random.Random(seed)
+    base = bytearray((x * 255 // max(width - 1, 1)) for x in range(width))
+    rows = []
+    shaded = {}
+    band = rng.randint(0, height)
+    for y in range(height):
+        if abs(y - band) < height // 20:
+            row = "\0" + "\xff" * width * 3
+        else:
+            shade = (y * 7 + seed) & 0xff
+            if shade not in shaded:
+                shaded[shade] = "\0" + str(bytearray((b ^ shade) for b in base)) * 3
+            row = shaded[shade]
+        rows.append(row)
+    raw = "".join(rows)
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    return ("\x89PNG\r\n\x1a\n" + chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk("IDAT", zlib.compress(raw, 1)) + chunk("IEND", ""))
+
+
+def _jpeg(width, height, seed, bits_per_pixel = 1.6):
+    # not decodable, but sized and framed like a real camera jpeg
+    rng = random.Random(seed)
+    size = int(width * height * bits_per_pixel / 8 * rng.uniform(0.7, 1.3))
+    body = "".join(chr(rng.randint(0, 254)) for _ in range(min(size, 4096)))
+    body = (body * (size // len(body) + 1))[:size]
+    return "\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00" + body + "\xff\xd9"
+
+
+def synthetic_frame(width, height, fmt, seed = 0, still = False):
+    try:
+        from PIL import Image as PILImage
+        import io
+        # horizon-like gradient with sensor noise: consecutive frames look alike
+        # (as in a still scene) but are not byte identical
+        ground = PILImage.linear_gradient("L").resize((width, height))
+        if still:
+            # no noise, only a small patch moves: a few tiles change per frame
+            img = PILImage.merge("RGB", (ground, ground, ground))
+            size = max(height // 10, 1)
+            x = (seed * size) % max(width - size, 1)
+            img.paste((255, 40, 40), (x, height // 2, x + size, height // 2 + size))
+        else:
+            noise = PILImage.effect_noise((width, height), 24)
+            grey = PILImage.blend(ground, noise, 0.25)
+            img = PILImage.merge("RGB", (grey, grey, PILImage.new("L", (width, height), (seed * 37) & 0xff)))
+        out = io.BytesIO()
+        img.save(out, "PNG" if fmt == "png" else "JPEG")
+        return out.getvalue()
+    except ImportError:
+        pass
+    if fmt == "png":
+        return _png(width, height, seed)
+    return _jpeg(width, height, seed)
+
+
+# Raw YUV420 like the Pi's: padded to 32 columns by 16 rows, a gradient that
+# drifts from frame to frame
+def synthetic_yuv(width, height, seed = 0):
+    fwidth, fheight = (width + 31) // 32 * 32, (height + 15) // 16 * 16
+    luma = "".join([chr((x + y + seed * 3) & 0xff) for y in range(fheight) for x in range(fwidth)])
+    return luma + "\x80" * (fwidth * fheight // 2)
+
+
+class Color:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakePiCamera:
+    frames = 0
+    capture_delay = 0.0             # added per capture to mimic sensor/encoder time
+    still = False                   # still scene frames, for deltas (rfd_bench.py --still)
+    open_cameras = 0
+
+    def __init__(self, *args, **kwargs):
+        if FakePiCamera.open_cameras:
+            raise RuntimeError("Camera already open")      # the real one fails the same way
+        FakePiCamera.open_cameras += 1
+        self.closed = False
+        self.resolution = (2592, 1944)
+        self.sharpness = 0
+        self.brightness = 50
+        self.contrast = 0
+        self.saturation = 0
+        self.iso = 0
+        self.hflip = False
+        self.vflip = False
+        self.annotate_text = ""
+        self.annotate_background = None
+        self.framerate = 30
+        self.recorder = None
+
+    def capture(self, output, format = None, **options):
+        if format is None:
+            format = "png" if str(output).endswith(".png") else "jpeg"
+        if FakePiCamera.capture_delay:
+            time.sleep(FakePiCamera.capture_delay)
+        width, height = options.get("resize") or self.resolution
+        if format == "yuv":
+            data = synthetic_yuv(width, height, FakePiCamera.frames)
+        else:
+            data = synthetic_frame(width, height, format, FakePiCamera.frames, FakePiCamera.still)
+        FakePiCamera.frames += 1
+        if hasattr(output, "write"):
+            output.write(data)
+        else:
+            fh = open(output, "wb")
+            fh.write(data)
+            fh.close()
+
+    # Writes one synthetic H.264 frame per 1/framerate to `output` from a thread
+    def start_recording(self, output, format = 'h264', **options):
+        if self.recorder is not None:
+            raise RuntimeError("Already recording")
+        self.recorder = FakeEncoder(output, self.framerate, options.get("bitrate") or 17000000,
+                                    options.get("intra_period") or self.framerate)
+
+    def wait_recording(self, timeout = 0):
+        if self.recorder is None:
+            raise RuntimeError("Not recording")
+        time.sleep(timeout)
+
+    def stop_recording(self):
+        if self.recorder is None:
+            raise RuntimeError("Not recording")
+        self.recorder.stop()
+        self.recorder = None
+
+    def close(self):
+        if self.recorder is not None:
+            self.stop_recording()
+        if not self.closed:
+            self.closed = True
+            FakePiCamera.open_cameras -= 1
+
+
+# Annex B stream the shape of the Pi's: SPS, PPS and an IDR every intra_period
+# frames, P slices between, frame sizes from the bitrate.  No zero bytes in
+# the slice data, so the only start codes are the real ones.
+def h264_frame(index, intra_period, size):
+    body = (_H264_FILL * (size // len(_H264_FILL) + 1))[index % 251:index % 251 + size]
+    if index % intra_period == 0:
+        return ("\x00\x00\x00\x01\x67\x64\x00\x1e\xac" + "\x00\x00\x00\x01\x68\xee\x3c\xb0"
+                + "\x00\x00\x00\x01\x65" + body * 4)
+    return "\x00\x00\x00\x01\x41" + body
+
+_H264_FILL = "".join([chr(1 + (i * 97) % 255) for i in range(4096)])
+
+
+class FakeEncoder:
+    def __init__(self, output, framerate, bitrate, intra_period):
+        self.output = output
+        self.framerate = framerate
+        self.size = max(16, bitrate // 8 // framerate)
+        self.intra_period = intra_period
+        self.running = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        index = 0
+        start = time.time()
+        while self.running:
+            self.output.write(h264_frame(index, self.intra_period, self.size))
+            index += 1
+            time.sleep(max(0, start + float(index) / self.framerate - time.time()))
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1.0)
+
+
+# picamera.PiCameraCircularIO: keeps the last `seconds` of frames, and
+# copy_to() starts from the first SPS header in the requested span
+class FakeCircularIO:
+    def __init__(self, camera, size = None, seconds = None, bitrate = 17000000, splitter_port = 1):
+        self.seconds = seconds or 30
+        self.frames = deque()           # (time, data)
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        now = time.time()
+        with self.lock:
+            self.frames.append((now, data))
+            while self.frames and self.frames[0][0] < now - self.seconds:
+                self.frames.popleft()
+        return len(data)
+
+    def copy_to(self, output, size = None, seconds = None, first_frame = None):
+        with self.lock:
+            frames = list(self.frames)
+        if seconds is not None and frames:
+            frames = [f for f in frames if f[0] >= frames[-1][0] - seconds]
+        while frames and frames[0][1][4:5] != "\x67":
+            frames.pop(0)
+        for stamp, data in frames:
+            output.write(data)
+
+
+#  ---------------------  Install  ----------------------
+def _module(name, **attrs):
+    mod = types.ModuleType(name)
+    for key, value in attrs.items():
+        setattr(mod, key, value)
+    return mod
+
+
+# Installs the fakes into sys.modules.  Returns the FakeGPIO so the caller can
+# fire edge callbacks; the radio supplies the payload side of serial.Serial(),
+# or the radio in `extra` for that port name (a second link).
+def install(radio, extra = None):
+    extra = extra or {}
+    def open_serial(port = "fake", baudrate = 38400, timeout = None):
+        return extra.get(port, radio).open_payload(port, baudrate, timeout)
+
+    gpio = FakeGPIO()
+    gpio_mod = _module("RPi.GPIO")
+    for name in dir(gpio):
+        if not name.startswith("_"):
+            setattr(gpio_mod, name, getattr(gpio, name))
+    sys.modules["RPi"] = _module("RPi", GPIO = gpio_mod)
+    sys.modules["RPi.GPIO"] = gpio_mod
+    sys.modules["picamera"] = _module("picamera", PiCamera = FakePiCamera, Color = Color,
+                                      PiCameraCircularIO = FakeCircularIO)
+    sys.modules["serial"] = _module("serial", Serial = open_serial,
+                                    SerialException = IOError, SerialTimeoutException = IOError)
+    try:
+        import Image
+    except ImportError:
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+            sys.modules["Image"] = Image
+            sys.modules["ImageDraw"] = ImageDraw
+            sys.modules["ImageFont"] = ImageFont
+        except ImportError:
+            sys.modules["Image"] = _module("Image")
+            sys.modules["ImageDraw"] = _module("ImageDraw")
+            sys.modules["ImageFont"] = _module("ImageFont")
+    # no OLED on the bench: construction fails like a missing I2C device
+    def no_display(*args, **kwargs):
+        raise IOError("no I2C display")
+    sys.modules["Adafruit_SSD1306"] = _module("Adafruit_SSD1306", SSD1306_128_64 = no_display)
+    return gpio
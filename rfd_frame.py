@@ -0,0 +1,180 @@
+import os
+import time
+import struct
+import zlib
+import threading
+
+#  ------------------------  Framed transport  -------------------------------
+# Self-delimiting binary frames for streamed image traffic, so it can be told
+# apart from command replies on the same serial link (background push,
+# rfd_push.py, and batch image requests, command 'R'):
+#
+#     MARKER(2) | type(1) | seq(2) | length(2) | payload(length) | crc32(4)
+#
+# The crc covers everything from the marker to the end of the payload; a
+# frame that fails it is dropped whole.  Frames are kept short (MAX_PAYLOAD)
+# so a sender that stops between frames frees the link quickly.
+#
+# Striping: given extra serial links (profile "port2"), the Framer sends each
+# IMAGE_DATA frame on whichever link has the least queued, and everything
+# else on the primary link.  IMAGE_END waits for the extra links to drain so
+# the ground has every piece of an image before the next one starts.
+# ----------------------------------------------------------------------------
+
+MARKER = "\xa5\x5a"
+HEADER = struct.Struct("<2sBHH")
+TRAILER = struct.Struct("<I")
+MAX_PAYLOAD = 512
+
+# frame types
+IMAGE_START = 1         # name(16s) size(I) crc32(I)
+IMAGE_DATA = 2          # offset(I) data
+IMAGE_END = 3           # name(16s)
+CATALOG = 4             # imagedata.txt lines
+BATCH_END = 5           # sent(H) missing(H)
+IMAGE_START_INFO = struct.Struct("<16sII")
+IMAGE_DATA_INFO = struct.Struct("<I")
+BATCH_END_INFO = struct.Struct("<HH")
+
+
+def crc32(data, value = 0):
+    return zlib.crc32(data, value) & 0xffffffff
+
+
+def pack(kind, seq, payload):
+    head = HEADER.pack(MARKER, kind, seq & 0xffff, len(payload))
+    return head + payload + TRAILER.pack(crc32(payload, crc32(head)))
+
+
+class Framer:
+    def __init__(self, ser, extra = ()):
+        self.ser = ser
+        self.links = [ser] + list(extra)
+        self.seq = 0
+        self.frames = 0
+        self.bytes = 0
+        self.link_bytes = [0] * len(self.links)
+
+    def pick(self, kind):
+        if kind != IMAGE_DATA or len(self.links) == 1:
+            return 0
+        queued = [link.outWaiting() for link in self.links]
+        return queued.index(min(queued))
+
+    # Waits until the extra links have nothing queued
+    def barrier(self, limit = 10.0):
+        self.wait_empty(self.links[1:], limit)
+
+    # Waits until every link has sent what is queued, so a transfer is
+    # really out (BATCH_END, IMAGE_END included) when its sender returns
+    def drain(self, limit = 10.0):
+        self.wait_empty(self.links, limit)
+
+    def wait_empty(self, links, limit):
+        deadline = time.time() + limit
+        for link in links:
+            while link.outWaiting() > 0 and time.time() < deadline:
+                time.sleep(0.005)
+
+    def send(self, kind, payload):
+        index = self.pick(kind)
+        link = self.links[index]
+        # don't run ahead of the radio: with the tty buffer full, a sender that
+        # stops between frames would still have seconds of data queued
+        while link.outWaiting() > MAX_PAYLOAD:
+            time.sleep(0.005)
+        frame = pack(kind, self.seq, payload)
+        self.seq = (self.seq + 1) & 0xffff
+        link.write(frame)
+        self.frames += 1
+        self.bytes += len(frame)
+        self.link_bytes[index] += len(frame)
+        return frame
+
+
+# Reads the rest of a frame whose first byte (MARKER[0]) has already been read.
+# Returns (type, seq, payload) or None if it is not a valid frame.
+def read_frame(ser, first = MARKER[0]):
+    head = first + ser.read(HEADER.size - len(first))
+    if len(head) < HEADER.size:
+        return None
+    marker, kind, seq, length = HEADER.unpack(head)
+    if marker != MARKER or length > MAX_PAYLOAD:
+        return None
+    payload = ser.read(length)
+    trailer = ser.read(TRAILER.size)
+    if len(payload) < length or len(trailer) < TRAILER.size:
+        return None
+    if TRAILER.unpack(trailer)[0] != crc32(payload, crc32(head)):
+        return None
+    return kind, seq, payload
+
+
+# Sends one image as IMAGE_START, IMAGE_DATA..., IMAGE_END, yielding after
+# every frame so the caller can stop between them
+def image_steps(framer, name, data):
+    framer.send(IMAGE_START, IMAGE_START_INFO.pack(name, len(data), crc32(data)))
+    yield None
+    step = MAX_PAYLOAD - IMAGE_DATA_INFO.size
+    for offset in range(0, len(data), step):
+        framer.send(IMAGE_DATA, IMAGE_DATA_INFO.pack(offset) + data[offset:offset + step])
+        yield None
+    framer.barrier()
+    framer.send(IMAGE_END, name)
+    yield None
+
+
+# Ground station side: reassembles streamed images from frames and writes
+# them to outdir once complete and their crc matches.  Frames may come from
+# several reader threads (one per striped link), so a data frame can arrive
+# after the IMAGE_END it belongs before; the image is finished by whichever
+# comes last.
+class ImageReceiver:
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.lock = threading.Lock()
+        self.current = None         # [name, size, crc, {offset: data}, ended, received]
+        self.images = []
+        self.catalog = []
+        self.bad = 0
+        self.batch_end = None       # (sent, missing) of the last batch
+
+    def frame(self, kind, seq, payload):
+        with self.lock:
+            if kind == CATALOG:
+                self.catalog.extend(payload.splitlines())
+            elif kind == IMAGE_START:
+                if self.current is not None and self.current[4]:
+                    self.bad += 1       # ended with pieces still missing
+                name, size, crc = IMAGE_START_INFO.unpack(payload)
+                self.current = [name.rstrip("\0"), size, crc, {}, False, 0]
+            elif kind == IMAGE_DATA and self.current is not None:
+                offset = IMAGE_DATA_INFO.unpack_from(payload)[0]
+                if offset not in self.current[3]:
+                    self.current[5] += len(payload) - IMAGE_DATA_INFO.size
+                self.current[3][offset] = payload[IMAGE_DATA_INFO.size:]
+                if self.current[4]:
+                    self.complete()
+            elif kind == IMAGE_END and self.current is not None:
+                self.current[4] = True
+                self.complete()
+            elif kind == BATCH_END:
+                if self.current is not None and self.current[4]:
+                    self.bad += 1
+                    self.current = None
+                self.batch_end = BATCH_END_INFO.unpack(payload)
+
+    # Writes out the current image once it has ended and every byte is in
+    def complete(self):
+        name, size, crc, pieces, ended, received = self.current
+        if received < size:
+            return
+        self.current = None
+        data = "".join([pieces[k] for k in sorted(pieces)])
+        if len(data) != size or crc32(data) != crc:
+            self.bad += 1
+            return
+        fh = open(os.path.join(self.outdir, name), "wb")
+        fh.write(data)
+        fh.close()
+        self.images.append(name)
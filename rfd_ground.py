@@ -0,0 +1,627 @@
+import os
+import sys
+import time
+import base64
+import Queue
+import argparse
+import threading
+
+import rfd_frame
+import rfd_integrity
+import rfd_sync
+import rfd_baud
+import rfd_delta
+
+try:
+    import serial
+except ImportError:
+    serial = None
+try:
+    from PIL import Image, ImageFile
+except ImportError:
+    Image = None
+
+#  ------------------------  Ground station  -------------------------------
+# The ground side of the payload protocol, which until now only existed by
+# convention (and in rfd_bench.py's copy):
+#
+#   command byte            -> 'A' (resent until acked, the payload may be busy)
+#   arguments               -> "...\n" where the command takes them
+#   image (send_image)      per chunk of WORDLENGTH base64 characters: the
+#                           chunk digest (rfd_integrity, hex MD5 by default)
+#                           then the chunk; answered 'Y' if they match, 'N' if
+#                           not, after which the payload resyncs ("sync"/'S',
+#                           or rfd_sync markers) and resends it
+#   frames (rfd_frame)      pushed thumbnails, catalog lines, 'R' batches, on
+#                           any link, between replies
+#
+# Images are reassembled as they arrive: each chunk is acked as soon as its
+# digest checks out and handed to an ImageAssembler thread, which decodes it
+# and writes it at its place in the output file (and, with preview on, keeps
+# a partial render of what has arrived) while the reader is already on the
+# next chunk.  Nothing is held in memory but the chunk in flight.
+#
+#     python rfd_ground.py /dev/ttyUSB0 1 "I 3" "R 0-10"
+#     python rfd_ground.py /dev/ttyUSB0 --preview < commands.txt
+#
+# Commands are the same lines as rfd_bench.py's sessions ("sleep 2.5" waits
+# here too), less its bench-only steps ("trigger", "shutdown") that drive the
+# simulated GPIO; those are refused rather than sent over the radio.
+# rfd_bench.py drives the payload through this class, so it is also the load
+# generator for the payload benchmarks.
+# --------------------------------------------------------------------------
+
+WORDLENGTH = 10000              # base64 characters per chunk, the payload's wordlength
+BASE_BAUD = 38400
+RATE_FALLBACK = 60.0            # the payload's profile "rate_fallback"
+STRAY_LIMIT = 64                # bytes outside valid frames before a listen counts the rate as lost
+PREVIEW_INTERVAL = 1.0          # seconds between partial renders
+LOCAL = ("listen", "sleep")     # session steps that don't send a command byte
+render_lock = threading.Lock()  # ImageFile.LOAD_TRUNCATED_IMAGES is process wide
+
+
+# Decodes verified base64 chunks and writes them into the output file on its
+# own thread.  Chunk n of the base64 is bytes n*WORDLENGTH/4*3 on of the image
+# (WORDLENGTH is a multiple of 4), so chunks can be written as they come.
+class ImageAssembler:
+    def __init__(self, path, wordlength = WORDLENGTH, preview = None):
+        self.path = path
+        self.wordlength = wordlength
+        self.preview = preview          # preview(name, received bytes, partial image or None)
+        self.count = 0                  # next chunk expected
+        self.size = 0
+        self.contiguous = 0             # bytes written without a gap from the start
+        self.error = None
+        self.last_preview = 0.0
+        self.fh = open(path, "wb")
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target = self.run, name = "assembler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def chunk(self, data):
+        self.queue.put((self.count, data))
+        self.count += 1
+
+    # The payload resends from chunk `seq`
+    def rewind(self, seq):
+        self.count = min(self.count, seq)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            index, data = item
+            try:
+                raw = base64.b64decode(data)
+            except TypeError, e:
+                self.error = e
+                continue
+            offset = index * (self.wordlength // 4 * 3)
+            self.fh.seek(offset)
+            self.fh.write(raw)
+            self.size = max(self.size, offset + len(raw))
+            if offset <= self.contiguous:
+                self.contiguous = max(self.contiguous, offset + len(raw))
+            if self.preview is not None and time.time() - self.last_preview > PREVIEW_INTERVAL:
+                self.last_preview = time.time()
+                self.preview(os.path.basename(self.path), self.contiguous, self.render())
+
+    # Whatever of the image the bytes so far decode to
+    def render(self):
+        if Image is None:
+            return None
+        self.fh.flush()
+        with render_lock:
+            ImageFile.LOAD_TRUNCATED_IMAGES = True
+            try:
+                image = Image.open(self.path)
+                image.load()
+                return image
+            except Exception:
+                return None
+            finally:
+                # left on, a truncated _b would decode cleanly as a delta base
+                ImageFile.LOAD_TRUNCATED_IMAGES = False
+
+    # Waits for the writes, returns the image or None if it didn't decode
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fh.truncate(self.size)
+        self.fh.close()
+        if self.error is not None or self.count == 0:
+            return None
+        fh = open(self.path, "rb")
+        data = fh.read()
+        fh.close()
+        return data
+
+    def abandon(self):
+        self.finish()
+        os.remove(self.path)
+
+
+# Ground end of an extra link the payload stripes frames over (profile
+# "port2"): hands every frame on it to the receiver
+class StripeReader:
+    def __init__(self, ser, receiver):
+        self.ser = ser
+        self.receiver = receiver
+        self.received = 0
+        self.thread = threading.Thread(target = self.run, name = "stripe reader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        self.ser.timeout = 0.5
+        try:
+            while True:
+                byte = self.ser.read(1)
+                if byte != rfd_frame.MARKER[0]:
+                    continue
+                frame = rfd_frame.read_frame(self.ser, byte)
+                if frame is not None:
+                    self.received += rfd_frame.HEADER.size + len(frame[2]) + rfd_frame.TRAILER.size
+                    self.receiver.frame(*frame)
+        except Exception:
+            pass                        # link closed
+
+
+class GroundStation:
+    def __init__(self, ser, outdir, idle = 0.3, preview = None, wordlength = WORDLENGTH, base_baud = BASE_BAUD):
+        self.ser = ser
+        self.base_baud = base_baud  # the payload's profile "baud", where a lost negotiated rate ends up
+        self.rate_fallback = RATE_FALLBACK
+        self.fell_back = False
+        self.outdir = outdir
+        self.idle = idle
+        self.preview = preview
+        self.wordlength = wordlength
+        self.received = 0
+        self.acked_at = None
+        self.frame = None           # last full _b, base for delta images
+        self.frame_ref = None       # (name, step) of self.frame, see rfd_delta.reference()
+        self.push = rfd_frame.ImageReceiver(outdir)
+        self.stripes = []
+        self.integrity = rfd_integrity.get("md5")     # chunk digest, changed by 'K'
+        self.link_sync = "legacy"                     # resync mode, changed by 'L'
+        self.resyncs = 0
+        self.saved = {"clip": [], "ring": [], "prof": []}     # ids of the last saved clip segments / ring frames / profile reports
+
+    def add_link(self, ser):
+        self.stripes.append(StripeReader(ser, self.push))
+
+    def striped(self):
+        return sum([stripe.received for stripe in self.stripes])
+
+    # Sends one command with its arguments and handles the reply.  Returns a
+    # result dict: cmd, arg, ok, note, seconds, bytes.
+    def execute(self, cmd, arg = ""):
+        start = time.time()
+        self.received = 0
+        self.resyncs = 0
+        self.fell_back = False
+        striped = self.striped()
+        ok = True
+        if cmd not in LOCAL and len(cmd) != 1:
+            return {"cmd": cmd, "arg": arg, "ok": False, "note": "not a payload command",
+                    "seconds": 0.0, "bytes": 0}
+        if cmd not in LOCAL:
+            ok = self.command(cmd)
+            if ok:
+                self.acked_at = time.time()
+        note = "no ack"
+        if ok:
+            handler = getattr(self, "do_" + cmd, self.no_reply)
+            ok, note = handler(arg)
+        if self.resyncs:
+            note += " resyncs %d" % self.resyncs
+        if self.fell_back:
+            note += " (rate back to %d)" % self.base_baud
+        return {"cmd": cmd, "arg": arg, "ok": ok, "note": note, "seconds": time.time() - start,
+                "bytes": self.received + self.striped() - striped}
+
+    # Gives a caller the chance to send a control command in place of the ack
+    # of chunk (or batch image) `number`; True if it did.  None by default.
+    def cut_in(self, number):
+        return False
+
+    def read(self, size, timeout):
+        self.ser.timeout = timeout
+        data = self.ser.read(size)
+        self.received += len(data)
+        return data
+
+    # read up to size bytes, stopping once the line has been quiet for `idle`
+    def read_block(self, size, idle = None):
+        out = []
+        got = 0
+        while got < size:
+            want = min(size - got, max(1, self.ser.inWaiting()))
+            piece = self.read(want, idle or self.idle)
+            if piece == "":
+                break
+            out.append(piece)
+            got += len(piece)
+        return "".join(out)
+
+    def read_until(self, terminator, timeout = 10):
+        out = []
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            piece = self.read(1, 0.5)
+            if piece == "":
+                continue
+            out.append(piece)
+            if piece == terminator:
+                break
+        return "".join(out)
+
+    # reads one byte; a pushed frame in its place goes to self.push and gives None
+    def next_byte(self, timeout):
+        byte = self.read(1, timeout)
+        if byte != rfd_frame.MARKER[0]:
+            return byte
+        self.ser.timeout = 1.0
+        frame = rfd_frame.read_frame(self.ser, byte)
+        if frame is not None:
+            self.received += rfd_frame.HEADER.size + len(frame[2]) + rfd_frame.TRAILER.size - 1
+            self.push.frame(*frame)
+        return None
+
+    # reads one reply byte, skipping any pushed frames in front of it
+    def read_reply(self, timeout):
+        byte = self.next_byte(timeout)
+        while byte is None:
+            byte = self.next_byte(timeout)
+        return byte
+
+    # sends a command byte and waits for the 'A' ack, resending if the payload
+    # was busy and flushed it.  No ack at a negotiated rate: the payload may
+    # have dropped back to its base rate (rfd_baud.py), so try again there.
+    def command(self, cmd, tries = 10, fallback = True):
+        for attempt in range(tries):
+            self.ser.write(cmd)
+            if self.read_reply(1.0) == 'A':
+                return True
+        if fallback and self.ser.baudrate != self.base_baud:
+            self.ser.baudrate = self.base_baud
+            self.fell_back = True
+            return self.command(cmd, tries, False)
+        return False
+
+    # Listening sends no commands, so at a negotiated rate the payload drops
+    # back to its base rate once its rate_fallback runs out, and pushes from
+    # there.  Follow it when that time is up or nothing but garbage arrives.
+    def listen_fallback(self, stray):
+        if self.ser.baudrate == self.base_baud:
+            return
+        quiet = self.acked_at is not None and time.time() - self.acked_at > self.rate_fallback
+        if quiet or stray > STRAY_LIMIT:
+            self.ser.baudrate = self.base_baud
+            self.fell_back = True
+
+    def answer_sync(self):
+        data = self.read_block(4, 1.0)
+        if data.endswith("sync"):
+            self.ser.write('S')
+            return True
+        return False
+
+    # marker mode: if `seen` holds a resync marker, acks it and rewinds the
+    # image being received to the chunk the payload will resend.  Returns True
+    # if it did.
+    def marker_resync(self, seen, assembler = None):
+        if rfd_sync.SYNC_MARKER not in seen:
+            return False
+        info = rfd_sync.find_marker(seen)
+        if info is None:
+            # marker at the very end: its seq/attempt are still coming
+            tail = seen[seen.rfind(rfd_sync.SYNC_MARKER) + len(rfd_sync.SYNC_MARKER):]
+            info = rfd_sync.find_marker(seen + self.read(rfd_sync.SYNC_INFO.size - len(tail), 0.5))
+        if info is None:
+            return False
+        rfd_sync.ack(self.ser, *info)
+        if assembler is not None:
+            assembler.rewind(info[0])
+        self.resyncs += 1
+        return True
+
+    # marker mode: after a NAK, waits for the payload's resync marker
+    def await_marker(self, assembler = None, timeout = 12.0):
+        seen = ""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            seen = (seen + self.read_block(64, 0.05))[-256:]
+            if self.marker_resync(seen, assembler):
+                return True
+        return False
+
+    # receives one image sent by send_image into outdir, returns its bytes or None
+    def receive_image(self, name):
+        assembler = ImageAssembler(os.path.join(self.outdir, name or "unnamed.jpg"), self.wordlength, self.preview)
+        while True:
+            checksum = self.read(self.integrity.size, 2.0)
+            marker = self.link_sync == "marker"
+            if marker and self.marker_resync(checksum, assembler):
+                continue
+            if len(checksum) < self.integrity.size:
+                break
+            data = self.read_block(self.wordlength)
+            if marker and self.marker_resync(checksum + data, assembler):
+                continue
+            if self.cut_in(assembler.count):
+                continue
+            if self.integrity.digest(data) == checksum:
+                self.ser.write('Y')
+                assembler.chunk(data)
+                if len(data) < self.wordlength:
+                    break
+            else:
+                self.ser.write('N')
+                if marker:
+                    self.await_marker(assembler)
+                else:
+                    self.answer_sync()
+        if assembler.count == 0:
+            assembler.abandon()
+            return None
+        image = assembler.finish()
+        if image is None:
+            return None
+        if name.endswith("_b.jpg") and rfd_delta.available():
+            try:
+                with render_lock:
+                    self.frame = rfd_delta.decode(image)
+                self.frame_ref = (name, 0)
+            except IOError:
+                return None             # incomplete: the payload gave up on it
+        return image
+
+    #  --------------  one method per command  --------------
+    def do_sleep(self, arg):
+        time.sleep(float(arg))
+        return True, ""
+
+    def do_listen(self, arg):
+        before = len(self.push.images)
+        deadline = time.time() + float(arg or 10)
+        stray = 0
+        while time.time() < deadline:
+            received = self.received
+            byte = self.next_byte(min(0.5, max(0.01, deadline - time.time())))
+            if self.received != received:
+                stray = 0               # a valid frame
+            elif byte != '':
+                stray += 1
+            self.listen_fallback(stray)
+        return True, ("%d pushed images, %d catalog lines, %d bad"
+                      % (len(self.push.images) - before, len(self.push.catalog), self.push.bad))
+
+    def do_1(self, arg):
+        name = self.read_block(15, 1.0)
+        return self.receive_image(name) is not None, name
+
+    def do_B(self, arg):
+        return self.do_1(arg)
+
+    def do_Q(self, arg):
+        self.ser.write(arg + "\n")
+        name = self.read_block(15, 3.0)
+        image = self.receive_image(name)
+        if image is None:
+            return False, name
+        return True, "%s %d bytes" % (name, len(image))
+
+    def do_E(self, arg):
+        self.ser.write(arg + "\n")
+        name = self.read_block(15, 3.0)
+        image = self.receive_image(name)
+        if image is None:
+            return False, name
+        if name.endswith("_d.bin"):
+            ref = rfd_delta.reference(image)
+            if self.frame is None or ref != self.frame_ref:
+                # not against our copy: drop it and ask for the full image
+                rejected = "delta for %s step %d rejected, have %s" % (ref + (self.frame_ref,))
+                if arg.endswith(",full") or not self.command('E'):
+                    return False, rejected
+                ok, note = self.do_E(arg + ",full")
+                return ok, rejected + ", " + note
+            self.frame = rfd_delta.apply_delta(self.frame, image)
+            self.frame_ref = (ref[0], ref[1] + 1)
+            rfd_delta.Image.fromarray(self.frame).save(os.path.join(self.outdir, name.replace(".bin", ".png")))
+        return True, "%s %d bytes" % (name, len(image))
+
+    def do_I(self, arg):
+        if arg[:4] in self.saved:
+            ids = self.saved[arg[:4]]
+            index = int(arg[4:] or 0)
+            arg = str(ids[index]) if index < len(ids) else "none"
+        self.ser.write(arg + "\n")
+        reply = self.read_until("\n", 5).split()
+        if reply[:1] != ["OK"]:
+            return True, "rejected"
+        name = reply[1]
+        image = self.receive_image(name)
+        if image is None or len(image) != int(reply[2]) or rfd_frame.crc32(image) != int(reply[3], 16):
+            return False, name
+        return True, "%s %d bytes" % (name, len(image))
+
+    def do_R(self, arg):
+        self.ser.write(arg + "\n")
+        before = len(self.push.images)
+        self.push.batch_end = None
+        deadline = time.time() + 600
+        while self.push.batch_end is None and time.time() < deadline:
+            self.cut_in(len(self.push.images) - before)
+            if self.next_byte(5.0) == "":
+                break
+        if self.push.batch_end is None:
+            return False, "no batch end"
+        sent, missing = self.push.batch_end
+        got = len(self.push.images) - before
+        return got == sent, "%d images, %d missing, %d bad" % (got, missing, self.push.bad)
+
+    def do_K(self, arg):
+        self.ser.write(arg + "\n")
+        reply = self.read_until("\n", 5).strip()
+        if reply == "OK":
+            self.integrity = rfd_integrity.get(arg)
+        return reply in ("OK", "NO"), "%s %s" % (arg, reply)
+
+    def do_L(self, arg):
+        self.ser.write(arg + "\n")
+        reply = self.read_until("\n", 5).strip()
+        if reply == "OK":
+            self.link_sync = arg
+        return reply in ("OK", "NO"), "%s %s" % (arg, reply)
+
+    def do_W(self, arg):
+        rate = rfd_baud.follow(self.ser, rfd_baud.parse_rates(arg))
+        if rate is None:
+            self.ser.baudrate = self.base_baud
+            return False, "negotiation broke down, back to %d" % self.base_baud
+        return True, "rate %d" % rate
+
+    # "OK" / "NO" / "OK <first id> <count>" replies of 'V', 'F' and 'X'
+    def saved_reply(self, arg, kind, what):
+        self.ser.write(arg + "\n")
+        reply = self.read_until("\n", 10).split()
+        if reply[:1] == ["OK"] and len(reply) == 3:
+            first, count = int(reply[1]), int(reply[2])
+            self.saved[kind] = range(first, first + count)
+            return True, "%d %s, ids %d-%d" % (count, what, first, first + count - 1)
+        return reply[:1] in (["OK"], ["NO"]), " ".join(reply)
+
+    def do_V(self, arg):
+        return self.saved_reply(arg, "clip", "segments")
+
+    def do_F(self, arg):
+        return self.saved_reply(arg, "ring", "frames")
+
+    def do_X(self, arg):
+        return self.saved_reply(arg, "prof", "reports")
+
+    def do_U(self, arg):
+        self.ser.write(arg + "\n")
+        return True, "push " + ("on" if arg == "1" else "off")
+
+    def do_2(self, arg):
+        data = self.read_block(1 << 20, 1.0)
+        return True, "%d lines" % data.count("\n")
+
+    def do_3(self, arg):
+        if self.link_sync == "marker":
+            self.await_marker()
+        else:
+            self.answer_sync()
+        self.ser.write(arg)
+        return self.receive_image(arg) is not None, arg
+
+    def do_4(self, arg):
+        data = self.read_until("\r")
+        return data.endswith("\r"), data.replace("\n", ",").strip(",\r")
+
+    def do_5(self, arg):
+        self.ser.write("\n".join(arg.split(",")) + "\n")
+        # the payload reads settings until its serial timeout, then acks again
+        return self.read(1, 15) == 'A', arg
+
+    def do_6(self, arg):
+        count = int(arg or 5)
+        rtts = []
+        for x in range(count):
+            start = time.time()
+            self.ser.write('P')
+            if self.read(1, 2.0) == 'P':
+                rtts.append(time.time() - start)
+        self.ser.write('D')
+        if not rtts:
+            return False, "no pings"
+        return len(rtts) == count, "rtt avg %.3fs" % (sum(rtts) / len(rtts))
+
+    def do_7(self, arg):
+        data = self.read_block(1 << 22, 1.0)
+        return True, "%d lines" % data.count("\n")
+
+    def do_T(self, arg):
+        data = self.read_until("\n")
+        return data.endswith("\n"), data.strip()
+
+    def do_M(self, arg):
+        data = self.read_until("\r")
+        return data.endswith("\r"), data.split("\n")[0]
+
+    def no_reply(self, arg):
+        return True, ""
+
+
+# One command per line ("I 3", "R 0-10"), '#' starts a comment
+def parse_command(line):
+    line = line.split("#")[0].strip()
+    if line == "":
+        return None
+    parts = line.split(None, 1)
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
+def print_result(r, out = sys.stdout):
+    rate = r["bytes"] / r["seconds"] if r["seconds"] > 0 else 0
+    out.write("%-4s %-20s %8.3f %9d %10.0f  %s %s\n" % (r["cmd"], r["arg"][:20], r["seconds"], r["bytes"],
+                                                      rate, "OK  " if r["ok"] else "FAIL", r["note"]))
+    out.flush()
+
+
+# --preview: a progress line per render, and the partial image next to the file
+def show_preview(name, received, image):
+    line = "  %s %d bytes" % (name, received)
+    if image is not None:
+        line += " decoded %dx%d" % image.size
+        try:
+            image.save(os.path.join(preview_dir, name + ".preview.png"))
+        except (IOError, KeyError):
+            pass
+    print line
+
+preview_dir = "."
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Ground station for the RFD payload")
+    parser.add_argument("port", help = "serial port of the ground radio")
+    parser.add_argument("commands", nargs = "*", help = "commands to run, e.g. 1 \"I 3\" (default: read from stdin)")
+    parser.add_argument("--baud", type = int, default = BASE_BAUD, help = "the payload's base rate (profile \"baud\")")
+    parser.add_argument("--rate-fallback", type = float, default = RATE_FALLBACK,
+                        help = "the payload's profile \"rate_fallback\", for listen")
+    parser.add_argument("--port2", default = None, help = "second radio the payload stripes frames over")
+    parser.add_argument("--out", default = ".", help = "directory for received images")
+    parser.add_argument("--integrity", default = "md5", choices = rfd_integrity.available(),
+                        help = "chunk digest the payload is set to (profile \"integrity\")")
+    parser.add_argument("--link-sync", default = "legacy", choices = ("legacy", "marker"),
+                        help = "resync mode the payload is set to (profile \"link_sync\")")
+    parser.add_argument("--preview", action = "store_true", help = "render images while they arrive")
+    args = parser.parse_args()
+    if serial is None:
+        sys.exit("rfd_ground.py needs pyserial")
+
+    ser = serial.Serial(port = args.port, baudrate = args.baud, timeout = 1)
+    preview_dir = args.out
+    ground = GroundStation(ser, args.out, preview = show_preview if args.preview else None, base_baud = args.baud)
+    ground.integrity = rfd_integrity.get(args.integrity)
+    ground.rate_fallback = args.rate_fallback
+    ground.link_sync = args.link_sync
+    if args.port2:
+        ground.add_link(serial.Serial(port = args.port2, baudrate = args.baud, timeout = 1))
+    lines = args.commands or sys.stdin
+    ok = True
+    for line in lines:
+        command = parse_command(line)
+        if command is None:
+            continue
+        result = ground.execute(*command)
+        print_result(result)
+        ok = ok and result["ok"]
+    sys.exit(0 if ok else 1)
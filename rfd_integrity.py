@@ -0,0 +1,110 @@
+import sys
+import time
+import zlib
+import struct
+import hashlib
+
+#  ------------------------  Chunk integrity  -------------------------------
+# send_image precedes every chunk with a digest the ground station checks
+# before answering 'Y'/'N'.  This used to be a hex MD5 (32 bytes per chunk,
+# over a copied slice); the digest is now pluggable:
+#
+#     md5       32 byte hex text, what existing ground stations expect (default)
+#     crc32     4 bytes binary, zlib
+#     crc32c    4 bytes binary, needs the crc32c package
+#     xxh64     8 bytes binary, needs the xxhash package
+#
+# Digests are taken over zero-copy windows of the encoded image, all chunks
+# in one pass, and cached on the catalog entry so resending an image costs
+# nothing.  The profile's "integrity" key sets the default and command 'K'
+# switches it at runtime.
+#
+#     python rfd_integrity.py [MB]      CPU cost per MB of each algorithm
+# ----------------------------------------------------------------------------
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class Algorithm:
+    def __init__(self, name, size, func, binary = True):
+        self.name = name
+        self.size = size            # digest bytes on the wire
+        self.func = func
+        self.binary = binary
+
+    def digest(self, view):
+        return self.func(view)
+
+    # for the log
+    def text(self, digest):
+        if self.binary:
+            return digest.encode('hex')
+        return digest
+
+
+ALGORITHMS = {}
+
+def register(algorithm):
+    ALGORITHMS[algorithm.name] = algorithm
+
+register(Algorithm("md5", 32, lambda view: hashlib.md5(view).hexdigest(), binary = False))
+register(Algorithm("crc32", 4, lambda view: struct.pack(">I", zlib.crc32(view) & 0xffffffff)))
+if crc32c is not None:
+    register(Algorithm("crc32c", 4, lambda view: struct.pack(">I", crc32c.crc32c(view))))
+if xxhash is not None:
+    register(Algorithm("xxh64", 8, lambda view: xxhash.xxh64(view).digest()))
+
+
+def available():
+    return sorted(ALGORITHMS)
+
+
+def get(name):
+    return ALGORITHMS.get(name)
+
+
+# Read-only view of data[pos:pos+size] without copying it.  Python 2's zlib
+# only takes buffer objects, not memoryviews.
+def window(data, pos, size):
+    try:
+        return buffer(data, pos, size)
+    except NameError:
+        return memoryview(data)[pos:pos + size]
+
+
+# Digests of every wordlength chunk of data, in order
+def chunk_digests(algorithm, data, wordlength):
+    return [algorithm.digest(window(data, pos, wordlength)) for pos in range(0, len(data), wordlength)]
+
+
+# CPU seconds per MB for each algorithm over wordlength chunks, plus the old
+# copy-a-slice MD5 for comparison
+def benchmark(megabytes = 8, wordlength = 10000):
+    data = "".join([chr((i * 131 + (i >> 7)) & 0xff) for i in range(1 << 16)]) * (megabytes * 16)
+    results = []
+    start = time.clock()
+    for pos in range(0, len(data), wordlength):
+        hashlib.md5(data[pos:pos + wordlength]).hexdigest()
+    results.append(("md5 (slice copy)", (time.clock() - start) / megabytes))
+    for name in available():
+        start = time.clock()
+        chunk_digests(ALGORITHMS[name], data, wordlength)
+        results.append((name, (time.clock() - start) / megabytes))
+    return results
+
+
+if __name__ == "__main__":
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    print "%-18s %10s %10s" % ("algorithm", "ms/MB", "MB/s")
+    for name, seconds in benchmark(megabytes):
+        print "%-18s %10.2f %10.1f" % (name, seconds * 1000, 1.0 / seconds if seconds > 0 else 0)
+    missing = [name for name in ("crc32c", "xxh64") if name not in ALGORITHMS]
+    if missing:
+        print "not installed:", ", ".join(missing)
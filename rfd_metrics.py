@@ -0,0 +1,203 @@
+import time
+import struct
+import threading
+from array import array
+
+#  ------------------------  Link telemetry  -------------------------------
+# Collects throughput/retry/timeout numbers from send_image, sync, sendword
+# and the ping handler so they can be summarised per flight and queried
+# from the ground station (command 'M').
+#
+# Per-image transfer summaries are appended to linkmetrics.bin as fixed
+# size records (see TRANSFER_RECORD) so a whole flight fits in a few kB.
+# -------------------------------------------------------------------------
+
+# time, name, encoded size, raw size, duration, chunks, retries, timeouts, sync fails, ok
+TRANSFER_RECORD = struct.Struct("<I16sIIfHHHHB")
+
+RTT_SAMPLES = 64                # size of the rtt ring kept in memory
+RTT_ALPHA = 0.125               # smoothing factors, same as TCP srtt/rttvar
+RTT_BETA = 0.25
+
+
+class LinkMetrics:
+    def __init__(self, path = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # flight totals
+        self.bytes_written = 0          # everything handed to ser.write by sendword
+        self.bytes_acked = 0            # payload bytes the ground station said 'Y' to
+        self.chunks_sent = 0
+        self.chunks_retried = 0
+        self.timeouts = 0
+        self.sync_calls = 0
+        self.sync_failures = 0
+        self.sync_time = 0.0
+        self.transfer_time = 0.0
+        self.images_sent = 0
+        self.images_failed = 0
+        self.pings = 0
+        # rtt estimate from the ping exchange
+        self.rtt = array('f', [0.0] * RTT_SAMPLES)
+        self.rtt_count = 0
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.ping_sent = 0.0
+        # transfer in progress
+        self.current = None
+        self.recent = []
+
+    # ---------------  transfer hooks (send_image)  -----------------
+    def transfer_start(self, name, encoded_size, raw_size = 0):
+        with self.lock:
+            self.current = {"name": name, "size": encoded_size, "raw": raw_size,
+                            "start": time.time(), "chunks": 0, "retries": 0,
+                            "timeouts": 0, "syncfail": 0, "acked": 0}
+
+    def chunk_result(self, nbytes, ack):
+        with self.lock:
+            self.chunks_sent += 1
+            cur = self.current
+            if cur is not None:
+                cur["chunks"] += 1
+            if ack == 'Y':
+                self.bytes_acked += nbytes
+                if cur is not None:
+                    cur["acked"] += nbytes
+                return
+            self.chunks_retried += 1
+            if cur is not None:
+                cur["retries"] += 1
+            if ack == "":
+                self.timeouts += 1
+                if cur is not None:
+                    cur["timeouts"] += 1
+
+    def transfer_end(self, ok):
+        with self.lock:
+            cur = self.current
+            self.current = None
+            if cur is None:
+                return None
+            duration = time.time() - cur["start"]
+            self.transfer_time += duration
+            if ok:
+                self.images_sent += 1
+            else:
+                self.images_failed += 1
+            record = TRANSFER_RECORD.pack(int(cur["start"]), cur["name"][:16], cur["size"],
+                                          cur["raw"], duration, min(cur["chunks"], 0xffff),
+                                          min(cur["retries"], 0xffff), min(cur["timeouts"], 0xffff),
+                                          min(cur["syncfail"], 0xffff), 1 if ok else 0)
+            self.recent.append(record)
+            del self.recent[:-16]
+        self.save(record)
+        return record
+
+    # ---------------  byte counter hook (sendword)  ----------------
+    def wrote(self, nbytes):
+        self.bytes_written += nbytes
+
+    # ---------------  sync hook  -----------------------------------
+    def sync_result(self, ok, elapsed):
+        with self.lock:
+            self.sync_calls += 1
+            self.sync_time += elapsed
+            if not ok:
+                self.sync_failures += 1
+                if self.current is not None:
+                    self.current["syncfail"] += 1
+
+    # ---------------  ping hooks (command '6')  --------------------
+    def ping_out(self):
+        self.ping_sent = time.time()
+
+    def ping_in(self):
+        if self.ping_sent == 0.0:
+            return
+        sample = time.time() - self.ping_sent
+        self.ping_sent = 0.0
+        with self.lock:
+            self.pings += 1
+            self.rtt[self.rtt_count % RTT_SAMPLES] = sample
+            self.rtt_count += 1
+            if self.rtt_count == 1:
+                self.srtt = sample
+                self.rttvar = sample / 2
+            else:
+                self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - sample)
+                self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+
+    # ---------------  derived numbers  -----------------------------
+    def goodput(self):
+        if self.transfer_time <= 0:
+            return 0.0
+        return self.bytes_acked / self.transfer_time
+
+    def retransmit_ratio(self):
+        if self.chunks_sent == 0:
+            return 0.0
+        return float(self.chunks_retried) / self.chunks_sent
+
+    def rtt_min(self):
+        n = min(self.rtt_count, RTT_SAMPLES)
+        if n == 0:
+            return 0.0
+        return min(self.rtt[:n])
+
+    def summary(self):
+        return ("goodput=%.0fB/s retx=%.3f chunks=%d timeouts=%d syncfail=%d/%d synctime=%.1fs "
+                "imgs=%d/%d srtt=%.3f rttvar=%.3f rttmin=%.3f pings=%d tx=%d\n"
+                % (self.goodput(), self.retransmit_ratio(), self.chunks_sent, self.timeouts,
+                   self.sync_failures, self.sync_calls, self.sync_time, self.images_sent,
+                   self.images_sent + self.images_failed, self.srtt, self.rttvar,
+                   self.rtt_min(), self.pings, self.bytes_written))
+
+    # ---------------  storage  -------------------------------------
+    def save(self, record):
+        if self.path is None:
+            return
+        try:
+            fh = open(self.path, "ab")
+            fh.write(record)
+            fh.close()
+        except IOError:
+            print "Link metrics write error"
+
+    def load(self):
+        records = []
+        try:
+            fh = open(self.path, "rb")
+            data = fh.read()
+            fh.close()
+        except (IOError, TypeError):
+            return records
+        size = TRANSFER_RECORD.size
+        for pos in range(0, len(data) - size + 1, size):
+            records.append(TRANSFER_RECORD.unpack_from(data, pos))
+        return records
+
+
+# Turns one TRANSFER_RECORD into the line sent to the ground station
+def format_record(record):
+    if isinstance(record, str):
+        record = TRANSFER_RECORD.unpack(record)
+    start, name, size, raw, duration, chunks, retries, timeouts, syncfail, ok = record
+    rate = 0.0
+    if duration > 0:
+        rate = size / duration
+    return ("%s %s size=%d raw=%d t=%.1fs rate=%.0fB/s chunks=%d retries=%d timeouts=%d syncfail=%d %s\n"
+            % (time.strftime("%H:%M:%S", time.localtime(start)), name.rstrip("\0"), size, raw,
+               duration, rate, chunks, retries, timeouts, syncfail, "OK" if ok else "FAIL"))
+
+
+# Sends the flight summary followed by the last `count` transfers, ends with "\r"
+# like the camera settings reply (command '4')
+def send_metrics(ser, metrics, count = 10):
+    ser.write(metrics.summary())
+    for record in metrics.load()[-count:]:
+        ser.write(format_record(record))
+    ser.write("\r")
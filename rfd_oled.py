@@ -0,0 +1,124 @@
+import time
+import datetime
+import subprocess
+
+import Adafruit_SSD1306
+import Image
+import ImageDraw
+import ImageFont
+
+#  ------------------------  SSD1306 status display  -------------------------------
+# Only imported by RFD_python_Pi.py when the hardware profile has oled = True.
+# Shows the time and the last three lines of piruntimedata.txt.  The display can
+# be plugged in or pulled mid flight, so the I2C bus is re-probed, but at most
+# every PROBE_INTERVAL seconds rather than on every update as before (each probe
+# is a "sudo i2cdetect" subprocess).
+# ----------------------------------------------------------------------------------
+
+RST = 24
+I2C_ADDRESS = "3c"
+PROBE_INTERVAL = 30
+TAIL_BYTES = 1024               # enough of the log file for the last few lines
+
+
+class OledDisplay:
+    def __init__(self, logpath, rst = RST):
+        self.logpath = logpath
+        self.disp = Adafruit_SSD1306.SSD1306_128_64(rst=rst)
+        self.present = False
+        self.probed = 0.0
+        self.image = None
+        self.draw = None
+        self.font = None
+
+    def initOLED(self):
+        self.disp.begin()
+        # Clear display.
+        self.disp.clear()
+        self.disp.display()
+
+        # Create blank image for drawing.
+        # Make sure to create image with mode '1' for 1-bit color.
+        width = self.disp.width
+        height = self.disp.height
+        self.image = Image.new('1', (width, height))
+
+        # Get drawing object to draw on image.
+        self.draw = ImageDraw.Draw(self.image)
+
+        # Draw a black filled box to clear the image.
+        self.draw.rectangle((0,0,width,height), outline=0, fill=0)
+
+        # Load default font.
+        self.font = ImageFont.load_default()
+        # Alternatively load a TTF font.
+        # Some other nice fonts to try: http://www.dafont.com/bitmap.php
+        #font = ImageFont.truetype('Minecraftia.ttf', 8)
+
+        self.disp.image(self.image)
+        self.disp.display()
+
+    # Re-checks the bus for the display, (re)initialising it when it shows up
+    def probe(self):
+        now = time.time()
+        if now - self.probed < PROBE_INTERVAL:
+            return self.present
+        self.probed = now
+        try:
+            result = subprocess.check_output(["sudo","i2cdetect","-y","1"])
+        except (OSError, subprocess.CalledProcessError):
+            self.present = False
+            return False
+        if I2C_ADDRESS in result:
+            if not self.present:
+                self.initOLED()
+                self.present = True
+        else:
+            self.present = False
+        return self.present
+
+    def clear(self):
+        self.draw.rectangle((0,0,self.disp.width,self.disp.height), outline=0, fill=0)
+
+    def tail(self, count):
+        try:
+            fh = open(self.logpath, "rb")
+            fh.seek(0, 2)
+            fh.seek(max(0, fh.tell() - TAIL_BYTES))
+            lines = fh.read().splitlines()
+            fh.close()
+        except IOError:
+            print "Error with Display Update"
+            return []
+        return [line.rstrip() for line in lines[-count:]]
+
+    def update(self):
+        try:
+            if not self.probe():
+                return
+            lines = self.tail(3)
+            lines = [""] * (3 - len(lines)) + lines
+            self.clear()
+            self.draw.text((0, 0), str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")), font=self.font, fill=255)
+            self.draw.text((0,15), lines[0], font=self.font, fill=255)
+            self.draw.text((0,30), lines[1], font=self.font, fill=255)
+            self.draw.text((0,45), lines[2], font=self.font, fill=255)
+            self.disp.image(self.image)
+            self.disp.display()
+        except IOError:
+            self.present = False
+
+    def smile(self):
+        try:
+            if not self.probe():
+                return
+            self.clear()
+            self.draw.text((0,0),"Capturing Photo...", font = self.font, fill = 255)
+            self.draw.line([(40,20),(40,35)],fill = 255)
+            self.draw.line([(50,20),(50,35)],fill = 255)
+            self.draw.arc((20,30,70,60),20,160,fill = 255)
+            self.disp.image(self.image)
+            self.disp.display()
+            time.sleep(0.5)
+        except IOError:
+            self.present = False
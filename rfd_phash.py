@@ -0,0 +1,66 @@
+import io
+
+#  ------------------------  Near-duplicate detection  -------------------------------
+# When the balloon hangs still, consecutive 60 s captures are nearly identical.
+# A 64 bit difference hash (dHash) of each _b thumbnail is taken at capture time:
+# the frame is shrunk to 9x8 grey and each bit says whether a pixel is brighter
+# than its right-hand neighbour.  Frames whose hash is within DUP_THRESHOLD bits
+# of the last kept frame are flagged as near-duplicates; they are skipped for
+# downlink and, if the profile asks for it, their full-res _a is not stored.
+# ------------------------------------------------------------------------------------
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+HASH_SIZE = 8
+DUP_THRESHOLD = 6               # differing bits (of 64) still counted as the same view
+
+
+def available():
+    return Image is not None and hasattr(Image, "open")
+
+
+# Returns the 64 bit dHash of JPEG/PNG data, or None if it can't be computed
+def dhash(data):
+    if not available():
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        img = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+        pixels = list(img.getdata())
+    except (IOError, ValueError, SyntaxError):
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        base = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[base + col] > pixels[base + col + 1])
+    return value
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+# Tracks the last kept frame and classifies new ones against it
+class DuplicateFilter:
+    def __init__(self, threshold = DUP_THRESHOLD):
+        self.threshold = threshold
+        self.last = None            # (name, hash) of the last frame that wasn't a duplicate
+        self.duplicates = 0
+
+    # Returns the name of the frame `value` duplicates, or None if it is new
+    def check(self, name, value):
+        if value is None:
+            return None
+        if self.last is not None and distance(self.last[1], value) <= self.threshold:
+            self.duplicates += 1
+            return self.last[0]
+        self.last = (name, value)
+        return None
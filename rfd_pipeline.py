@@ -0,0 +1,185 @@
+import time
+import base64
+import threading
+
+import rfd_phash
+import rfd_integrity
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+#  ------------------------  Post-capture pipeline  -------------------------------
+# The camera encodes both the PNG and the JPEG thumbnail on the GPU, but the
+# CPU work on each new _b used to run inline in the main loop on one core:
+#
+#     metadata         quality score (rfd_quality) and dHash (rfd_phash)
+#     transmit-cache   base64 of the image and its chunk digests, so the first
+#                      send_image of it does no encoding or hashing
+#
+# Pipeline runs these in a pool of worker processes so the other cores do it
+# while the main loop goes back to serving commands.  Results are handed to
+# finish() (in the main process) in capture order, which is where the catalog
+# entry is updated and the images are given to the storage writer.
+#
+# Backpressure: at most IN_FLIGHT captures may be in the pipeline; if workers
+# fall behind pic_interval, submit() blocks the capture loop until one is done
+# and the wait is counted.  With no workers (or no multiprocessing) everything
+# runs inline, as before.  Per stage times are kept for command 'M'.
+#
+# Python 2's apply_async has no error callback, so a worker that is killed
+# (OOM) never hands its result back.  A capture that has waited STALL_LIMIT
+# gives up on the captures still out: they are finished with an error
+# result (images stored, no score), the pool is dropped and the pipeline
+# carries on inline.
+# ---------------------------------------------------------------------------------
+
+WORKERS = 2
+IN_FLIGHT = 3
+STALL_LIMIT = 60.0
+STAGES = ("queue", "metadata", "transmit-cache", "finish")
+
+
+# Runs in a worker process: every CPU stage for one _b thumbnail.  rfd_quality
+# (NumPy) is imported here, in the workers, so it isn't part of the boot time.
+def process(data, algorithm, wordlength, submitted):
+    import rfd_quality
+    start = time.time()
+    timing = {"queue": start - submitted}
+    result = {"timing": timing}
+    try:
+        result["quality"] = rfd_quality.score_image(data)
+        result["dhash"] = rfd_phash.dhash(data)
+        mark = time.time()
+        timing["metadata"] = mark - start
+        encoded = base64.b64encode(data)
+        result["encoded"] = encoded
+        result["digests"] = rfd_integrity.chunk_digests(rfd_integrity.get(algorithm), encoded, wordlength)
+        result["digest_key"] = (algorithm, wordlength)
+        timing["transmit-cache"] = time.time() - mark
+    except Exception, e:
+        result["error"] = "%s: %s" % (e.__class__.__name__, e)
+    return result
+
+
+class Pipeline:
+    def __init__(self, finish, workers = WORKERS, limit = IN_FLIGHT):
+        self.finish = finish            # finish(job, result), called in submit order
+        self.workers = workers
+        self.limit = max(1, limit)
+        self.pool = None
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.next_seq = 0
+        self.finished = 0               # next seq to hand to finish()
+        self.results = {}
+        self.jobs = {}                  # seq -> job, submitted to the pool and not back yet
+        self.draining = False
+        self.stalls = 0
+        self.backpressure = 0.0
+        self.lost = 0
+        self.stats = dict([(stage, [0, 0.0, 0.0]) for stage in STAGES])    # count, total, max
+
+    # Forks the workers; call before starting threads
+    def start(self):
+        if self.workers > 0 and multiprocessing is not None:
+            try:
+                self.pool = multiprocessing.Pool(self.workers)
+            except (OSError, ImportError), e:
+                print "Pipeline workers unavailable, processing inline:", e
+
+    def submit(self, job, data, algorithm, wordlength):
+        start = time.time()
+        lost = []
+        with self.cond:
+            while self.inflight >= self.limit:
+                if time.time() - start > STALL_LIMIT:
+                    lost = self.give_up()
+                    break
+                self.cond.wait(1.0)
+            waited = time.time() - start
+            if waited > 0.001:
+                self.stalls += 1
+                self.backpressure += waited
+                print "Pipeline full, capture waited %.3fs" % waited
+            seq = self.next_seq
+            self.next_seq += 1
+            self.inflight += 1
+            if self.pool is not None:
+                self.jobs[seq] = job
+        for stuck, stuck_job in lost:
+            self.done(stuck, stuck_job, {"timing": {}, "error": "worker lost"})
+        args = (data, algorithm, wordlength, time.time())
+        if self.pool is None:
+            self.done(seq, job, process(*args))
+        else:
+            self.pool.apply_async(process, args, callback = lambda result: self.done(seq, job, result))
+
+    # Called with cond held after STALL_LIMIT: drops the pool and returns the
+    # (seq, job) still out, for submit() to finish with an error
+    def give_up(self):
+        lost = [(seq, job) for seq, job in sorted(self.jobs.items()) if seq not in self.results]
+        for seq, job in lost:
+            del self.jobs[seq]
+        self.lost += len(lost)
+        print "Pipeline stalled, %d captures lost, processing inline" % len(lost)
+        pool = self.pool
+        self.pool = None
+        if pool is not None:
+            # terminate() can block on a broken pool; the capture loop mustn't
+            closer = threading.Thread(target = pool.terminate, name = "pool-close")
+            closer.daemon = True
+            closer.start()
+        return lost
+
+    # Collects a result and finishes every job that is next in order
+    def done(self, seq, job, result):
+        with self.cond:
+            if seq < self.finished or seq in self.results:
+                return                  # a late result for a capture given up on
+            self.jobs.pop(seq, None)
+            self.results[seq] = (job, result)
+            if self.draining:
+                return
+            self.draining = True
+        while True:
+            with self.cond:
+                item = self.results.pop(self.finished, None)
+                if item is None:
+                    self.draining = False
+                    return
+                self.finished += 1
+            start = time.time()
+            try:
+                self.finish(*item)
+            except Exception, e:
+                print "Pipeline finish error", e
+            item[1]["timing"]["finish"] = time.time() - start
+            with self.cond:
+                for stage, seconds in item[1]["timing"].items():
+                    stat = self.stats[stage]
+                    stat[0] += 1
+                    stat[1] += seconds
+                    stat[2] = max(stat[2], seconds)
+                self.inflight -= 1
+                self.cond.notify_all()
+
+    # Blocks until everything submitted has been finished
+    def flush(self, timeout = 30):
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.inflight and time.time() < deadline:
+                self.cond.wait(0.5)
+
+    # Stops the workers; call after flush()
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def summary(self):
+        stages = " ".join(["%s=%.3f/%.3fs" % (stage, self.stats[stage][1] / max(self.stats[stage][0], 1), self.stats[stage][2])
+                           for stage in STAGES])
+        return ("pipeline workers=%d inflight=%d stalls=%d backpressure=%.3fs lost=%d %s\n"
+                % (self.workers if self.pool else 0, self.inflight, self.stalls, self.backpressure, self.lost, stages))
@@ -0,0 +1,123 @@
+import os
+import ConfigParser
+
+#  ------------------------  Hardware profiles  -------------------------------
+# RFD_python_Pi.py and Modified_RFD_python_Pi.py used to be two copies of the
+# payload that differed only in the hardware they ran on.  Those differences
+# now live here as named profiles; the profile is picked with the RFD_PROFILE
+# environment variable or the [payload] section of rfd_payload.cfg, and any
+# key below can be overridden there too, e.g.
+#
+#     [payload]
+#     profile = oled
+#     iso = 200
+#
+# Subsystems a profile turns off are never imported or polled.
+# ------------------------------------------------------------------------------
+
+# settings shared by every profile, a profile or the config file can override them
+COMMON = {
+    "storage_quota_mb": 0,              # cap for this flight's folder, 0 = card size
+    "storage_min_free_mb": 200,         # thin old full-res images below this much free space
+    "dup_threshold": 6,                 # dHash bits within which frames count as near-duplicates
+    "dedup_fullres": False,             # also skip storing the full-res _a of near-duplicates
+    "integrity": "md5",                 # chunk digest for send_image, see rfd_integrity.py
+    "pipeline_workers": 2,              # post-capture worker processes, 0 = inline
+    "link_sync": "legacy",              # resync after a NAK: "legacy" sync()/'S' or "marker" (rfd_sync.py)
+    "push": False,                      # push new thumbnails while the link is idle (rfd_push.py)
+    "push_idle": 15.0,                  # seconds without a command before pushing starts
+    "baud": 38400,                      # base serial rate, command 'W' negotiates higher (rfd_baud.py)
+    "rate_fallback": 60.0,              # seconds without a valid command before a negotiated rate drops back to baud
+    "port2": "",                        # second radio to stripe framed image traffic over, "" = none
+    "clip_arm": False,                  # record into the clip buffer from boot (rfd_clip.py), command 'V' too
+    "clip_seconds": 20,                 # clip buffer length
+    "clip_width": 640,
+    "clip_height": 480,
+    "clip_framerate": 10,               # also the IDR interval, so segments are about 1 s
+    "clip_bitrate": 400000,
+    "clip_trigger_gpio": 0,             # BCM pin whose falling edge saves a clip, 0 = none
+    "ring": False,                      # run the pre-trigger frame ring from boot (rfd_ring.py), command 'F' too
+    "ring_seconds": 10,
+    "ring_fps": 5,                      # ring_seconds * ring_fps frames, at most 100
+    "ring_width": 160,
+    "ring_height": 120,
+    "ring_trigger_gpio": 0,             # BCM pin whose falling edge freezes the ring, may be the clip trigger's
+    "shutdown_deadline": 20.0,          # seconds from the shutdown switch to power off (rfd_shutdown.py)
+    "slow_cycle": 2.0,                  # main loop passes busier than this go to timing.txt (rfd_timing.py)
+}
+
+PROFILES = {
+    # single board camera mux (A/B), shutdown switch, no display
+    "mux": {
+        "mux": True,
+        "cameras": "AB",
+        "oled": False,
+        "shutdown_switch": True,
+        "autoshutdown": True,
+        "iso": 100,
+        "folder": "/home/pi/RFD_Pics_Logs",
+        "camera_b_flip": True,
+        "camera_b_annotation": "",
+        "port": "/dev/ttyAMA0",
+    },
+    # the Modified_RFD_python_Pi.py board: four camera mux and the SSD1306 OLED
+    "oled": {
+        "mux": True,
+        "cameras": "ABCD",
+        "oled": True,
+        "shutdown_switch": False,
+        "autoshutdown": False,
+        "iso": 400,
+        "folder": "/home/pi/RFD_Pi_Code",
+        "camera_b_flip": False,
+        "camera_b_annotation": "Camera B",
+        "port": "/dev/ttyAMA0",
+    },
+    # one camera straight on the CSI port, nothing on the mux pins
+    "single": {
+        "mux": False,
+        "cameras": "A",
+        "oled": False,
+        "shutdown_switch": True,
+        "autoshutdown": True,
+        "iso": 100,
+        "folder": "/home/pi/RFD_Pics_Logs",
+        "camera_b_flip": True,
+        "camera_b_annotation": "",
+        "port": "/dev/ttyAMA0",
+    },
+}
+
+DEFAULT_PROFILE = "mux"
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rfd_payload.cfg")
+
+
+# Returns the settings dict for the selected profile with config file overrides
+# applied.  Unknown profile names fall back to DEFAULT_PROFILE.
+def load(path = None, name = None):
+    config = ConfigParser.RawConfigParser()
+    config.read(os.environ.get("RFD_CONFIG", path or CONFIG_FILE))
+    if name is None:
+        name = os.environ.get("RFD_PROFILE")
+    if name is None and config.has_option("payload", "profile"):
+        name = config.get("payload", "profile")
+    if name not in PROFILES:
+        if name is not None:
+            print "Unknown hardware profile", name, "using", DEFAULT_PROFILE
+        name = DEFAULT_PROFILE
+    profile = dict(COMMON)
+    profile.update(PROFILES[name])
+    if config.has_section("payload"):
+        for key, default in profile.items():
+            if not config.has_option("payload", key):
+                continue
+            if isinstance(default, bool):
+                profile[key] = config.getboolean("payload", key)
+            elif isinstance(default, int):
+                profile[key] = config.getint("payload", key)
+            elif isinstance(default, float):
+                profile[key] = config.getfloat("payload", key)
+            else:
+                profile[key] = config.get("payload", key)
+    profile["name"] = name
+    return profile
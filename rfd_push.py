@@ -0,0 +1,113 @@
+import time
+
+import rfd_frame
+from rfd_txsched import Job, LOW
+
+#  ------------------------  Background push  -------------------------------
+# Between ground station commands the link sits idle for most of a flight.
+# When push is on (profile "push", or command 'U'), once the link has been
+# quiet for "push_idle" seconds the payload sends, unasked:
+#
+#   - the imagedata.txt lines written since the last push  (CATALOG frames)
+#   - every new _b thumbnail the ground does not have yet  (IMAGE_START,
+#     IMAGE_DATA..., IMAGE_END), oldest first, skipping near-duplicates
+#
+# using rfd_frame frames so the ground can pick them out of the byte stream.
+# Push runs as a LOW priority job and stops between frames as soon as a byte
+# from the ground is waiting, so a command never waits more than one frame;
+# an interrupted image carries on from where it stopped next time the link
+# is idle, unless other frames (an 'R' batch) went out meanwhile: the
+# ground's receiver has dropped the half-sent image then, so it starts again
+# from IMAGE_START.  Pushed images are not acked: anything lost is fetched
+# the usual way ('3') from the catalog lines.
+# ----------------------------------------------------------------------------
+
+PUSH_IDLE = 15.0
+
+
+class Pusher:
+    def __init__(self, catalog, catalogpath, idle_after = PUSH_IDLE, enabled = False):
+        self.catalog = catalog
+        self.catalogpath = catalogpath      # imagedata.txt
+        self.idle_after = idle_after
+        self.enabled = enabled
+        self.framer = None                  # rfd_frame.Framer, set once serial is open
+        self.last_activity = time.time()
+        self.catalog_pos = 0                # bytes of imagedata.txt already pushed
+        self.job = None
+        self.frames_sent = 0                # framer.frames when the job was cut short
+        self.images = 0
+        self.interrupted = 0
+        self.restarted = 0
+
+    # A command came in: the ground is using the link
+    def activity(self):
+        self.last_activity = time.time()
+
+    # New _b thumbnails on the card that the ground doesn't have, oldest first
+    def pending(self):
+        return [e for e in self.catalog.of_kind('b')
+                if e["stored"] and not e.get("downlinked") and e.get("duplicate_of") is None]
+
+    # Complete imagedata.txt lines written since the last push
+    def catalog_delta(self):
+        try:
+            fh = open(self.catalogpath, "rb")
+        except IOError:
+            return ""
+        fh.seek(self.catalog_pos)
+        data = fh.read()
+        fh.close()
+        data = data[:data.rfind("\n") + 1]
+        self.catalog_pos += len(data)
+        return data
+
+    def steps(self):
+        while True:
+            lines = self.catalog_delta()
+            for pos in range(0, len(lines), rfd_frame.MAX_PAYLOAD):
+                self.framer.send(rfd_frame.CATALOG, lines[pos:pos + rfd_frame.MAX_PAYLOAD])
+                yield None
+            todo = self.pending()
+            if not todo:
+                return
+            entry = todo[0]
+            fh = open(entry["path"], "rb")
+            data = fh.read()
+            fh.close()
+            for x in rfd_frame.image_steps(self.framer, entry["name"], data):
+                yield x
+            self.framer.drain()             # only downlinked once IMAGE_END is out
+            entry["downlinked"] = True
+            self.images += 1
+            print "Pushed", entry["name"], len(data), "bytes"
+
+    # Called from the main loop with nothing to do.  Pushes until everything is
+    # sent or busy() says the ground wants the link; returns True if cut short.
+    def pump(self, scheduler, busy):
+        if not self.enabled or self.framer is None:
+            return False
+        if time.time() - self.last_activity < self.idle_after:
+            return False
+        if self.job is not None and not self.job.done and self.framer.frames != self.frames_sent:
+            # someone else sent frames since the cut: resuming mid-image would
+            # send data the ground can't place, and mark the image downlinked
+            scheduler.cancel(self.job)
+            self.restarted += 1
+        if self.job is None or self.job.done:
+            self.job = Job("push", self.steps(), LOW)
+        cut = scheduler.run_until(self.job, busy)
+        self.framer.drain()                 # nothing of the push left queued behind the main loop
+        if cut:
+            self.interrupted += 1
+            self.frames_sent = self.framer.frames
+            return True
+        return False
+
+    def summary(self):
+        framer = self.framer
+        return ("push %s images=%d frames=%d bytes=%d interrupted=%d restarted=%d\n"
+                % ("on" if self.enabled else "off", self.images,
+                   framer.frames if framer else 0, framer.bytes if framer else 0, self.interrupted,
+                   self.restarted))
+
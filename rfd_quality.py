@@ -0,0 +1,98 @@
+import io
+
+#  ------------------------  Onboard image scoring  -------------------------------
+# Cheap quality metrics on a downsampled greyscale copy of the _b thumbnail so
+# the payload can send the best recent frame (command 'B') instead of whatever
+# was captured last, which may be black, blurred or empty sky.
+#
+#   exposure   - how well the histogram sits in range (mean near mid grey, few
+#                clipped pixels)
+#   sharpness  - variance of the 4-neighbour Laplacian
+#   entropy    - Shannon entropy of the 8 bit histogram, low for flat sky/black
+#
+# Needs NumPy and PIL; without them score_image() returns None and command 'B'
+# falls back to the most recent image.
+# ---------------------------------------------------------------------------------
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+SCORE_SIZE = (160, 120)         # frame is reduced to this before scoring
+CLIP_LOW = 8
+CLIP_HIGH = 247
+SHARPNESS_FULL = 1000.0         # Laplacian variance treated as perfectly sharp
+WEIGHTS = (0.3, 0.4, 0.3)       # exposure, sharpness, entropy
+
+
+def available():
+    return numpy is not None and Image is not None and hasattr(Image, "open")
+
+
+# Decodes JPEG data straight to a small greyscale array; draft() lets the JPEG
+# decoder skip most of the DCT work instead of decoding full size and resizing
+def load_small(data):
+    img = Image.open(io.BytesIO(data))
+    img.draft('L', SCORE_SIZE)
+    img = img.convert('L')
+    if img.size != SCORE_SIZE:
+        img = img.resize(SCORE_SIZE)
+    return numpy.asarray(img, dtype = numpy.float32)
+
+
+def exposure_score(hist, total):
+    levels = numpy.arange(256, dtype = numpy.float32)
+    mean = float((hist * levels).sum()) / total
+    clipped = float(hist[:CLIP_LOW].sum() + hist[CLIP_HIGH + 1:].sum()) / total
+    return max(0.0, 1.0 - abs(mean - 128.0) / 128.0 - clipped)
+
+
+def sharpness_value(a):
+    lap = (4 * a[1:-1, 1:-1] - a[:-2, 1:-1] - a[2:, 1:-1] - a[1:-1, :-2] - a[1:-1, 2:])
+    return float(lap.var())
+
+
+def entropy_value(hist, total):
+    p = hist[hist > 0].astype(numpy.float64) / total
+    return max(0.0, float(-(p * numpy.log2(p)).sum()))
+
+
+# Returns a dict of the metrics and the combined score in [0, 1], or None if
+# scoring isn't available or the image can't be decoded
+def score_image(data):
+    if not available():
+        return None
+    try:
+        a = load_small(data)
+    except (IOError, ValueError, SyntaxError):
+        return None
+    hist = numpy.bincount(a.astype(numpy.uint8).ravel(), minlength = 256)
+    total = float(a.size)
+    exposure = exposure_score(hist, total)
+    sharpness = sharpness_value(a)
+    entropy = entropy_value(hist, total)
+    sharp_norm = min(1.0, numpy.log1p(sharpness) / numpy.log1p(SHARPNESS_FULL))
+    score = (WEIGHTS[0] * exposure + WEIGHTS[1] * sharp_norm + WEIGHTS[2] * entropy / 8.0)
+    return {"score": round(float(score), 3), "exposure": round(exposure, 3),
+            "sharpness": round(sharpness, 1), "entropy": round(entropy, 2)}
+
+
+# Highest scoring entry newer than `since` (an image number), or None
+def best_since(entries, since):
+    best = None
+    for entry in entries:
+        if entry["number"] <= since or entry.get("score") is None or entry["thinned"]:
+            continue
+        if entry.get("duplicate_of") is not None:
+            continue
+        if best is None or entry["score"] > best["score"]:
+            best = entry
+    return best
@@ -0,0 +1,158 @@
+import io
+import time
+import threading
+from array import array
+
+#  ------------------------  Pre-trigger frame ring  -------------------------------
+# Stills are only taken when checkpoint expires, so anything that happens
+# between them is lost.  FrameRing keeps grabbing small greyscale frames off
+# the camera's video port into a ring of the last `seconds`, in memory only:
+# one array allocated at start-up holds every slot, so the ring never grows
+# and nothing reaches the card until it is wanted.
+#
+# freeze() (command 'F', or the ring trigger GPIO's edge callback) stops the
+# ring from overwriting anything; the main loop then writes the frozen
+# frames out oldest first as
+#
+#     ring003_f17.pgm       freeze 3, frame 17 (binary PGM, no encoding cost)
+#
+# catalogued like images so the ground station can fetch them with 'I', and
+# thaws the ring.  The seconds before the event are kept as they were when
+# the trigger fired, however long the main loop takes to get to them.
+#
+# The ring shares the camera: it borrows the clip recorder's while that is
+# recording, and otherwise opens its own, which it closes (release()) for a
+# full-res still and reopens on its next frame.  `lock` is held by whoever is
+# using the camera.
+# ---------------------------------------------------------------------------------
+
+MAX_SLOTS = 100                 # two digit frame numbers
+CAMERA_RESOLUTION = (1296, 972)     # full field of view; ring frames are resized from it
+
+
+# Picamera pads raw YUV captures to a multiple of 32 columns and 16 rows
+def padded(width, height):
+    return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+def pgm(width, height, pixels):
+    return "P5\n%d %d\n255\n" % (width, height) + pixels
+
+
+class FrameRing:
+    def __init__(self, seconds = 10, fps = 5, size = (160, 120)):
+        self.fps = fps
+        self.slots = max(1, min(MAX_SLOTS, int(seconds * fps)))
+        self.width, self.height = size
+        self.frame_size = self.width * self.height
+        self.pixels = array('B', [0]) * (self.slots * self.frame_size)
+        self.stamps = array('d', [0.0]) * self.slots
+        self.written = 0                # frames ever stored, the next goes in slot written % slots
+        self.first = 0                  # oldest frame not saved by an earlier freeze
+        self.lock = threading.RLock()
+        self.camera = None              # our own, when nobody else has one open
+        self.running = False
+        self.thread = None
+        self.frozen = None              # time of the freeze, None while running
+        self.freezes = 0
+        self.frames = 0
+        self.late = 0                   # frames that took longer than 1/fps
+        self.saved = 0
+
+    def start(self, picamera, held):
+        if self.running:
+            return
+        self.picamera = picamera
+        self.held = held                # -> a camera someone else has open, or None
+        self.running = True
+        self.thread = threading.Thread(target = self.run, name = "frame ring")
+        self.thread.daemon = True
+        self.thread.start()
+        print "Frame ring running,", self.slots, "frames of", self.width, "x", self.height
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(5)
+            self.thread = None
+        with self.lock:
+            self.release()
+
+    # Closes our own camera, e.g. so the clip recorder can open it.  The ring
+    # reopens it (or borrows) on its next frame.
+    def release(self):
+        with self.lock:
+            if self.camera is not None:
+                self.camera.close()
+                self.camera = None
+
+    def open_camera(self):
+        camera = self.held()
+        if camera is not None:
+            self.release()
+            return camera
+        if self.camera is None:
+            self.camera = self.picamera.PiCamera()
+            self.camera.resolution = CAMERA_RESOLUTION
+        return self.camera
+
+    def run(self):
+        interval = 1.0 / self.fps
+        stream = io.BytesIO()
+        while self.running:
+            start = time.time()
+            if self.frozen is None:
+                stream.seek(0)
+                stream.truncate()
+                try:
+                    with self.lock:
+                        self.open_camera().capture(stream, format = 'yuv', use_video_port = True,
+                                                   resize = (self.width, self.height))
+                    self.store(stream.getvalue(), start)
+                except Exception, e:
+                    print "Frame ring capture error", e
+                    time.sleep(1.0)
+            elapsed = time.time() - start
+            if elapsed > interval:
+                self.late += 1
+            time.sleep(max(0.0, interval - elapsed))
+
+    # Copies the Y plane of a raw capture into the next slot
+    def store(self, yuv, stamp):
+        rowlength = padded(self.width, self.height)[0]
+        if self.frozen is not None or len(yuv) < rowlength * self.height:
+            return
+        slot = self.written % self.slots
+        base = slot * self.frame_size
+        for row in range(self.height):
+            self.pixels[base + row * self.width:base + (row + 1) * self.width] = \
+                array('B', yuv[row * rowlength:row * rowlength + self.width])
+        self.stamps[slot] = stamp
+        self.written += 1
+        self.frames += 1
+
+    # Stops overwriting; safe to call from a GPIO callback
+    def freeze(self, channel = None):
+        if self.frozen is None:
+            self.frozen = time.time()
+            self.freezes += 1
+
+    # (timestamp, PGM data) of every frozen frame, oldest first; frames an
+    # earlier freeze already saved are left out
+    def frozen_frames(self):
+        out = []
+        for k in range(max(self.first, self.written - self.slots), self.written):
+            slot = k % self.slots
+            base = slot * self.frame_size
+            out.append((self.stamps[slot], pgm(self.width, self.height,
+                                               self.pixels[base:base + self.frame_size].tostring())))
+        return out
+
+    def thaw(self):
+        self.first = self.written
+        self.frozen = None
+
+    def summary(self):
+        return ("ring running=%d slots=%d frames=%d late=%d freezes=%d saved=%d memory=%dkB\n"
+                % (self.running, self.slots, self.frames, self.late, self.freezes, self.saved,
+                   (self.pixels.buffer_info()[1] * self.pixels.itemsize) // 1024))
@@ -0,0 +1,89 @@
+import time
+import threading
+
+#  ------------------------  Lazy hardware bring-up  -------------------------------
+# The payload used to open serial, set up GPIO, switch the camera mux (with its
+# 0.5 s settle), import picamera and probe the OLED one after the other before
+# the first command could be read.  Services lets the script open serial first
+# and start every other subsystem in its own thread; code that needs one calls
+# require() and only then waits for it.
+# ----------------------------------------------------------------------------------
+
+STARTUP_BUDGET = 1.0            # seconds from boot to serving commands
+
+
+class Services:
+    def __init__(self, boot = None):
+        self.boot = boot or time.time()
+        self.ready_at = None            # serial command handling up
+        self.first_ack = None           # first command acked
+        self.lock = threading.Lock()
+        self.items = {}
+        self.order = []
+
+    # Runs init() in the background (or inline) and records how long it took
+    def start(self, name, init, background = True):
+        item = {"name": name, "init": init, "done": threading.Event(),
+                "ok": False, "error": None, "start": time.time(), "seconds": 0.0}
+        with self.lock:
+            self.items[name] = item
+            self.order.append(name)
+        if background:
+            worker = threading.Thread(target = self._run, args = (item,), name = "init-" + name)
+            worker.daemon = True
+            worker.start()
+        else:
+            self._run(item)
+        return item
+
+    def _run(self, item):
+        try:
+            item["init"]()
+            item["ok"] = True
+        except Exception, e:
+            item["error"] = e
+            print "Init error in", item["name"], ":", e
+        item["seconds"] = time.time() - item["start"]
+        item["done"].set()
+
+    # True once the subsystem initialised successfully, never blocks
+    def ready(self, name):
+        item = self.items.get(name)
+        return item is not None and item["done"].is_set() and item["ok"]
+
+    # Waits for a subsystem to finish initialising, True if it is usable
+    def require(self, name, timeout = 10):
+        item = self.items.get(name)
+        if item is None:
+            return False
+        item["done"].wait(timeout)
+        return item["ok"]
+
+    def serving(self):
+        self.ready_at = time.time()
+        print "Serial ready after %.3fs" % (self.ready_at - self.boot)
+
+    def acked(self):
+        if self.first_ack is not None:
+            return
+        self.first_ack = time.time()
+        boot_to_ack = self.first_ack - self.boot
+        print "Boot to first ack %.3fs" % boot_to_ack
+        if self.ready_at is not None and self.ready_at - self.boot > STARTUP_BUDGET:
+            print "Startup over budget: %.3fs > %.1fs" % (self.ready_at - self.boot, STARTUP_BUDGET)
+
+    def timings(self):
+        parts = []
+        if self.ready_at is not None:
+            parts.append("serial=%.3f" % (self.ready_at - self.boot))
+        if self.first_ack is not None:
+            parts.append("firstack=%.3f" % (self.first_ack - self.boot))
+        for name in self.order:
+            item = self.items[name]
+            if not item["done"].is_set():
+                parts.append("%s=pending" % name)
+            elif item["ok"]:
+                parts.append("%s=%.3f" % (name, item["seconds"]))
+            else:
+                parts.append("%s=failed" % name)
+        return "boot " + " ".join(parts) + "\n"
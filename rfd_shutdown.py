@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+
+#  ------------------------  Orderly shutdown  -------------------------------
+# The shutdown switch's edge callback used to run /sbin/shutdown itself and
+# then sys.exit() in the callback thread, whatever the main loop was in the
+# middle of: a capture, a card write, a transfer.  Now the callback only calls
+# request().  The main loop notices it between commands (transfers check
+# between chunks and stop there) and calls run(), which goes through the
+# registered steps in order, each given what is left of the deadline:
+#
+#     transfers      cancel the background push, log where transfers stopped
+#     buffers        save a pending clip/ring freeze or profile, stop recording
+#     camera         (closed by the above, or by the capture that was running)
+#     pipeline       finish queued captures, stop the workers
+#     storage        flush queued images and imagedata.txt to the card
+#     logs           write timing.txt, fsync piruntimedata.txt
+#     serial, gpio   close and release
+#
+# then powers off (if the profile allows) with POWEROFF.  A watchdog powers
+# off anyway if that hasn't happened `deadline` seconds after the request,
+# e.g. because the main loop is stuck.  The step times go to shutdown.txt.
+# -----------------------------------------------------------------------------
+
+DEADLINE = 20.0
+POWEROFF = "/sbin/shutdown -h now"
+
+
+class ShutdownCoordinator:
+    def __init__(self, deadline = DEADLINE, poweroff = True, logpath = None):
+        self.deadline = deadline
+        self.poweroff = poweroff
+        self.logpath = logpath
+        self.steps = []                 # (name, func(seconds left))
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.finished = threading.Event()
+        self.reason = None
+        self.requested_at = None
+        self.started_at = None
+        self.timings = []               # (name, seconds, status)
+        self.forced = False
+
+    def add(self, name, func):
+        self.steps.append((name, func))
+
+    def requested(self):
+        return self.event.is_set()
+
+    # Safe to call from a GPIO callback or any other thread
+    def request(self, reason = "request"):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.requested_at = time.time()
+            self.event.set()
+        watchdog = threading.Thread(target = self.watchdog, name = "shutdown watchdog")
+        watchdog.daemon = True
+        watchdog.start()
+        print "Shutdown requested:", reason
+
+    def remaining(self):
+        return max(0.0, self.requested_at + self.deadline - time.time())
+
+    # Runs the steps in the calling (main) thread, then powers off
+    def run(self):
+        self.started_at = time.time()
+        for name, func in self.steps:
+            start = time.time()
+            if self.remaining() <= 0:
+                self.timings.append((name, 0.0, "skipped"))
+                continue
+            try:
+                func(self.remaining())
+                status = "ok"
+            except Exception, e:
+                status = "error %s: %s" % (e.__class__.__name__, e)
+            self.timings.append((name, time.time() - start, status))
+        self.write_log()
+        self.finished.set()
+        self.power_off()
+
+    def power_off(self):
+        if self.poweroff:
+            os.system(POWEROFF)
+
+    def watchdog(self):
+        if self.finished.wait(self.deadline):
+            return
+        self.forced = True
+        print "Shutdown deadline passed, forcing it"
+        self.write_log()
+        self.power_off()
+        os._exit(1)
+
+    def write_log(self):
+        if self.logpath is None:
+            return
+        lines = ["requested %s reason=%s noticed=%.3fs total=%.3fs forced=%d\n"
+                 % (time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(self.requested_at)), self.reason,
+                    (self.started_at or time.time()) - self.requested_at, time.time() - self.requested_at,
+                    self.forced)]
+        lines.extend(["%-10s %.3fs %s\n" % timing for timing in self.timings])
+        try:
+            fh = open(self.logpath, "w")
+            fh.write("".join(lines))
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.close()
+        except IOError:
+            print "shutdown.txt write error"
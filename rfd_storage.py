@@ -0,0 +1,184 @@
+import os
+import time
+import zlib
+import threading
+from collections import deque
+
+#  ------------------------  SD card storage manager  -------------------------------
+# Every pic_interval the payload writes a full-res PNG (_a, several MB) and a
+# JPEG thumbnail (_b).  Without checks a long flight fills the card and captures
+# and logs then fail silently.  StorageManager:
+#   - keeps the flight folder under a quota and the card above a free space floor
+#     by deleting the oldest full-res _a images (the _b thumbnails are kept)
+#   - takes captured images as in-memory buffers and writes them from a writer
+#     thread, each in a single write() followed by fdatasync, together with
+#     their imagedata.txt lines, so card latency spikes don't stall the main loop
+# ---------------------------------------------------------------------------------
+
+MB = 1024 * 1024
+QUEUE_LIMIT = 4                 # buffered images before save() blocks
+DEFAULT_A_SIZE = 8 * MB         # guess for the first full-res image
+
+
+class StorageManager:
+    def __init__(self, folder, catalog, quota_mb = 0, min_free_mb = 200, hard_min_free_mb = 20):
+        self.folder = folder
+        self.catalog = catalog
+        self.quota = quota_mb * MB              # 0 = no quota for the flight folder
+        self.min_free = min_free_mb * MB        # thin full-res images below this
+        self.hard_min_free = hard_min_free_mb * MB   # stop writing images below this
+        self.used = 0
+        self.last_a_size = DEFAULT_A_SIZE
+        self.thinned = 0
+        self.dropped = 0
+        self.write_time = 0.0
+        self.writes = 0
+        self.max_write = 0.0
+        self.timer = None                       # timer("write", seconds) per write, set by the payload
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.pending = set()
+        self.writer = None
+
+    def start(self):
+        self.writer = threading.Thread(target = self._writer, name = "storage-writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    # ---------------  space accounting  ------------------------------
+    def free_bytes(self):
+        try:
+            st = os.statvfs(self.folder)
+        except OSError:
+            return 0
+        return st.f_bavail * st.f_frsize
+
+    def over_quota(self, extra = 0):
+        return self.quota > 0 and self.used + extra > self.quota
+
+    # Frees space for a full-res capture by thinning old _a images.  Returns
+    # False if there still isn't room, in which case only the _b thumbnail
+    # should be taken.
+    def make_room(self, expected = None):
+        if expected is None:
+            expected = self.last_a_size
+        for entry in self.catalog.of_kind('a'):
+            if not (self.over_quota(expected) or self.free_bytes() - expected < self.min_free):
+                return True
+            if entry["stored"] and not entry["thinned"]:
+                self.thin(entry)
+        return not (self.over_quota(expected) or self.free_bytes() - expected < self.min_free)
+
+    def thin(self, entry):
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            print "Could not remove", entry["name"]
+            return
+        entry["thinned"] = True
+        self.used -= entry["size"]
+        self.thinned += 1
+        print "Storage: removed full-res", entry["name"]
+        self.append_lines(["%s removed @ time(%s) storage\n" % (entry["name"], time.strftime("%m/%d/%Y %H:%M:%S"))])
+
+    # ---------------  write batching  --------------------------------
+    # Queues an image buffer and its imagedata.txt line for the writer thread
+    def save(self, entry, data, line):
+        with self.cond:
+            while len(self.queue) >= QUEUE_LIMIT:
+                self.cond.wait(1.0)
+            self.queue.append((entry, data, line))
+            self.pending.add(entry["path"])
+            self.cond.notify_all()
+
+    # Marks a file that is still being produced (rfd_pipeline.py) so wait()
+    # holds readers until it has been saved and written
+    def reserve(self, path):
+        with self.cond:
+            self.pending.add(path)
+
+    # A reserved file that won't be saved after all
+    def release(self, path):
+        with self.cond:
+            self.pending.discard(path)
+            self.cond.notify_all()
+
+    # Blocks until `path` (if queued) has hit the card
+    def wait(self, path, timeout = 30):
+        deadline = time.time() + timeout
+        with self.cond:
+            while path in self.pending and time.time() < deadline:
+                self.cond.wait(0.5)
+
+    def flush(self, timeout = 30):
+        deadline = time.time() + timeout
+        with self.cond:
+            while (self.queue or self.pending) and time.time() < deadline:
+                self.cond.wait(0.5)
+
+    def _writer(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                batch = list(self.queue)
+                self.queue.clear()
+                self.cond.notify_all()
+            lines = []
+            for entry, data, line in batch:
+                if self.write_file(entry, data):
+                    lines.append(line)
+            if lines:
+                self.append_lines(lines)
+            with self.cond:
+                for entry, data, line in batch:
+                    self.pending.discard(entry["path"])
+                self.cond.notify_all()
+
+    def write_file(self, entry, data):
+        if self.free_bytes() - len(data) < self.hard_min_free:
+            self.dropped += 1
+            print "Storage full, dropped", entry["name"]
+            return False
+        start = time.time()
+        try:
+            fd = os.open(entry["path"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fdatasync(fd)
+            finally:
+                os.close(fd)
+        except (OSError, IOError), e:
+            self.dropped += 1
+            print "Storage write error", entry["name"], e
+            return False
+        elapsed = time.time() - start
+        self.write_time += elapsed
+        self.writes += 1
+        self.max_write = max(self.max_write, elapsed)
+        if self.timer is not None:
+            self.timer("write", elapsed)
+        entry["size"] = len(data)
+        entry["crc32"] = zlib.crc32(data) & 0xffffffff
+        entry["stored"] = True
+        self.used += len(data)
+        if entry["kind"] == 'a':
+            self.last_a_size = len(data)
+        return True
+
+    def append_lines(self, lines):
+        try:
+            fh = open(self.folder + "imagedata.txt", "a")
+            fh.write("".join(lines))
+            fh.flush()
+            os.fdatasync(fh.fileno())
+            fh.close()
+        except IOError:
+            print "imagedata.txt write error"
+
+    def summary(self):
+        return ("storage used=%.1fMB free=%.1fMB thinned=%d dropped=%d writes=%d avgwrite=%.3fs maxwrite=%.3fs\n"
+                % (float(self.used) / MB, float(self.free_bytes()) / MB, self.thinned, self.dropped,
+                   self.writes, self.write_time / max(self.writes, 1), self.max_write))
@@ -0,0 +1,112 @@
+import time
+import struct
+
+#  ------------------------  Link resynchronisation  -------------------------------
+# After a NAK the old sync() wrote "sync" and waited up to 10 s for an 'S',
+# then slept 0.5 s.  "sync" can occur in base64 image data, a lost ack cost the
+# full 5 s serial timeout, and a failed sync was only printed.  In "marker"
+# mode (profile "link_sync", or command 'L') a resync is instead:
+#
+#     payload:  SYNC_MARKER seq(H) attempt(B)     seq = chunk it will resend next
+#     ground:   SYNC_ACK    seq(H) attempt(B)     ready for chunk seq
+#
+# The markers start with SYN bytes, which never occur in base64, hex digests
+# or the single byte acks, so either side can find them in whatever junk is
+# still in flight.  The ack wait is sized from the serial backlog and the
+# measured round trip instead of the serial timeout, and if no ack comes the
+# marker is resent with exponential backoff up to RESYNC_DEADLINE; after that
+# the transfer is abandoned.  Normally recovery is one round trip.
+# ----------------------------------------------------------------------------------
+
+SYNC_MARKER = "\x16\x16\x16Z"
+SYNC_ACK = "\x16\x16\x16z"
+SYNC_INFO = struct.Struct(">HB")
+BASE_WAIT = 0.25                # first resync ack wait, before backoff
+MAX_WAIT = 4.0
+RESYNC_DEADLINE = 10.0
+ACK_MARGIN = 0.5                # chunk ack wait beyond the time to clock out the backlog
+
+
+class SyncLink:
+    def __init__(self, ser, baud):
+        self.ser = ser
+        self.baud = baud
+        self.resyncs = 0
+        self.attempts = 0
+        self.failures = 0
+        self.resync_time = 0.0
+
+    # Seconds until whatever is still queued for the radio has gone out
+    def backlog_time(self):
+        try:
+            return self.ser.outWaiting() * 10.0 / self.baud
+        except (AttributeError, IOError):
+            return 0.0
+
+    # Reads one byte, waiting at most `timeout` s, leaving the serial timeout as it was
+    def read_byte(self, timeout):
+        saved = self.ser.timeout
+        self.ser.timeout = max(timeout, 0.01)
+        try:
+            return self.ser.read()
+        finally:
+            self.ser.timeout = saved
+
+    # Waits for the ack of a chunk that was just written: as long as the chunk
+    # takes to clock out plus a few round trips
+    def read_ack(self, srtt = 0.0):
+        return self.read_byte(self.backlog_time() + max(ACK_MARGIN, 4 * srtt))
+
+    # Reads until `pattern` has been seen or `timeout` s have passed
+    def expect(self, pattern, timeout):
+        deadline = time.time() + timeout
+        seen = ""
+        while time.time() < deadline:
+            byte = self.read_byte(deadline - time.time())
+            if byte == "":
+                continue
+            seen = (seen + byte)[-len(pattern):]
+            if seen == pattern:
+                return True
+        return False
+
+    # Brings the ground back to the start of chunk `seq`.  Returns True when it
+    # has acked, False if it didn't within RESYNC_DEADLINE.
+    def resync(self, seq, srtt = 0.0):
+        start = time.time()
+        wait = max(BASE_WAIT, 4 * srtt)
+        attempt = 0
+        self.resyncs += 1
+        while time.time() - start < RESYNC_DEADLINE:
+            self.ser.flushInput()
+            self.ser.write(SYNC_MARKER + SYNC_INFO.pack(seq & 0xffff, attempt & 0xff))
+            self.attempts += 1
+            # any attempt's ack will do: they all mean "ready for chunk seq"
+            if self.expect(SYNC_ACK + SYNC_INFO.pack(seq & 0xffff, attempt & 0xff)[:2],
+                           self.backlog_time() + wait):
+                self.read_byte(wait)                    # the attempt byte
+                self.resync_time += time.time() - start
+                return True
+            attempt += 1
+            wait = min(wait * 2, MAX_WAIT)
+        self.failures += 1
+        self.resync_time += time.time() - start
+        return False
+
+    def summary(self):
+        return ("linksync resyncs=%d attempts=%d failures=%d avg=%.3fs\n"
+                % (self.resyncs, self.attempts, self.failures, self.resync_time / max(self.resyncs, 1)))
+
+
+# Ground station side: looks for a resync marker in bytes already read.
+# Returns (seq, attempt) or None.
+def find_marker(data):
+    pos = data.rfind(SYNC_MARKER)
+    if pos < 0 or len(data) < pos + len(SYNC_MARKER) + SYNC_INFO.size:
+        return None
+    return SYNC_INFO.unpack_from(data, pos + len(SYNC_MARKER))
+
+
+# Ground station side: acks a resync marker
+def ack(ser, seq, attempt):
+    ser.write(SYNC_ACK + SYNC_INFO.pack(seq, attempt))
@@ -0,0 +1,263 @@
+import os
+import sys
+import time
+import marshal
+import threading
+from StringIO import StringIO
+
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    cProfile = None
+
+#  ------------------------  Main loop timing  -------------------------------
+# The main loop used to leave nothing behind but "RT: n Watching Serial".
+# CycleTimer splits every pass of it into phases with lap(): the time since
+# the last lap goes to the phase named, e.g.
+#
+#     serial        waiting in ser.read() for a command (up to the 5 s timeout)
+#     cmd_1         handling command '1' (one phase per command byte)
+#     buffers       clip/ring saves
+#     camera_open   open_still_camera(), settings read, camera setup
+#     capture_a     full-res capture         capture_b   thumbnail capture
+#     queue         handing both to the pipeline, camera_close
+#     push          idle-time thumbnail push
+#
+# Work timed from inside a phase with add()/timed() (display updates, log
+# flushes) is taken out of the phase it happened in.  Other threads add()
+# too (the storage writer's "write"); their time overlaps the main loop's and
+# is listed, not taken out.
+#
+# Per phase the flight count/total/max is kept; a cycle whose busy time (all
+# but the serial wait) is over `slow` seconds is kept with its breakdown, the
+# last SLOW_KEPT of them.  Both go to timing.txt every SUMMARY_INTERVAL and
+# at shutdown, replacing the previous copy, so the file stays a few kB.
+#
+# Profiler (command 'X') runs cProfile, or a sampling profiler where
+# cProfile's overhead would distort the loop, on the main thread for a while
+# and hands back the report; see the 'X' handler in RFD_python_Pi.py.
+# ----------------------------------------------------------------------------
+
+SLOW_KEPT = 20
+SUMMARY_INTERVAL = 60.0
+SAMPLE_INTERVAL = 0.01          # sampling profiler period
+REPORT_LINES = 40
+
+
+class CycleTimer:
+    def __init__(self, path = None, slow = 2.0):
+        self.path = path
+        self.slow = slow
+        self.lock = threading.Lock()
+        self.main = threading.current_thread()
+        self.phases = {}                # name -> [count, total, max]
+        self.cycle = None               # name -> seconds, this cycle
+        self.cycles = 0
+        self.slow_cycles = []           # lines, newest last
+        self.slow_count = 0
+        self.mark = time.time()
+        self.nested = 0.0               # add()ed main thread time since the last lap
+        self.written = time.time()
+
+    # Starts a cycle, ending the last one if a `continue` skipped its end()
+    def start(self):
+        self.end()
+        self.cycle = {}
+        self.cycle_start = self.mark = time.time()
+        self.nested = 0.0
+
+    # The time since the last lap (less anything add()ed meanwhile) was `name`
+    def lap(self, name):
+        now = time.time()
+        self.record(name, now - self.mark - self.nested)
+        self.mark = now
+        self.nested = 0.0
+
+    # Time spent on `name` inside whatever phase is running; any thread
+    def add(self, name, seconds):
+        if threading.current_thread() is self.main:
+            self.nested += seconds
+        self.record(name, seconds)
+
+    def timed(self, name):
+        return Timed(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = [0, 0.0, 0.0]
+            phase[0] += 1
+            phase[1] += seconds
+            phase[2] = max(phase[2], seconds)
+            if self.cycle is not None:
+                self.cycle[name] = self.cycle.get(name, 0.0) + seconds
+
+    def end(self):
+        if self.cycle is None:
+            return
+        total = time.time() - self.cycle_start
+        busy = total - self.cycle.get("serial", 0.0)
+        with self.lock:
+            cycle = self.cycle
+            self.cycle = None
+            self.cycles += 1
+            if busy > self.slow:
+                self.slow_count += 1
+                self.slow_cycles.append("%s busy=%.3fs %s\n" % (time.strftime("%H:%M:%S", time.localtime(self.cycle_start)),
+                                                                busy, format_phases(cycle)))
+                del self.slow_cycles[:-SLOW_KEPT]
+        if time.time() - self.written > SUMMARY_INTERVAL:
+            self.write()
+
+    # One line for command 'M': average/max per phase, slowest total first
+    def summary(self):
+        with self.lock:
+            phases = sorted(self.phases.items(), key = lambda item: -item[1][1])
+            return ("timing cycles=%d slow=%d %s\n"
+                    % (self.cycles, self.slow_count,
+                       " ".join(["%s=%.3f/%.3f" % (name, total / count, peak) for name, (count, total, peak) in phases])))
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases.items(), key = lambda item: -item[1][1])
+            lines = ["cycles=%d slow=%d (busy > %.1fs)\n" % (self.cycles, self.slow_count, self.slow),
+                     "%-12s %7s %9s %8s %8s\n" % ("phase", "count", "total", "avg", "max")]
+            lines.extend(["%-12s %7d %9.3f %8.4f %8.3f\n" % (name, count, total, total / count, peak)
+                          for name, (count, total, peak) in phases])
+            lines.append("slow cycles:\n")
+            lines.extend(self.slow_cycles)
+        return "".join(lines)
+
+    # Replaces timing.txt, never leaving a half written one
+    def write(self, sync = False):
+        self.written = time.time()
+        if self.path is None:
+            return
+        try:
+            fh = open(self.path + ".tmp", "w")
+            fh.write(self.report())
+            if sync:
+                fh.flush()
+                os.fsync(fh.fileno())
+            fh.close()
+            os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError):
+            print "timing.txt write error"
+
+
+class Timed:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, kind, value, traceback):
+        self.timer.add(self.name, time.time() - self.start)
+
+
+# "serial=4.995 cmd_1=12.301 display=0.104", biggest first
+def format_phases(cycle):
+    return " ".join(["%s=%.3f" % item for item in sorted(cycle.items(), key = lambda item: -item[1])])
+
+
+# Profiles the main thread from start() until stop() or the window runs out.
+# "cprofile" is exact but slows what it measures; "sample" looks at the main
+# thread's stack every SAMPLE_INTERVAL and counts where it is.
+class Profiler:
+    def __init__(self):
+        self.mode = None
+        self.until = 0.0
+        self.started = 0.0
+        self.runs = 0
+        self.profile = None
+        self.samples = {}               # (file, line, function) -> [innermost, on stack]
+        self.sample_count = 0
+        self.thread = None
+
+    def modes(self):
+        return (["cprofile"] if cProfile is not None else []) + ["sample"]
+
+    def running(self):
+        return self.mode is not None
+
+    def expired(self):
+        return self.mode is not None and time.time() > self.until
+
+    # Call from the thread to profile
+    def start(self, mode, seconds):
+        if self.mode is not None or mode not in self.modes():
+            return False
+        self.mode = mode
+        self.started = time.time()
+        self.until = self.started + seconds
+        self.runs += 1
+        if mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.samples = {}
+            self.sample_count = 0
+            self.target = threading.current_thread().ident
+            self.thread = threading.Thread(target = self.sample, name = "sampler")
+            self.thread.daemon = True
+            self.thread.start()
+        print "Profiling", mode, "for", seconds, "s"
+        return True
+
+    def sample(self):
+        while self.mode == "sample":
+            frame = sys._current_frames().get(self.target)
+            seen = set()
+            innermost = True
+            while frame is not None:
+                code = frame.f_code
+                key = (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+                counts = self.samples.get(key)
+                if counts is None:
+                    counts = self.samples[key] = [0, 0]
+                if innermost:
+                    counts[0] += 1
+                    innermost = False
+                if key not in seen:
+                    counts[1] += 1
+                    seen.add(key)
+                frame = frame.f_back
+            self.sample_count += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+    # Stops and returns [(suffix, data)] to save: the text report and, for
+    # cprofile, the raw pstats dump for offline viewers
+    def stop(self):
+        mode = self.mode
+        if mode is None:
+            return []
+        seconds = time.time() - self.started
+        self.mode = None
+        if mode == "cprofile":
+            self.profile.disable()
+            out = StringIO()
+            stats = pstats.Stats(self.profile, stream = out)
+            out.write("cprofile %.1fs\n" % seconds)
+            stats.sort_stats("cumulative").print_stats(REPORT_LINES)
+            raw = dump(self.profile)
+            self.profile = None
+            return [("cum.txt", out.getvalue()), ("raw.prf", raw)]
+        self.thread.join(1.0)
+        total = max(self.sample_count, 1)
+        lines = ["sample %.1fs %d samples every %.3fs\n" % (seconds, self.sample_count, SAMPLE_INTERVAL),
+                 "%6s %6s  %s\n" % ("self%", "cum%", "function")]
+        ranked = sorted(self.samples.items(), key = lambda item: (-item[1][1], -item[1][0]))
+        for (filename, line, function), (inner, stacked) in ranked[:REPORT_LINES]:
+            lines.append("%6.1f %6.1f  %s:%d(%s)\n" % (100.0 * inner / total, 100.0 * stacked / total,
+                                                      filename, line, function))
+        return [("smp.txt", "".join(lines))]
+
+
+# pstats' marshalled dump, as Profile.dump_stats would write it
+def dump(profile):
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
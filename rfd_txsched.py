@@ -0,0 +1,111 @@
+import time
+import heapq
+import itertools
+
+#  ------------------------  Transmit scheduler  -------------------------------
+# Long transfers (send_image) are written as generators that yield after every
+# chunk, so they can be interrupted between chunks.  When the ground station
+# answers a chunk with a control command byte (ping '6', time sync 'T') instead
+# of 'Y'/'N', the transfer hands it to preempt(); the scheduler serves the
+# control exchange before the transfer's next unit, and the transfer then
+# resends the chunk that was not acked.  Control latency during a download is
+# bounded by one chunk instead of the whole image.
+#
+# Lower number = more urgent.  LOW is for background traffic that should only
+# use otherwise idle link time.
+# ------------------------------------------------------------------------------
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+
+class Job:
+    def __init__(self, name, steps, priority = NORMAL):
+        self.name = name
+        self.steps = steps          # generator, the last value it yields is the result
+        self.priority = priority
+        self.done = False
+        self.result = None
+
+    def step(self):
+        try:
+            self.result = next(self.steps)
+        except StopIteration:
+            self.done = True
+
+
+def once(handler, *args):
+    yield handler(*args)
+
+
+class TxScheduler:
+    def __init__(self):
+        self.queue = []
+        self.seq = itertools.count()
+        self.control = {}           # command byte -> handler, e.g. {'6': handle_ping}
+        self.preemptions = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.pending_since = {}
+
+    def submit(self, job):
+        heapq.heappush(self.queue, (job.priority, next(self.seq), job))
+        return job
+
+    def is_control(self, byte):
+        return byte in self.control
+
+    # Queues the handler for a control byte that arrived in the middle of a transfer
+    def preempt(self, byte):
+        self.preemptions += 1
+        job = self.submit(Job("control " + byte, once(self.control[byte]), HIGH))
+        self.pending_since[job] = time.time()
+        return job
+
+    # Runs queued jobs one unit at a time, most urgent first, until `job` (or
+    # the queue, if job is None) is finished.  Returns job's result.
+    def run(self, job = None):
+        if job is not None and job not in [entry[2] for entry in self.queue]:
+            self.submit(job)
+        while self.queue:
+            if self.step_next() is job and job.done:
+                break
+        if job is None:
+            return None
+        return job.result
+
+    # Like run(job) for background work: stops between units as soon as stop()
+    # is true.  Returns True if the job was cut short (it stays queued).
+    def run_until(self, job, stop):
+        if job not in [entry[2] for entry in self.queue]:
+            self.submit(job)
+        while self.queue:
+            if stop():
+                return True
+            if self.step_next() is job and job.done:
+                break
+        return False
+
+    # Drops a job that was cut short and won't be resumed
+    def cancel(self, job):
+        self.queue = [entry for entry in self.queue if entry[2] is not job]
+        heapq.heapify(self.queue)
+        job.steps.close()
+        job.done = True
+
+    # Runs one unit of the most urgent job, returns that job
+    def step_next(self):
+        priority, seq, current = heapq.heappop(self.queue)
+        if current in self.pending_since:
+            waited = time.time() - self.pending_since.pop(current)
+            self.latency_total += waited
+            self.latency_max = max(self.latency_max, waited)
+        current.step()
+        if not current.done:
+            heapq.heappush(self.queue, (current.priority, next(self.seq), current))
+        return current
+
+    def summary(self):
+        return ("txsched preemptions=%d latency avg=%.3fs max=%.3fs\n"
+                % (self.preemptions, self.latency_total / max(self.preemptions, 1), self.latency_max))